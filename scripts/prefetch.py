@@ -0,0 +1,44 @@
+import argparse
+
+import teuthology.prefetch
+
+
+def main():
+    teuthology.prefetch.main(parse_args())
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="""
+Watch beanstalk queues for the teuthology and suite branches that upcoming
+jobs need, and fetch - and for teuthology, bootstrap - them before workers
+reserve the jobs.
+""")
+    parser.add_argument(
+        '-v', '--verbose',
+        action='store_true', default=None,
+        help='be more verbose',
+    )
+    parser.add_argument(
+        '-l', '--log-dir',
+        help='path in which to store logs',
+    )
+    parser.add_argument(
+        '-t', '--tube',
+        action='append',
+        help='a beanstalk tube to watch; may be given more than once',
+        required=True,
+    )
+    parser.add_argument(
+        '-n', '--jobs',
+        type=int,
+        default=100,
+        help='how many of the next jobs in each tube to look at',
+    )
+    parser.add_argument(
+        '-i', '--interval',
+        type=int,
+        default=60,
+        help='how many seconds to wait between looks at the queue',
+    )
+
+    return parser.parse_args()
@@ -17,7 +17,7 @@ optional arguments:
                         The base archive directory
                         [default: {archive_base}]
   --dry-run             Don't actually delete anything; just log what would be
-                        deleted
+                        deleted, and how many bytes that would free
   -p DAYS, --pass DAYS  Remove all logs for jobs which passed and are older
                         than DAYS. Negative values will skip this operation.
                         [default: 14]
@@ -27,9 +27,13 @@ optional arguments:
                         Negative values will skip this operation.
                         [default: 60]
   -z DAYS, --compress DAYS
-                        Compress (using gzip) any teuthology.log files older
-                        than DAYS. Negative values will skip this operation.
+                        Compress any teuthology.log files older than DAYS.
+                        Negative values will skip this operation.
                         [default: 30]
+  -c PROG, --compressor PROG
+                        The program to compress logs with: gzip or zstd
+                        [default: gzip]
+  -j N, --jobs N        How many logs to compress at once [default: 4]
 """.format(archive_base=teuthology.config.config.archive_base)
 
 
@@ -5,9 +5,9 @@ import teuthology.report
 doc = """
 usage:
     teuthology-report -h
-    teuthology-report [-v] [-R] [-n] [-s SERVER] [-a ARCHIVE] [-D] -r RUN ...
-    teuthology-report [-v] [-s SERVER] [-a ARCHIVE] [-D] -r RUN -j JOB ...
-    teuthology-report [-v] [-R] [-n] [-s SERVER] [-a ARCHIVE] --all-runs
+    teuthology-report [-v] [-R] [-n] [-s SERVER] [-a ARCHIVE] [-D] [-c N] [-b] -r RUN ...
+    teuthology-report [-v] [-s SERVER] [-a ARCHIVE] [-D] [-c N] [-b] -r RUN -j JOB ...
+    teuthology-report [-v] [-R] [-n] [-s SERVER] [-a ARCHIVE] [-c N] [-b] --all-runs
 
 Submit test results to a web service
 
@@ -28,9 +28,14 @@ optional arguments:
                         http://localhost:8080/ . May also be specified in
                         ~/.teuthology.yaml as 'results_server'
   -n, --no-save         By default, when submitting all runs, we remember the
-                        last successful submission in a file called
-                        'last_successful_run'. Pass this flag to disable that
-                        behavior.
+                        runs submitted successfully in files called
+                        'last_successful_run' and 'reported_runs', so an
+                        interrupted submission can be resumed. Pass this flag
+                        to disable that behavior.
+  -c N, --concurrency N
+                        How many runs, and how many jobs of each run, to
+                        submit at once [default: 8]
+  -b, --bulk            Submit jobs in batches, if the server supports it
   -D, --dead            Mark all given jobs (or entire runs) with status
                         'dead'. Implies --refresh.
   -v, --verbose         be more verbose
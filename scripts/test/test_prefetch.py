@@ -0,0 +1,5 @@
+from script import Script
+
+
+class TestPrefetch(Script):
+    script_name = 'teuthology-prefetch'
@@ -117,6 +117,7 @@ setup(
             'teuthology-suite = scripts.suite:main',
             'teuthology-ls = scripts.ls:main',
             'teuthology-worker = scripts.worker:main',
+            'teuthology-prefetch = scripts.prefetch:main',
             'teuthology-lock = scripts.lock:main',
             'teuthology-schedule = scripts.schedule:main',
             'teuthology-updatekeys = scripts.updatekeys:main',
@@ -0,0 +1,148 @@
+import json
+import logging
+import os
+import sqlite3
+import time
+
+log = logging.getLogger(__name__)
+
+
+class ArchiveIndex(object):
+    """
+    A persistent cache of things read from an archive directory, kept in an
+    SQLite database inside it.
+
+    Each value is stored along with a 'stamp' describing what it was read
+    from - typically the modification times of some files or directories -
+    and is read again whenever that stamp changes. If the database can't be
+    used, e.g. because the archive isn't writable, nothing is cached and every
+    value is read from scratch.
+    """
+    dir_name = '.index'
+    file_name = 'archive.db'
+    # Values read from anything modified more recently than this many seconds
+    # ago aren't stored; a later modification might leave the mtime as it is
+    settle_time = 2
+
+    def __init__(self, archive_base):
+        self.archive_base = archive_base
+        self.path = os.path.join(archive_base, self.dir_name, self.file_name)
+        self._conn = None
+        self._disabled = False
+
+    @property
+    def conn(self):
+        """
+        The database connection, or None if the index can't be used
+        """
+        if self._conn is None and not self._disabled:
+            try:
+                self._conn = self._connect()
+            except (EnvironmentError, sqlite3.Error):
+                log.debug("Not using the archive index at %s", self.path,
+                          exc_info=True)
+                self._disabled = True
+        return self._conn
+
+    def _connect(self):
+        if not os.path.isdir(self.archive_base):
+            raise IOError("%s does not exist" % self.archive_base)
+        index_dir = os.path.dirname(self.path)
+        if not os.path.isdir(index_dir):
+            os.mkdir(index_dir)
+        conn = sqlite3.connect(self.path, timeout=30)
+        # this is only a cache; a lost write just means reading the archive
+        conn.execute('PRAGMA synchronous = OFF')
+        conn.execute(
+            'CREATE TABLE IF NOT EXISTS entries '
+            '(key TEXT PRIMARY KEY, stamp TEXT, value TEXT)')
+        conn.commit()
+        return conn
+
+    def get(self, key, stamp, read, mtime=None):
+        """
+        Return the value stored under key, if it was stored with the same
+        stamp. Otherwise, call read() and store what it returns.
+
+        Values must survive being round-tripped through JSON unchanged to be
+        stored; ones that don't are returned without being stored.
+
+        :param key:   A string identifying the value
+        :param stamp: A JSON-serializable object that changes whenever the
+                      value might have
+        :param read:  A function returning the value
+        :param mtime: The newest modification time involved in stamp. If it is
+                      too recent, the value is read but not stored.
+        :returns:     The value
+        """
+        conn = self.conn
+        if conn is None:
+            return read()
+        stamp = json.dumps(stamp)
+        try:
+            row = conn.execute(
+                'SELECT value FROM entries WHERE key = ? AND stamp = ?',
+                (key, stamp)).fetchone()
+        except sqlite3.Error:
+            log.debug("Failed to query the archive index", exc_info=True)
+            return read()
+        if row is not None:
+            return json.loads(row[0])
+        value = read()
+        if mtime is not None and mtime > time.time() - self.settle_time:
+            return value
+        try:
+            dumped = json.dumps(value)
+        except (TypeError, ValueError):
+            return value
+        if json.loads(dumped) != value:
+            return value
+        try:
+            conn.execute(
+                'INSERT OR REPLACE INTO entries VALUES (?, ?, ?)',
+                (key, stamp, dumped))
+            conn.commit()
+        except sqlite3.Error:
+            log.debug("Failed to update the archive index", exc_info=True)
+        return value
+
+    def keys(self, prefix):
+        """
+        :returns: The keys of the values stored under keys starting with
+                  prefix
+        """
+        conn = self.conn
+        if conn is None:
+            return []
+        try:
+            # a range, rather than a match on part of the key, so that the
+            # primary key's index is used
+            rows = conn.execute(
+                'SELECT key FROM entries WHERE key >= ? AND key < ?',
+                (prefix, prefix + u'\U0010ffff')).fetchall()
+        except sqlite3.Error:
+            log.debug("Failed to query the archive index", exc_info=True)
+            return []
+        return [row[0] for row in rows]
+
+    def delete(self, keys):
+        """
+        Remove values from the index, e.g. because what they were read from
+        is gone
+
+        :param keys: The values' keys
+        """
+        conn = self.conn
+        if conn is None or not keys:
+            return
+        try:
+            conn.executemany('DELETE FROM entries WHERE key = ?',
+                             [(key,) for key in keys])
+            conn.commit()
+        except sqlite3.Error:
+            log.debug("Failed to update the archive index", exc_info=True)
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
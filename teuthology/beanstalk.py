@@ -7,6 +7,7 @@ from collections import OrderedDict
 
 from teuthology.config import config
 from teuthology import report
+from teuthology.parallel import parallel
 
 log = logging.getLogger(__name__)
 
@@ -36,7 +37,11 @@ def watch_tube(connection, tube_name):
 
 def walk_jobs(connection, tube_name, processor, pattern=None):
     """
-    def callback(jobs_dict)
+    Pass each job that is ready in a tube to processor.add_job(), in the
+    order workers would reserve them, then call processor.complete()
+
+    The jobs are found with peek_ready_jobs(), so they stay available to
+    workers all along.
     """
     log.info("Checking Beanstalk Queue...")
     job_count = connection.stats_tube(tube_name)['current-jobs-ready']
@@ -44,23 +49,153 @@ def walk_jobs(connection, tube_name, processor, pattern=None):
         log.info('No jobs in Beanstalk Queue')
         return
 
-    # Try to figure out a sane timeout based on how many jobs are in the queue
-    timeout = job_count / 2000.0 * 60
-    for i in range(1, job_count + 1):
-        print_progress(i, job_count, "Loading")
-        job = connection.reserve(timeout=timeout)
-        if job is None or job.body is None:
-            continue
-        job_config = yaml.safe_load(job.body)
+    jobs = peek_ready_jobs(connection, tube_name, job_count, max_ids=None)
+    for (job_id, job_config, job) in jobs:
         job_name = job_config['name']
-        job_id = job.stats()['id']
         if pattern is not None and pattern not in job_name:
             continue
         processor.add_job(job_id, job_config, job)
-    end_progress()
     processor.complete()
 
 
+# The parsed bodies of jobs we have seen, by id, along with the bodies
+# themselves. A job's body never changes, so each only needs parsing once.
+_job_configs = dict()
+
+
+def parse_job_body(job_id, body):
+    """
+    Parse a job's body, or return what it was parsed into last time
+    """
+    cached = _job_configs.get(job_id)
+    if cached is not None and cached[0] == body:
+        return cached[1]
+    job_config = yaml.safe_load(body)
+    _job_configs[job_id] = (body, job_config)
+    return job_config
+
+
+def peek_ready_jobs(connection, tube_name, job_count=None, concurrency=8,
+                    batch_size=1000, max_ids=100000):
+    """
+    Find the jobs that are ready in a tube, without reserving them
+
+    beanstalkd can only peek at the single next job in a tube, so job ids are
+    peeked at one by one instead: first any newer than the server's job
+    count, then from there downwards, until all of the tube's ready jobs have
+    been found or every job on the server has been seen. Only then are they
+    sorted, so that the first job_count of them are the ones workers will
+    reserve next. Each batch_size ids are split across concurrency
+    connections.
+
+    No more than max_ids ids below the server's job count are peeked at. If
+    the tube still has ready jobs older than that, they are left out, and a
+    warning is logged. Callers that must see every job, e.g. to delete them,
+    pass max_ids=None.
+
+    :param connection:  A beanstalkc.Connection
+    :param tube_name:   The tube to look in
+    :param job_count:   How many jobs to return, at most; defaults to all of
+                        them
+    :param concurrency: How many connections to peek with at once
+    :param batch_size:  How many job ids to peek at between checking whether
+                        all the jobs have been found
+    :param max_ids:     The most ids to peek at below the server's job
+                        count, or None for no limit
+    :returns:           A list of (job_id, job_config, job) tuples, in the
+                        order workers would reserve the jobs. job is a
+                        beanstalkc.Job using connection, which may be used to
+                        delete it.
+    """
+    tube_ready = connection.stats_tube(tube_name)['current-jobs-ready']
+    server_stats = connection.stats()
+    server_jobs = sum(
+        server_stats['current-jobs-%s' % state]
+        for state in ('ready', 'reserved', 'delayed', 'buried')
+    )
+    newest_id = server_stats['total-jobs']
+
+    connections = [connection] + [
+        beanstalkc.Connection(host=connection.host, port=connection.port)
+        for i in range(concurrency - 1)
+    ]
+    found = dict()
+    try:
+        def peek(job_ids):
+            with parallel() as p:
+                for (i, conn) in enumerate(connections):
+                    p.spawn(_peek_jobs, conn, job_ids[i::len(connections)])
+                for jobs in p:
+                    found.update(jobs)
+
+        # If the server was restarted with a binlog, ids may carry on from
+        # where they were rather than matching total-jobs
+        bottom = newest_id + 1
+        while True:
+            before = len(found)
+            peek(list(range(bottom, bottom + batch_size)))
+            bottom += batch_size
+            if len(found) == before:
+                break
+
+        top = newest_id
+        if max_ids is None:
+            lowest = 0
+        else:
+            lowest = max(newest_id - max_ids, 0)
+        while True:
+            ready = len([stats for (stats, body) in found.values()
+                         if stats['tube'] == tube_name and
+                         stats['state'] == 'ready'])
+            if ready >= tube_ready or len(found) >= server_jobs:
+                break
+            if top <= lowest:
+                log.warning(
+                    "Found %s of the %s jobs ready in %s in the newest %s "
+                    "job ids; leaving out any older ones",
+                    ready, tube_ready, tube_name, max_ids)
+                break
+            log.debug("Found %s of %s ready jobs in %s; peeking below id %s",
+                      ready, tube_ready, tube_name, top)
+            peek(list(range(top, max(top - batch_size, lowest), -1)))
+            top -= batch_size
+    finally:
+        for conn in connections[1:]:
+            conn.close()
+
+    jobs = list()
+    for (job_id, (stats, body)) in found.items():
+        if stats['tube'] != tube_name or stats['state'] != 'ready':
+            continue
+        jobs.append((stats['pri'], job_id, body))
+    jobs.sort(key=lambda job: job[:2])
+    if job_count is not None:
+        jobs = jobs[:job_count]
+    return [
+        (job_id, parse_job_body(job_id, body),
+         beanstalkc.Job(connection, job_id, body, reserved=False))
+        for (pri, job_id, body) in jobs
+    ]
+
+
+def _peek_jobs(connection, job_ids):
+    """
+    :returns: A dict mapping the ids of the jobs that exist to (stats, body)
+    """
+    jobs = dict()
+    for job_id in job_ids:
+        job = connection.peek(job_id)
+        if job is None:
+            continue
+        try:
+            stats = job.stats()
+        except beanstalkc.CommandFailed:
+            # it was deleted in the meantime
+            continue
+        jobs[job_id] = (stats, job.body)
+    return jobs
+
+
 def print_progress(index, total, message=None):
     msg = "{m} ".format(m=message) if message else ''
     sys.stderr.write("{msg}{i}/{total}\r".format(
@@ -136,11 +136,17 @@ class TeuthologyConfig(YamlConfig):
     yaml_path = os.path.join(os.path.expanduser('~/.teuthology.yaml'))
     _defaults = {
         'archive_base': '/home/teuthworker/archive',
+        'archive_compress_level': None,
+        'archive_concurrency': 8,
+        'archive_max_bytes_per_host': None,
+        'archive_timeout_per_host': None,
         'archive_upload': None,
         'archive_upload_key': None,
         'archive_upload_url': None,
         'automated_scheduling': False,
         'reserve_machines': 5,
+        'lock_notify_dir': '/tmp/teuthology-unlocks',
+        'partial_lock_hold': 0,
         'ceph_git_base_url': 'https://github.com/ceph/',
         'ceph_git_url': None,
         'ceph_qa_suite_git_url': None,
@@ -154,14 +160,19 @@ class TeuthologyConfig(YamlConfig):
         'lab_domain': 'front.sepia.ceph.com',
         'lock_server': 'http://paddles.front.sepia.ceph.com/',
         'max_job_time': 259200,  # 3 days
+        'max_concurrent_node_ops': None,
         'nsupdate_url': 'http://nsupdate.front.sepia.ceph.com/update',
         'results_server': 'http://paddles.front.sepia.ceph.com/',
         'results_ui_server': 'http://pulpito.ceph.com/',
         'results_sending_email': 'teuthology',
         'results_timeout': 43200,
+        'ref_cache_path': None,
+        'ref_cache_ttl': 60,
         'src_base_path': os.path.expanduser('~/src'),
+        'venv_cache_path': None,
         'verify_host_keys': True,
         'watchdog_interval': 120,
+        'heartbeat_spool_dir': '/tmp/teuthology-heartbeats',
         'kojihub_url': 'http://koji.fedoraproject.org/kojihub',
         'kojiroot_url': 'http://kojipkgs.fedoraproject.org/packages',
         'koji_task_url': 'https://kojipkgs.fedoraproject.org/work/',
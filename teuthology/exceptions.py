@@ -182,3 +182,41 @@ class NoRemoteError(Exception):
 
     def __str__(self):
         return self.message
+
+
+class ParallelTimeoutError(Exception):
+    """
+    Raised by a function spawned by teuthology.parallel.parallel that ran for
+    longer than the timeout it was given
+    """
+    def __init__(self, func, timeout):
+        self.func = func
+        self.timeout = timeout
+
+    def __str__(self):
+        return "{func} did not finish within {timeout}s".format(
+            func=getattr(self.func, '__name__', self.func),
+            timeout=self.timeout,
+        )
+
+
+class ClusterCommandError(Exception):
+    """
+    Raised when a command run on several remotes at once failed on some of
+    them
+    """
+    def __init__(self, errors):
+        """
+        :param errors: A dict of the exceptions raised, keyed by remote
+        """
+        self.errors = errors
+
+    def __str__(self):
+        return "Command failed on {count} remote(s): {errors}".format(
+            count=len(self.errors),
+            errors='; '.join(
+                '{name}: {error}'.format(
+                    name=getattr(remote, 'name', remote), error=error)
+                for remote, error in self.errors.items()
+            ),
+        )
@@ -126,15 +126,11 @@ def remove_beanstalk_jobs(run_name, tube_name):
 
     curjobs = beanstalk_conn.stats_tube(real_tube_name)['current-jobs-ready']
     if curjobs != 0:
-        x = 1
-        while x != curjobs:
-            x += 1
-            job = beanstalk_conn.reserve(timeout=20)
-            if job is None:
-                continue
-            job_config = yaml.safe_load(job.body)
+        # every one of the run's jobs must be found, however old
+        jobs = beanstalk.peek_ready_jobs(beanstalk_conn, real_tube_name,
+                                         curjobs, max_ids=None)
+        for (job_id, job_config, job) in jobs:
             if run_name == job_config['name']:
-                job_id = job.stats()['id']
                 msg = "Deleting job from queue. ID: " + \
                     "{id} Name: {name} Desc: {desc}".format(
                         id=str(job_id),
@@ -152,16 +152,29 @@ def main(ctx):
         reimage_machines = list()
         updatekeys_machines = list()
         machine_types = dict()
+        responses = ops.map_nodes(
+            lambda machine: ops.lock_one(machine, user, ctx.desc),
+            machines,
+        )
+        locked = [machine for machine in machines
+                  if responses[machine] is not None and
+                  responses[machine].ok]
+        if len(locked) < len(machines) and not ctx.f:
+            # They were all locked at once, so don't leave the ones that
+            # were locked behind with nothing done to them
+            if locked:
+                log.error("Could not lock all of the machines; unlocking %s",
+                          ' '.join(locked))
+                ops.unlock_many(locked, user or misc.get_user())
+            return 1
         for machine in machines:
-            resp = ops.lock_one(machine, user, ctx.desc)
-            if resp.ok:
+            resp = responses[machine]
+            if resp is not None and resp.ok:
                 machine_status = resp.json()
                 machine_type = machine_status['machine_type']
                 machine_types[machine] = machine_type
-            if not resp.ok:
+            if resp is None or not resp.ok:
                 ret = 1
-                if not ctx.f:
-                    return ret
             elif not query.is_vm(machine, machine_status):
                 if machine_type in reimage_types:
                     # Reimage in parallel just below here
@@ -170,28 +183,49 @@ def main(ctx):
                 updatekeys_machines = list()
             else:
                 machines_to_update.append(machine)
-                ops.update_nodes([machine], True)
-                teuthology.provision.create_if_vm(
-                    ctx,
-                    misc.canonicalize_hostname(machine),
-                )
+        # Create the VMs in parallel
+        created = ops.map_nodes(lambda machine: create_vm(ctx, machine),
+                                machines_to_update)
+        not_created = [machine for machine in machines_to_update
+                       if not created[machine]]
+        if not_created:
+            log.error("Could not create virtual machines: %s",
+                      ' '.join(not_created))
+            ret = 1
         with teuthology.parallel.parallel() as p:
             ops.update_nodes(reimage_machines, True)
             for machine in reimage_machines:
                 p.spawn(teuthology.provision.reimage, ctx, machine, machine_types[machine])
-        for machine in updatekeys_machines:
-            ops.do_update_keys([machine])
+        if updatekeys_machines:
+            ops.do_update_keys(updatekeys_machines)
         ops.update_nodes(reimage_machines + machines_to_update)
 
     elif ctx.unlock:
         if ctx.owner is None and user is None:
             user = misc.get_user()
+        # One request for all of their statuses, rather than one per machine
+        statuses = dict((status['name'], status)
+                        for status in query.get_statuses(machines))
+        vms = [machine for machine in machines
+               if query.is_vm(status=statuses.get(
+                   misc.canonicalize_hostname(machine, user=None), dict()))]
         # If none of them are vpm, do them all in one shot
-        if not filter(query.is_vm, machines):
+        if not vms:
             res = ops.unlock_many(machines, user)
             return 0 if res else 1
-        for machine in machines:
-            if not ops.unlock_one(ctx, machine, user):
+        # Otherwise do the ones that aren't in one shot, and destroy and
+        # unlock the VMs in parallel
+        others = [machine for machine in machines if machine not in vms]
+        if others and not ops.unlock_many(others, user):
+            ret = 1
+            if not ctx.f:
+                return ret
+        results = ops.map_nodes(
+            lambda machine: ops.unlock_one(ctx, machine, user),
+            vms,
+        )
+        for machine in vms:
+            if not results[machine]:
                 ret = 1
                 if not ctx.f:
                     return ret
@@ -234,12 +268,27 @@ def main(ctx):
         machines_to_update = machines
 
         if ctx.desc is not None or ctx.status is not None:
-            for machine in machines_to_update:
-                ops.update_lock(machine, ctx.desc, ctx.status)
+            results = ops.update_many(machines_to_update, ctx.desc,
+                                      ctx.status)
+            failed = [name for name, ok in results.items() if not ok]
+            if failed:
+                log.error("Failed to update: %s", ' '.join(sorted(failed)))
+                ret = 1
 
     return ret
 
 
+def create_vm(ctx, machine):
+    """
+    Create a virtual machine that was just locked
+    """
+    ops.update_nodes([machine], True)
+    return teuthology.provision.create_if_vm(
+        ctx,
+        misc.canonicalize_hostname(machine),
+    )
+
+
 def do_summary(ctx):
     lockd = collections.defaultdict(lambda: [0, 0, 'unknown'])
     if ctx.machine_type:
@@ -0,0 +1,173 @@
+import logging
+import os
+import time
+
+import requests
+
+from teuthology.config import config
+from teuthology.util.compat import urlencode
+
+log = logging.getLogger(__name__)
+
+
+class LockServerClient(object):
+    """
+    Talks to the lock server over a single pooled session, and remembers the
+    node records it sees for a short while.
+
+    A job asks about the same nodes from many places - whether they are VMs,
+    who has them locked, what their keys are - so records are kept for ttl
+    seconds and shared by all of them. Anything that changes a node through
+    this client makes it forget that node.
+
+    :param base_uri:  The lock server's URL. Defaults to config.lock_server.
+    :param ttl:       How long to remember node records, in seconds
+    :param pool_size: How many connections to the lock server to keep open
+    """
+    # Fetching more records than this one by one takes longer than listing
+    # every node at once
+    bulk_threshold = 4
+    # Whether the lock server has a nodes/update_many/ endpoint; cleared the
+    # first time it turns out not to
+    bulk_update = True
+
+    def __init__(self, base_uri=None, ttl=30, pool_size=16):
+        self._base_uri = base_uri
+        self.ttl = ttl
+        self.pool_size = pool_size
+        self._session = None
+        # Maps node names to (time fetched, record) tuples
+        self._nodes = dict()
+
+    @property
+    def base_uri(self):
+        return self._base_uri or config.lock_server
+
+    @property
+    def session(self):
+        if self._session is None:
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(
+                pool_connections=1,
+                pool_maxsize=self.pool_size,
+            )
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            self._session = session
+        return self._session
+
+    def uri(self, *parts):
+        """
+        :returns: The URI of the lock server's nodes/<parts>/ endpoint
+        """
+        return os.path.join(self.base_uri, 'nodes', *(parts + ('',)))
+
+    def remember(self, nodes):
+        """
+        Remember node records that were just read from the lock server
+
+        :param nodes: A list of node dicts
+        """
+        now = time.time()
+        for node in nodes:
+            self._nodes[node['name']] = (now, node)
+
+    def forget(self, names=None):
+        """
+        Forget what was read about some nodes, e.g. because they were just
+        changed
+
+        :param names: The nodes' canonical names. Defaults to all nodes.
+        """
+        if names is None:
+            self._nodes.clear()
+            return
+        for name in names:
+            self._nodes.pop(name, None)
+
+    def cached(self, name, any_age=False):
+        """
+        :param name:    The node's canonical name
+        :param any_age: Whether to return a record older than self.ttl
+        :returns:       The remembered record for a node, or None
+        """
+        entry = self._nodes.get(name)
+        if entry is None:
+            return None
+        fetched, node = entry
+        if not any_age and time.time() - fetched >= self.ttl:
+            return None
+        return node
+
+    def get_node(self, name, any_age=False):
+        """
+        :param name:    The node's canonical name
+        :param any_age: Whether a remembered record older than self.ttl will
+                        do, e.g. for things that never change like is_vm
+        :returns:       The node's record, or None if the lock server
+                        doesn't have one
+        """
+        node = self.cached(name, any_age=any_age)
+        if node is not None:
+            return node
+        response = self.session.get(self.uri(name))
+        if not response.ok:
+            return None
+        node = response.json()
+        self.remember([node])
+        return node
+
+    def get_nodes(self, names):
+        """
+        Get several nodes' records, with one request for all of them if
+        more than a few aren't remembered
+
+        :param names: The nodes' canonical names
+        :returns:     A dict mapping names to records, for every node the
+                      lock server has a record of
+        """
+        result = dict()
+        missing = list()
+        for name in names:
+            node = self.cached(name)
+            if node is None:
+                missing.append(name)
+            else:
+                result[name] = node
+        if len(missing) > self.bulk_threshold:
+            nodes = self.list_nodes()
+            if nodes is not None:
+                by_name = dict((node['name'], node) for node in nodes)
+                for name in missing:
+                    if name in by_name:
+                        result[name] = by_name[name]
+                return result
+        for name in missing:
+            node = self.get_node(name)
+            if node is not None:
+                result[name] = node
+        return result
+
+    def list_nodes(self, **filters):
+        """
+        List the nodes matching some filters, e.g. machine_type='smithi'
+
+        :returns: A list of node dicts, or None if the lock server couldn't
+                  be asked
+        """
+        uri = self.uri()
+        if filters:
+            uri += '?' + urlencode(filters)
+        try:
+            response = self.session.get(uri)
+        except requests.ConnectionError:
+            log.exception("Could not contact lock server: %s", self.base_uri)
+            return None
+        if not response.ok:
+            return None
+        nodes = response.json()
+        self.remember(nodes)
+        return nodes
+
+
+client = LockServerClient()
@@ -14,24 +14,62 @@ from teuthology.task import console_log
 from teuthology.misc import canonicalize_hostname
 
 from teuthology.lock import util, query
+from teuthology.lock.client import client
+from teuthology.lock.wait import notify_unlocked
 
 log = logging.getLogger(__name__)
 
 
+def _concurrency():
+    """
+    :returns: How many nodes to work on at once
+    """
+    return config.max_concurrent_node_ops or client.pool_size
+
+
+def map_nodes(func, names):
+    """
+    Call func(name) for each of several nodes, concurrently
+
+    An exception raised for one node is logged, and doesn't stop the others.
+
+    :param func:  A function taking a node's name
+    :param names: The nodes' names
+    :returns:     A dict mapping each name to what func returned for it, or
+                  None if it raised an exception
+    """
+    def run(name):
+        try:
+            return name, func(name)
+        except Exception:
+            log.exception("Error while working on %s", name)
+            return name, None
+
+    with teuthology.parallel.parallel(concurrency=_concurrency()) as p:
+        for name in names:
+            p.spawn(run, name)
+        return dict(p)
+
+
 def update_nodes(nodes, reset_os=False):
-    for node in nodes:
-        remote = teuthology.orchestra.remote.Remote(
-            canonicalize_hostname(node))
-        if reset_os:
-            log.info("Updating [%s]: reset os type and version on server", node)
-            inventory_info = dict()
-            inventory_info['os_type'] = ''
-            inventory_info['os_version'] = ''
-            inventory_info['name'] = remote.hostname
-        else:
-            log.info("Updating [%s]: set os type and version on server", node)
-            inventory_info = remote.inventory_info
-        update_inventory(inventory_info)
+    with teuthology.parallel.parallel(concurrency=_concurrency()) as p:
+        for node in nodes:
+            p.spawn(_update_node, node, reset_os)
+
+
+def _update_node(node, reset_os=False):
+    remote = teuthology.orchestra.remote.Remote(
+        canonicalize_hostname(node))
+    if reset_os:
+        log.info("Updating [%s]: reset os type and version on server", node)
+        inventory_info = dict()
+        inventory_info['os_type'] = ''
+        inventory_info['os_version'] = ''
+        inventory_info['name'] = remote.hostname
+    else:
+        log.info("Updating [%s]: set os type and version on server", node)
+        inventory_info = remote.inventory_info
+    update_inventory(inventory_info)
 
 
 def lock_many_openstack(ctx, num, machine_type, user=None, description=None,
@@ -105,12 +143,14 @@ def lock_many(ctx, num, machine_type, user=None, description=None,
         if arch:
             data['arch'] = arch
         log.debug("lock_many request: %s", repr(data))
-        response = requests.post(
+        response = client.session.post(
             uri,
             data=json.dumps(data),
             headers={'content-type': 'application/json'},
         )
         if response.ok:
+            # the lock server answers with the records of the nodes it locked
+            client.remember(response.json())
             machines = {misc.canonicalize_hostname(machine['name']):
                         machine['ssh_pub_key'] for machine in response.json()}
             log.debug('locked {machines}'.format(
@@ -138,7 +178,8 @@ def lock_many(ctx, num, machine_type, user=None, description=None,
                 with console_log.task(
                         ctx, console_log_conf):
                     update_nodes(reimaged, True)
-                    with teuthology.parallel.parallel() as p:
+                    with teuthology.parallel.parallel(
+                            concurrency=config.max_concurrent_node_ops) as p:
                         for machine in machines:
                             p.spawn(teuthology.provision.reimage, ctx,
                                     machine, machine_type)
@@ -164,7 +205,8 @@ def lock_one(name, user=None, description=None):
     request = dict(name=name, locked=True, locked_by=user,
                    description=description)
     uri = os.path.join(config.lock_server, 'nodes', name, 'lock', '')
-    response = requests.put(uri, json.dumps(request))
+    response = client.session.put(uri, json.dumps(request))
+    client.forget([name])
     success = response.ok
     if success:
         log.debug('locked %s as %s', name, user)
@@ -178,21 +220,36 @@ def lock_one(name, user=None, description=None):
     return response
 
 
+def _machine_types(names):
+    """
+    :returns: The types of some nodes, as far as the lock client remembers
+              them, with None for those it doesn't
+    """
+    types = []
+    for name in names:
+        node = client.cached(name, any_age=True)
+        types.append(node.get('machine_type') if node else None)
+    return types
+
+
 def unlock_many(names, user):
     fixed_names = [misc.canonicalize_hostname(name, user=None) for name in
                    names]
     names = fixed_names
+    machine_types = _machine_types(names)
     uri = os.path.join(config.lock_server, 'nodes', 'unlock_many', '')
     data = dict(
         locked_by=user,
         names=names,
     )
-    response = requests.post(
+    response = client.session.post(
         uri,
         data=json.dumps(data),
         headers={'content-type': 'application/json'},
     )
+    client.forget(names)
     if response.ok:
+        notify_unlocked(machine_types)
         log.debug("Unlocked: %s", ', '.join(names))
     else:
         log.error("Failed to unlock: %s", ', '.join(names))
@@ -204,6 +261,7 @@ def unlock_one(ctx, name, user, description=None):
     if not teuthology.provision.destroy_if_vm(ctx, name, user, description):
         log.error('destroy failed for %s', name)
         return False
+    machine_types = _machine_types([name])
     request = dict(name=name, locked=False, locked_by=user,
                    description=description)
     uri = os.path.join(config.lock_server, 'nodes', name, 'lock', '')
@@ -211,13 +269,15 @@ def unlock_one(ctx, name, user, description=None):
             sleep=1, increment=0.5, action="unlock %s" % name) as proceed:
         while proceed():
             try:
-                response = requests.put(uri, json.dumps(request))
+                response = client.session.put(uri, json.dumps(request))
                 break
             # Work around https://github.com/kennethreitz/requests/issues/2364
             except requests.ConnectionError as e:
                 log.warn("Saw %s while unlocking; retrying...", str(e))
+    client.forget([name])
     success = response.ok
     if success:
+        notify_unlocked(machine_types)
         log.info('unlocked %s', name)
     else:
         try:
@@ -229,8 +289,7 @@ def unlock_one(ctx, name, user, description=None):
     return success
 
 
-def update_lock(name, description=None, status=None, ssh_pub_key=None):
-    name = misc.canonicalize_hostname(name, user=None)
+def _lock_updates(description=None, status=None, ssh_pub_key=None):
     updated = {}
     if description is not None:
         updated['description'] = description
@@ -238,16 +297,66 @@ def update_lock(name, description=None, status=None, ssh_pub_key=None):
         updated['up'] = (status == 'up')
     if ssh_pub_key is not None:
         updated['ssh_pub_key'] = ssh_pub_key
+    return updated
+
+
+def update_lock(name, description=None, status=None, ssh_pub_key=None):
+    name = misc.canonicalize_hostname(name, user=None)
+    updated = _lock_updates(description, status, ssh_pub_key)
 
     if updated:
         uri = os.path.join(config.lock_server, 'nodes', name, '')
-        response = requests.put(
+        response = client.session.put(
             uri,
             json.dumps(updated))
+        client.forget([name])
         return response.ok
     return True
 
 
+def update_many(names, description=None, status=None):
+    """
+    Update the description and/or status of several nodes
+
+    This is one request if the lock server has an update_many endpoint.
+    Otherwise, the nodes are updated with update_lock(), concurrently.
+
+    :param names:       The nodes' names
+    :param description: The new description
+    :param status:      The new status; 'up' or 'down'
+    :returns:           A dict mapping each node's canonical name to whether
+                        it was updated
+    """
+    names = [misc.canonicalize_hostname(name, user=None) for name in names]
+    updated = _lock_updates(description, status)
+    if not updated:
+        return dict((name, True) for name in names)
+    if client.bulk_update:
+        uri = os.path.join(config.lock_server, 'nodes', 'update_many', '')
+        data = dict(updated, names=names)
+        response = client.session.post(
+            uri,
+            data=json.dumps(data),
+            headers={'content-type': 'application/json'},
+        )
+        client.forget(names)
+        if response.ok:
+            log.debug("Updated: %s", ', '.join(names))
+            return dict((name, True) for name in names)
+        if response.status_code in (404, 405, 501):
+            log.debug("The lock server can't update nodes in bulk")
+            client.bulk_update = False
+        else:
+            log.error("Failed to update %s: %s", ', '.join(names),
+                      response.text)
+            return dict((name, False) for name in names)
+    results = map_nodes(
+        lambda name: update_lock(name, description, status),
+        names,
+    )
+    return dict((name, bool(result)) for name, result in results.items())
+
+
 def update_inventory(node_dict):
     """
     Like update_lock(), but takes a dict and doesn't try to do anything smart
@@ -260,7 +369,8 @@ def update_inventory(node_dict):
         return
     uri = os.path.join(config.lock_server, 'nodes', name, '')
     log.info("Updating %s on lock server", name)
-    response = requests.put(
+    client.forget([name])
+    response = client.session.put(
         uri,
         json.dumps(node_dict),
         headers={'content-type': 'application/json'},
@@ -268,7 +378,7 @@ def update_inventory(node_dict):
     if response.status_code == 404:
         log.info("Creating new node %s on lock server", name)
         uri = os.path.join(config.lock_server, 'nodes', '')
-        response = requests.post(
+        response = client.session.post(
             uri,
             json.dumps(node_dict),
             headers={'content-type': 'application/json'},
@@ -1,39 +1,51 @@
 import logging
-import os
 
 import requests
 
 from teuthology import misc
-from teuthology.config import config
-from teuthology.util.compat import urlencode
+from teuthology.lock.client import client
+from teuthology.parallel import parallel
+from teuthology.report import ResultsReporter
 
 
 log = logging.getLogger(__name__)
 
+# How many requests find_stale_locks() makes to the results server at once
+STALE_LOCK_CONCURRENCY = 8
+
 
 def get_status(name):
     name = misc.canonicalize_hostname(name, user=None)
-    uri = os.path.join(config.lock_server, 'nodes', name, '')
-    response = requests.get(uri)
-    success = response.ok
-    if success:
-        return response.json()
+    status = client.get_node(name)
+    if status is not None:
+        return status
     log.warning(
         "Failed to query lock server for status of {name}".format(name=name))
     return None
 
 
-def get_statuses(machines):
+def get_statuses(machines, fresh=False):
+    """
+    :param machines: The machines to get the lock statuses of; defaults to
+                     all of them
+    :param fresh:    Whether to ask the lock server even about machines whose
+                     records were read recently, e.g. to check who owns them
+    """
     if machines:
+        names = [misc.canonicalize_hostname(machine, user=None)
+                 for machine in machines]
+        if fresh:
+            client.forget(names)
+        # one request for all of them, rather than one per machine
+        found = client.get_nodes(names)
         statuses = []
-        for machine in machines:
-            machine = misc.canonicalize_hostname(machine)
-            status = get_status(machine)
+        for name in names:
+            status = found.get(name)
             if status:
                 statuses.append(status)
             else:
                 log.error("Lockserver doesn't know about machine: %s" %
-                          machine)
+                          name)
     else:
         statuses = list_locks()
     return statuses
@@ -43,35 +55,30 @@ def is_vm(name=None, status=None):
     if status is None:
         if name is None:
             raise ValueError("Must provide either name or status, or both")
-        name = misc.canonicalize_hostname(name)
-        status = get_status(name)
+        name = misc.canonicalize_hostname(name, user=None)
+        # whether a node is a VM never changes, so any record of it will do
+        status = client.get_node(name, any_age=True)
+        if status is None:
+            log.warning("Failed to query lock server for status of "
+                        "{name}".format(name=name))
     return status.get('is_vm', False)
 
 
 def list_locks(keyed_by_name=False, **kwargs):
-    uri = os.path.join(config.lock_server, 'nodes', '')
     for key, value in kwargs.items():
         if kwargs[key] is False:
             kwargs[key] = '0'
         if kwargs[key] is True:
             kwargs[key] = '1'
-    if kwargs:
-        if 'machine_type' in kwargs:
-            kwargs['machine_type'] = kwargs['machine_type'].replace(',','|')
-        uri += '?' + urlencode(kwargs)
-    try:
-        response = requests.get(uri)
-    except requests.ConnectionError:
-        success = False
-        log.exception("Could not contact lock server: %s", config.lock_server)
-    else:
-        success = response.ok
-    if success:
+    if 'machine_type' in kwargs:
+        kwargs['machine_type'] = kwargs['machine_type'].replace(',','|')
+    nodes = client.list_nodes(**kwargs)
+    if nodes is not None:
         if not keyed_by_name:
-            return response.json()
+            return nodes
         else:
             return {node['name']: node
-                    for node in response.json()}
+                    for node in nodes}
     return dict()
 
 
@@ -106,38 +113,69 @@ def find_stale_locks(owner=None):
     nodes = list_locks(locked=True)
     if owner is not None:
         nodes = [node for node in nodes if node['locked_by'] == owner]
-    nodes = filter(might_be_stale, nodes)
+    nodes = list(filter(might_be_stale, nodes))
 
-    def node_job_is_active(node, cache):
-        """
-        Is this node's job active (e.g. running or waiting)?
+    # Group the nodes' jobs by run, so each run's jobs can be looked up at
+    # once
+    runs = dict()
+    for node in nodes:
+        (name, job_id) = node['description'].split('/')[-2:]
+        runs.setdefault(name, set()).add(job_id)
 
-        :param node:  The node dict as returned from the lock server
-        :param cache: A set() used for caching results
-        :returns:     True or False
+    reporter = ResultsReporter(concurrency=STALE_LOCK_CONCURRENCY)
+
+    def get_run_statuses(run_name):
         """
-        description = node['description']
-        if description in cache:
-            return True
-        (name, job_id) = description.split('/')[-2:]
-        url = os.path.join(config.results_server, 'runs', name, 'jobs', job_id,
-                           '')
-        resp = requests.get(url)
-        if not resp.ok:
-            return False
-        job_info = resp.json()
-        if job_info['status'] in ('running', 'waiting'):
-            cache.add(description)
-            return True
-        return False
+        :returns: A dict mapping each of a run's job IDs to its status, or
+                  None if the results server couldn't list them
+        """
+        try:
+            jobs = reporter.get_jobs(run_name, fields=['job_id', 'status'])
+        except requests.HTTPError as e:
+            if e.response is not None and e.response.status_code == 404:
+                # The run doesn't exist, so none of its jobs are active
+                return dict()
+            log.warning("Could not list the jobs of %s: %s", run_name, e)
+            return None
+        return dict((str(job['job_id']), job['status']) for job in jobs)
+
+    def get_job_status(run_job):
+        (run_name, job_id) = run_job
+        try:
+            job = reporter.get_jobs(run_name, job_id, fields=['status'])
+        except requests.HTTPError:
+            return None
+        return job['status']
+
+    statuses = dict()
+    with parallel(concurrency=STALE_LOCK_CONCURRENCY) as p:
+        for run_name in runs:
+            p.spawn(lambda run_name: (run_name, get_run_statuses(run_name)),
+                    run_name)
+        run_statuses = dict(p)
+    # Look up the jobs of runs that couldn't be listed one at a time, as
+    # before
+    unlisted = list()
+    for run_name, job_ids in runs.items():
+        if run_statuses[run_name] is None:
+            unlisted.extend((run_name, job_id) for job_id in job_ids)
+            continue
+        for job_id in job_ids:
+            statuses[(run_name, job_id)] = run_statuses[run_name].get(job_id)
+    if unlisted:
+        with parallel(concurrency=STALE_LOCK_CONCURRENCY) as p:
+            for run_job in unlisted:
+                p.spawn(lambda run_job: (run_job, get_job_status(run_job)),
+                        run_job)
+            statuses.update(p)
 
     result = list()
     # Here we build the list of of nodes that are locked, for a job (as opposed
     # to being locked manually for random monkeying), where the job is not
     # running
-    active_jobs = set()
     for node in nodes:
-        if node_job_is_active(node, active_jobs):
+        run_job = tuple(node['description'].split('/')[-2:])
+        if statuses.get(run_job) in ('running', 'waiting'):
             continue
         result.append(node)
     return result
@@ -0,0 +1,155 @@
+import json
+import pytest
+
+from mock import patch, Mock
+
+from teuthology.config import FakeNamespace
+from teuthology.lock import client as lock_client
+from teuthology.lock import ops, query
+from teuthology.task.internal import check_lock
+
+
+def make_node(name, **kwargs):
+    node = dict(name=name, is_vm=False, locked=True, locked_by='user@host',
+                up=True, ssh_pub_key='key-' + name)
+    node.update(kwargs)
+    return node
+
+
+class FakeSession(object):
+    """
+    Answers the requests LockServerClient makes, from a dict of node records
+    """
+    def __init__(self, nodes):
+        self.nodes = dict((node['name'], node) for node in nodes)
+        self.requests = []
+
+    def response(self, data, ok=True):
+        return Mock(ok=ok, status_code=200 if ok else 404,
+                    json=Mock(return_value=data))
+
+    def get(self, uri):
+        self.requests.append(('GET', uri))
+        path = uri.split('/nodes/', 1)[1].split('?')[0].strip('/')
+        if not path:
+            return self.response(list(self.nodes.values()))
+        if path in self.nodes:
+            return self.response(self.nodes[path])
+        return self.response(None, ok=False)
+
+    def put(self, uri, data, **kwargs):
+        self.requests.append(('PUT', uri))
+        name = uri.split('/nodes/', 1)[1].split('/')[0]
+        self.nodes[name].update(json.loads(data))
+        return self.response(self.nodes[name])
+
+
+class TestLockServerClient(object):
+    names = ['smithi%03d.front.sepia.ceph.com' % i for i in range(10)]
+
+    def setup(self):
+        self.session = FakeSession(
+            [make_node(name) for name in self.names] +
+            [make_node('vpm001.front.sepia.ceph.com', is_vm=True)]
+        )
+        self.client = lock_client.LockServerClient(
+            base_uri='http://lock.example.com/')
+        self.client._session = self.session
+        self.patcher = patch.object(lock_client, 'client', self.client)
+        self.patcher.start()
+        # query and ops import the module-level client by name
+        self.query_patcher = patch.object(query, 'client', self.client)
+        self.query_patcher.start()
+        self.ops_patcher = patch.object(ops, 'client', self.client)
+        self.ops_patcher.start()
+
+    def teardown(self):
+        self.ops_patcher.stop()
+        self.query_patcher.stop()
+        self.patcher.stop()
+
+    def test_uri(self):
+        assert self.client.uri() == 'http://lock.example.com/nodes/'
+        assert self.client.uri('foo', 'lock') == \
+            'http://lock.example.com/nodes/foo/lock/'
+
+    def test_get_status_cached(self):
+        for _ in range(3):
+            status = query.get_status(self.names[0])
+            assert status['name'] == self.names[0]
+        assert len(self.session.requests) == 1
+
+    def test_get_status_expired(self):
+        self.client.ttl = 0
+        query.get_status(self.names[0])
+        query.get_status(self.names[0])
+        assert len(self.session.requests) == 2
+
+    def test_get_status_missing(self):
+        assert query.get_status('nonexistent.example.com') is None
+
+    def test_is_vm_any_age(self):
+        assert query.is_vm('vpm001.front.sepia.ceph.com') is True
+        self.client.ttl = 0
+        assert query.is_vm('vpm001.front.sepia.ceph.com') is True
+        assert query.is_vm(self.names[0]) is False
+        assert len(self.session.requests) == 2
+
+    def test_get_statuses_bulk(self):
+        statuses = query.get_statuses(
+            ['ubuntu@' + name for name in self.names] +
+            ['nonexistent.example.com'])
+        assert [status['name'] for status in statuses] == self.names
+        assert self.session.requests == \
+            [('GET', 'http://lock.example.com/nodes/')]
+        # now they are all remembered
+        query.get_statuses(self.names)
+        assert len(self.session.requests) == 1
+
+    def test_get_statuses_few(self):
+        names = self.names[:self.client.bulk_threshold]
+        statuses = query.get_statuses(names)
+        assert [status['name'] for status in statuses] == names
+        assert len(self.session.requests) == len(names)
+
+    def test_get_statuses_fresh(self):
+        query.get_statuses(self.names[:2])
+        query.get_statuses(self.names[:2], fresh=True)
+        assert len(self.session.requests) == 4
+
+    def test_check_lock_asks_server(self):
+        ctx = FakeNamespace(dict(
+            config=dict(targets={'ubuntu@' + self.names[0]: 'key'}),
+            owner='user@host',
+        ))
+        with patch.object(check_lock.teuth_config, 'lock_server',
+                          'http://lock.example.com/'):
+            check_lock.check_lock(ctx, None)
+            # someone else locks it in the meantime
+            self.session.nodes[self.names[0]]['locked_by'] = 'other@host'
+            with pytest.raises(AssertionError) as excinfo:
+                check_lock.check_lock(ctx, None)
+        assert 'other@host' in str(excinfo.value)
+
+    def test_list_locks_remembers(self):
+        nodes = query.list_locks(machine_type='smithi', locked=True)
+        assert len(nodes) == 11
+        assert self.session.requests[0][1].endswith('?machine_type=smithi&'
+                                                     'locked=1')
+        query.get_status(self.names[3])
+        assert len(self.session.requests) == 1
+
+    def test_list_locks_connection_error(self):
+        self.session.get = Mock(
+            side_effect=lock_client.requests.ConnectionError)
+        assert query.list_locks() == dict()
+
+    def test_update_forgets(self):
+        name = self.names[0]
+        assert query.get_status(name)['ssh_pub_key'] == 'key-' + name
+        with patch.object(ops.config, 'lock_server',
+                          'http://lock.example.com/'):
+            assert ops.update_lock(name, ssh_pub_key='new-key')
+        assert query.get_status(name)['ssh_pub_key'] == 'new-key'
+        assert [method for method, uri in self.session.requests] == \
+            ['GET', 'PUT', 'GET']
@@ -0,0 +1,200 @@
+from mock import patch, Mock
+
+from teuthology.config import FakeNamespace
+from teuthology.lock import cli, ops
+from teuthology.lock.client import LockServerClient
+
+
+def response(status_code=200):
+    return Mock(ok=status_code < 400, status_code=status_code, text='')
+
+
+class TestOps(object):
+    names = ['smithi%03d.front.sepia.ceph.com' % i for i in range(5)]
+
+    def setup(self):
+        self.client = LockServerClient(base_uri='http://lock.example.com/')
+        self.client._session = Mock()
+        self.patchers = [
+            patch.object(ops, 'client', self.client),
+            patch.multiple(ops.config, lock_server='http://lock.example.com/',
+                           max_concurrent_node_ops=2),
+        ]
+        for patcher in self.patchers:
+            patcher.start()
+
+    def teardown(self):
+        for patcher in self.patchers:
+            patcher.stop()
+
+    def test_map_nodes(self):
+        def func(name):
+            if name == self.names[1]:
+                raise RuntimeError("boom")
+            return name.upper()
+        results = ops.map_nodes(func, self.names)
+        assert results[self.names[1]] is None
+        assert results[self.names[0]] == self.names[0].upper()
+        assert len(results) == 5
+
+    def test_update_many_bulk(self):
+        self.client.session.post.return_value = response()
+        results = ops.update_many(self.names, description='desc',
+                                  status='down')
+        assert results == dict((name, True) for name in self.names)
+        assert self.client.session.post.call_count == 1
+        assert not self.client.session.put.called
+
+    def test_update_many_fallback(self):
+        self.client.session.post.return_value = response(404)
+        self.client.session.put.return_value = response()
+        results = ops.update_many(self.names, description='desc')
+        assert all(results.values())
+        assert self.client.session.put.call_count == 5
+        assert self.client.bulk_update is False
+        # the bulk endpoint isn't tried again
+        ops.update_many(self.names, description='desc')
+        assert self.client.session.post.call_count == 1
+        assert self.client.session.put.call_count == 10
+
+    def test_update_many_partial_failure(self):
+        self.client.bulk_update = False
+        self.client.session.put.side_effect = lambda uri, data: response(
+            500 if self.names[2] in uri else 200)
+        results = ops.update_many(self.names, status='up')
+        assert [name for name, ok in results.items() if not ok] == \
+            [self.names[2]]
+
+    def test_update_many_nothing(self):
+        assert all(ops.update_many(self.names).values())
+        assert not self.client.session.method_calls
+
+
+class TestCLIUnlock(object):
+    vms = ['vpm%03d.front.sepia.ceph.com' % i for i in range(3)]
+    others = ['smithi%03d.front.sepia.ceph.com' % i for i in range(3)]
+
+    def ctx(self, **kwargs):
+        ctx = FakeNamespace(dict(
+            verbose=False, owner='user@host', machines=self.vms + self.others,
+            targets=None, f=False, lock=False, unlock=True, list=False,
+            list_targets=False, update=False, brief=False, all=False,
+            num_to_lock=None, summary=False, desc=None, status=None,
+        ))
+        for key, value in kwargs.items():
+            setattr(ctx, key, value)
+        return ctx
+
+    def statuses(self, names):
+        return [dict(name=name, is_vm=name in self.vms) for name in names]
+
+    @patch.object(cli, 'set_config_attr')
+    @patch.object(cli.ops, 'unlock_one')
+    @patch.object(cli.ops, 'unlock_many')
+    @patch.object(cli.query, 'get_statuses')
+    def test_mixed(self, m_get_statuses, m_unlock_many, m_unlock_one,
+                   m_set_config_attr):
+        m_get_statuses.side_effect = self.statuses
+        m_unlock_many.return_value = True
+        m_unlock_one.side_effect = lambda ctx, name, user: \
+            name != self.vms[1]
+        assert cli.main(self.ctx(f=True)) == 1
+        m_unlock_many.assert_called_once_with(self.others, 'user@host')
+        assert sorted(c[0][1] for c in m_unlock_one.call_args_list) == \
+            self.vms
+        assert m_get_statuses.call_count == 1
+
+    @patch.object(cli, 'set_config_attr')
+    @patch.object(cli.ops, 'unlock_one')
+    @patch.object(cli.ops, 'unlock_many')
+    @patch.object(cli.query, 'get_statuses')
+    def test_no_vms(self, m_get_statuses, m_unlock_many, m_unlock_one,
+                    m_set_config_attr):
+        m_get_statuses.side_effect = self.statuses
+        m_unlock_many.return_value = True
+        assert cli.main(self.ctx(machines=self.others)) == 0
+        m_unlock_many.assert_called_once_with(self.others, 'user@host')
+        assert not m_unlock_one.called
+
+    @patch.object(cli, 'set_config_attr')
+    @patch.object(cli.ops, 'update_many')
+    def test_update(self, m_update_many, m_set_config_attr):
+        m_update_many.return_value = dict.fromkeys(self.others, True)
+        ctx = self.ctx(unlock=False, update=True, owner=None,
+                       machines=self.others, desc='desc')
+        assert cli.main(ctx) == 0
+        m_update_many.assert_called_once_with(self.others, 'desc', None)
+
+
+class TestCLILock(object):
+    machines = ['smithi%03d.front.sepia.ceph.com' % i for i in range(4)]
+
+    def setup(self):
+        self.patchers = dict(
+            set_config_attr=patch.object(cli, 'set_config_attr'),
+            lock_one=patch.object(cli.ops, 'lock_one',
+                                  side_effect=self.lock_one),
+            unlock_many=patch.object(cli.ops, 'unlock_many'),
+            update_nodes=patch.object(cli.ops, 'update_nodes'),
+            get_reimage_types=patch.object(
+                cli.teuthology.provision, 'get_reimage_types',
+                return_value=[]),
+        )
+        self.mocks = dict((name, patcher.start())
+                          for (name, patcher) in self.patchers.items())
+
+    def teardown(self):
+        for patcher in self.patchers.values():
+            patcher.stop()
+
+    def lock_one(self, name, user, description):
+        if name == self.machines[2]:
+            return response(409)
+        resp = response()
+        resp.json.return_value = dict(name=name, machine_type='smithi',
+                                      is_vm=False)
+        return resp
+
+    def ctx(self, **kwargs):
+        return TestCLIUnlock().ctx(lock=True, unlock=False,
+                                   machines=self.machines, machine_type=None,
+                                   os_type=None, os_version=None, **kwargs)
+
+    def test_failure_unlocks(self):
+        assert cli.main(self.ctx()) == 1
+        locked = [self.machines[0], self.machines[1], self.machines[3]]
+        self.mocks['unlock_many'].assert_called_once_with(locked,
+                                                          'user@host')
+        assert not self.mocks['update_nodes'].called
+
+    def test_failure_forced(self):
+        assert cli.main(self.ctx(f=True)) == 1
+        assert not self.mocks['unlock_many'].called
+        assert self.mocks['lock_one'].call_count == 4
+
+    @patch.object(cli.query, 'is_vm', return_value=True)
+    @patch.object(cli.teuthology.provision, 'create_if_vm')
+    def test_vm_not_created(self, m_create_if_vm, m_is_vm):
+        def create_if_vm(ctx, name):
+            if name.endswith(self.machines[0]):
+                return False
+            if name.endswith(self.machines[1]):
+                raise RuntimeError("boom")
+            return True
+        m_create_if_vm.side_effect = create_if_vm
+        self.mocks['lock_one'].side_effect = \
+            lambda name, user, description: self.lock_one(self.machines[0],
+                                                          user, description)
+        assert cli.main(self.ctx()) == 1
+        assert m_create_if_vm.call_count == 4
+        assert not self.mocks['unlock_many'].called
+
+    @patch.object(cli.query, 'is_vm', return_value=True)
+    @patch.object(cli.teuthology.provision, 'create_if_vm',
+                  return_value=True)
+    def test_vms_created(self, m_create_if_vm, m_is_vm):
+        self.mocks['lock_one'].side_effect = \
+            lambda name, user, description: self.lock_one(self.machines[0],
+                                                          user, description)
+        assert cli.main(self.ctx()) == 0
+        assert m_create_if_vm.call_count == 4
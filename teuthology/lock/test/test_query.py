@@ -0,0 +1,73 @@
+import requests
+
+from mock import patch, Mock
+
+from teuthology.lock import query
+
+
+def http_error(status_code):
+    return requests.HTTPError(response=Mock(status_code=status_code))
+
+
+class TestFindStaleLocks(object):
+    def setup(self):
+        self.nodes = [
+            self.node(1, '/archive/run1/1'),
+            self.node(2, '/archive/run1/2'),
+            self.node(3, '/archive/run1/3'),
+            self.node(4, '/archive/run2/4'),
+            self.node(5, '/archive/run3/5'),
+            self.node(6, '/archive/run4/6'),
+            self.node(7, 'manually locked'),
+            self.node(8, '/archive/run1/1', locked_by='other@host'),
+        ]
+        self.runs = dict(
+            run1=[dict(job_id=1, status='running'),
+                  dict(job_id=2, status='dead'),
+                  dict(job_id=3, status='waiting')],
+            run2=[dict(job_id=4, status='pass')],
+            # run3 doesn't exist; run4 can't be listed
+        )
+        self.calls = []
+        self.patchers = [
+            patch.object(query, 'list_locks', return_value=self.nodes),
+            patch.object(query.ResultsReporter, 'get_jobs',
+                         autospec=True, side_effect=self.get_jobs),
+        ]
+        for patcher in self.patchers:
+            patcher.start()
+
+    def teardown(self):
+        for patcher in self.patchers:
+            patcher.stop()
+
+    def node(self, number, description, locked_by='user@host'):
+        return dict(name='smithi%03d' % number, locked=True,
+                    locked_by=locked_by, description=description)
+
+    def get_jobs(self, reporter, run_name, job_id=None, fields=None):
+        self.calls.append((run_name, job_id))
+        if run_name == 'run4':
+            if job_id is None:
+                raise http_error(500)
+            return dict(job_id=job_id, status='running')
+        if run_name not in self.runs:
+            raise http_error(404)
+        return self.runs[run_name]
+
+    def test_find_stale_locks(self):
+        stale = query.find_stale_locks(owner='user@host')
+        assert [node['name'] for node in stale] == \
+            ['smithi002', 'smithi004', 'smithi005']
+        # one request per run, and one per job of the run that couldn't be
+        # listed
+        assert len(self.calls) == 5
+        assert set(self.calls) == set([
+            ('run1', None), ('run2', None), ('run3', None), ('run4', None),
+            ('run4', '6'),
+        ])
+
+    def test_find_stale_locks_all_owners(self):
+        stale = query.find_stale_locks()
+        assert 'smithi008' not in [node['name'] for node in stale]
+        assert len([call for call in self.calls if call[0] == 'run1']) == 1
@@ -0,0 +1,71 @@
+import os
+
+from mock import patch
+
+from teuthology.config import config
+from teuthology.lock import wait
+
+
+class TestMachineWaiter(object):
+    def setup(self):
+        config.load()
+
+    def teardown(self):
+        config.load()
+
+    def test_backoff(self):
+        waiter = wait.MachineWaiter('smithi', initial=2, maximum=10,
+                                    jitter=0)
+        delays = []
+        for _ in range(5):
+            delays.append(waiter.delay())
+            waiter.failures += 1
+        assert delays == [2, 4, 8, 10, 10]
+        waiter.reset()
+        assert waiter.delay() == 2
+
+    def test_jitter(self):
+        waiter = wait.MachineWaiter('smithi', initial=8, jitter=0.5)
+        delays = [waiter.delay() for _ in range(50)]
+        assert all(4 <= delay <= 8 for delay in delays)
+        assert len(set(delays)) > 1
+
+    def test_wait_timeout(self, tmpdir):
+        config.lock_notify_dir = str(tmpdir)
+        waiter = wait.MachineWaiter('smithi', initial=0.05, jitter=0,
+                                    poll_interval=0.01)
+        assert waiter.wait() is False
+        assert waiter.failures == 1
+
+    def test_wait_notified(self, tmpdir):
+        config.lock_notify_dir = str(tmpdir.join('notify'))
+        waiter = wait.MachineWaiter('mira,smithi', initial=60,
+                                    poll_interval=0.01)
+        # other machine types don't wake us
+        wait.notify_unlocked(['plana'])
+
+        with patch.object(wait.time, 'sleep') as m_sleep:
+            m_sleep.side_effect = lambda s: wait.notify_unlocked(['smithi'])
+            assert waiter.wait() is True
+        # one poll, and then the random delay after being woken
+        assert m_sleep.call_count == 2
+        assert os.path.exists(os.path.join(config.lock_notify_dir, 'smithi'))
+
+    def test_wait_notified_unknown_type(self, tmpdir):
+        config.lock_notify_dir = str(tmpdir)
+        waiter = wait.MachineWaiter('smithi', initial=60, poll_interval=0.01)
+        with patch.object(wait.time, 'sleep',
+                          side_effect=lambda s: wait.notify_unlocked([None])):
+            assert waiter.wait() is True
+
+    def test_notify_disabled(self, tmpdir):
+        config.lock_notify_dir = None
+        wait.notify_unlocked(['smithi'])
+        waiter = wait.MachineWaiter('smithi', initial=0.01, jitter=0)
+        assert waiter.wait() is False
+
+    def test_notify_unwritable(self, tmpdir):
+        path = tmpdir.join('file')
+        path.write('')
+        config.lock_notify_dir = str(path)
+        wait.notify_unlocked(['smithi'])
@@ -0,0 +1,120 @@
+"""
+Wait for machines to become free without polling the lock server on a fixed
+schedule.
+
+Jobs waiting to lock machines back off exponentially, with jitter so that
+they don't all retry at once. They also watch a directory in which anything
+on the same host that unlocks machines touches one file per machine type;
+this wakes them up as soon as machines they could use are freed, rather
+than at their next retry.
+"""
+import errno
+import logging
+import os
+import random
+import time
+
+from teuthology import misc
+from teuthology.config import config
+
+log = logging.getLogger(__name__)
+
+# The file touched when the type of the unlocked machines isn't known
+ANY_TYPE = '_any'
+
+
+def notify_unlocked(machine_types):
+    """
+    Let jobs waiting for machines know that some were unlocked
+
+    :param machine_types: The unlocked machines' types. None stands for an
+                          unknown type, which wakes up every waiting job.
+    """
+    notify_dir = config.lock_notify_dir
+    if not notify_dir:
+        return
+    try:
+        try:
+            os.makedirs(notify_dir)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        for machine_type in set(machine_types):
+            path = os.path.join(notify_dir, machine_type or ANY_TYPE)
+            open(path, 'a').close()
+            os.utime(path, None)
+    except (IOError, OSError):
+        log.debug("Could not notify waiting jobs of unlocked machines",
+                  exc_info=True)
+
+
+class MachineWaiter(object):
+    """
+    Sleeps between attempts to lock machines.
+
+    Each wait is twice as long as the last, up to maximum seconds, and
+    shortened by up to jitter times its length. A wait ends early if
+    notify_unlocked() is called for one of the machine types.
+
+    :param machine_type:  The machine type(s) being waited for, e.g.
+                          'smithi' or 'plana,mira'
+    :param initial:       How long the first wait is, in seconds
+    :param maximum:       The longest a wait may be, in seconds
+    :param jitter:        The largest fraction of a wait to cut off
+    :param poll_interval: How often to check for notifications, in seconds
+    """
+    def __init__(self, machine_type, initial=2, maximum=60, jitter=0.5,
+                 poll_interval=1):
+        self.machine_types = misc.get_multi_machine_types(machine_type)
+        self.initial = initial
+        self.maximum = maximum
+        self.jitter = jitter
+        self.poll_interval = poll_interval
+        self.failures = 0
+        self.seen = self._last_notified()
+
+    def _last_notified(self):
+        notify_dir = config.lock_notify_dir
+        if not notify_dir:
+            return None
+        mtimes = []
+        for name in self.machine_types + [ANY_TYPE]:
+            try:
+                mtimes.append(os.stat(os.path.join(notify_dir, name)).st_mtime)
+            except OSError:
+                pass
+        return max(mtimes) if mtimes else None
+
+    def delay(self):
+        """
+        :returns: How long the next wait will be, at most, in seconds
+        """
+        delay = min(self.initial * 2 ** self.failures, self.maximum)
+        return delay * random.uniform(1 - self.jitter, 1)
+
+    def reset(self):
+        """
+        Go back to short waits, e.g. because some machines were locked
+        """
+        self.failures = 0
+
+    def wait(self):
+        """
+        Sleep until the next attempt should be made
+
+        :returns: True if the wait was ended by machines being unlocked
+        """
+        deadline = time.time() + self.delay()
+        self.failures += 1
+        while True:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return False
+            time.sleep(min(self.poll_interval, remaining))
+            notified = self._last_notified()
+            if notified != self.seen:
+                self.seen = notified
+                log.info("Machines were unlocked; trying again")
+                # all the waiting jobs were woken at the same moment
+                time.sleep(random.uniform(0, self.poll_interval))
+                return True
@@ -3,9 +3,11 @@ from __future__ import print_function
 import os
 import yaml
 import errno
-import re
 
+from teuthology.archive_index import ArchiveIndex
 from teuthology.job_status import get_status
+from teuthology.report import ResultsSerializer
+from teuthology.util.logs import tail_log
 
 
 def main(args):
@@ -13,14 +15,12 @@ def main(args):
 
 
 def ls(archive_dir, verbose):
+    archive_dir = os.path.abspath(archive_dir)
+    index = ArchiveIndex(os.path.dirname(archive_dir))
     for j in get_jobs(archive_dir):
         job_dir = os.path.join(archive_dir, j)
-        summary = {}
         try:
-            with open(os.path.join(job_dir, 'summary.yaml')) as f:
-                g = yaml.safe_load_all(f)
-                for new in g:
-                    summary.update(new)
+            summary = read_summary(index, job_dir)
         except IOError as e:
             if e.errno == errno.ENOENT:
                 print_debug_info(j, job_dir, archive_dir)
@@ -39,16 +39,38 @@ def ls(archive_dir, verbose):
             print('    {reason}'.format(reason=summary['failure_reason']))
 
 
-def get_jobs(archive_dir):
-    dir_contents = os.listdir(archive_dir)
+def read_summary(index, job_dir):
+    """
+    Merge the documents in a job's summary.yaml, or look up what they were
+    merged into last time in index if the file hasn't changed since
+
+    :param index:   An ArchiveIndex for the archive the job is in
+    :param job_dir: The job's directory
+    :returns:       A dict
+    """
+    summary_path = os.path.join(job_dir, 'summary.yaml')
+
+    def read():
+        summary = {}
+        with open(summary_path) as f:
+            g = yaml.safe_load_all(f)
+            for new in g:
+                summary.update(new)
+        return summary
+
+    try:
+        st = os.stat(summary_path)
+    except OSError:
+        # let open() raise the error
+        return read()
+    return index.get('summary:%s' % summary_path, [st.st_mtime, st.st_size],
+                     read, mtime=st.st_mtime)
 
-    def is_job_dir(parent, subdir):
-        if (os.path.isdir(os.path.join(parent, subdir)) and re.match('\d+$',
-                                                                     subdir)):
-            return True
-        return False
 
-    jobs = [job for job in dir_contents if is_job_dir(archive_dir, job)]
+def get_jobs(archive_dir):
+    archive_dir = os.path.abspath(archive_dir)
+    serializer = ResultsSerializer(os.path.dirname(archive_dir))
+    jobs = serializer.jobs_for_run(os.path.basename(archive_dir))
     return sorted(jobs)
 
 
@@ -69,10 +91,8 @@ def print_debug_info(job, job_dir, archive_dir):
         if not found:
             print('(no process or summary.yaml)', end='')
         # tail
-        tail = os.popen(
-            'tail -1 %s/%s/teuthology.log' % (archive_dir, job)
-        ).read().rstrip()
-        print(tail, end='')
+        tail = tail_log(os.path.join(job_dir, 'teuthology.log'), lines=1)
+        print(''.join(tail), end='')
     except IOError:
         pass
     print('')
@@ -6,6 +6,7 @@ import argparse
 import os
 import logging
 import configobj
+import gevent
 import getpass
 import socket
 import subprocess
@@ -29,7 +30,7 @@ from teuthology.config import config
 from teuthology.contextutil import safe_while
 from teuthology.orchestra.opsys import DEFAULT_OS_VERSION
 
-from six import (reraise, ensure_str)
+from six import (reraise, ensure_str, string_types)
 
 log = logging.getLogger(__name__)
 
@@ -755,39 +756,81 @@ def get_file(remote, path, sudo=False, dest_dir='/tmp'):
     return file_data
 
 
-def pull_directory(remote, remotedir, localdir):
+def pull_directory(remote, remotedir, localdir, max_bytes=None,
+                   timeout=None, compress_level=None):
     """
     Copy a remote directory to a local directory.
+
+    If either budget runs out before the whole directory has been copied, the
+    transfer is stopped with a warning and the remaining files are left
+    behind.
+
+    :param max_bytes:      Copy no more than this many bytes of file data
+    :param timeout:        Spend no more than this many seconds copying
+    :param compress_level: Passed on to Remote.get_tar_stream()
+    :returns:              The number of bytes of file data copied
     """
     log.debug('Transferring archived files from %s:%s to %s',
               remote.shortname, remotedir, localdir)
     if not os.path.exists(localdir):
         os.mkdir(localdir)
-    r = remote.get_tar_stream(remotedir, sudo=True)
-    tar = tarfile.open(mode='r|gz', fileobj=r.stdout)
-    while True:
-        ti = tar.next()
-        if ti is None:
-            break
+    r = remote.get_tar_stream(remotedir, sudo=True,
+                              compress_level=compress_level)
+    copied = 0
+    stopped = False
+    deadline = gevent.Timeout(timeout)
+    deadline.start()
+    try:
+        tar = tarfile.open(mode='r|gz', fileobj=r.stdout)
+        while True:
+            ti = tar.next()
+            if ti is None:
+                break
 
-        if ti.isdir():
-            # ignore silently; easier to just create leading dirs below
-            # XXX this mean empty dirs are not transferred
-            pass
-        elif ti.isfile():
-            sub = safepath.munge(ti.name)
-            safepath.makedirs(root=localdir, path=os.path.dirname(sub))
-            tar.makefile(ti, targetpath=os.path.join(localdir, sub))
-        else:
-            if ti.isdev():
-                type_ = 'device'
-            elif ti.issym():
-                type_ = 'symlink'
-            elif ti.islnk():
-                type_ = 'hard link'
+            if ti.isdir():
+                # ignore silently; easier to just create leading dirs below
+                # XXX this mean empty dirs are not transferred
+                pass
+            elif ti.isfile():
+                if max_bytes is not None and copied + ti.size > max_bytes:
+                    log.warning(
+                        'Stopped transferring files from %s:%s at %r; '
+                        'only %d bytes are allowed per host',
+                        remote.shortname, remotedir, ti.name, max_bytes)
+                    stopped = True
+                    break
+                sub = safepath.munge(ti.name)
+                safepath.makedirs(root=localdir, path=os.path.dirname(sub))
+                tar.makefile(ti, targetpath=os.path.join(localdir, sub))
+                copied += ti.size
             else:
-                type_ = 'unknown'
-            log.info('Ignoring tar entry: %r type %r', ti.name, type_)
+                if ti.isdev():
+                    type_ = 'device'
+                elif ti.issym():
+                    type_ = 'symlink'
+                elif ti.islnk():
+                    type_ = 'hard link'
+                else:
+                    type_ = 'unknown'
+                log.info('Ignoring tar entry: %r type %r', ti.name, type_)
+    except gevent.Timeout as e:
+        if e is not deadline:
+            raise
+        log.warning(
+            'Stopped transferring files from %s:%s after %s seconds',
+            remote.shortname, remotedir, timeout)
+        stopped = True
+    finally:
+        deadline.cancel()
+    if stopped:
+        # we won't be reading the rest of the stream; don't leave tar blocked
+        # writing to it
+        r.stdout.channel.close()
+    else:
+        # a failing tar still leaves us a readable (truncated) stream; only
+        # its exit status tells us the copy is incomplete
+        r.wait()
+    return copied
 
 
 def pull_directory_tarball(remote, remotedir, localfile):
@@ -1098,27 +1141,30 @@ def ssh_keyscan(hostnames, _raise=True):
     """
     Fetch the SSH public key of one or more hosts
 
+    All the hosts are scanned at once; when retrying, only the hosts whose
+    keys haven't been retrieved yet are scanned again.
+
     :param hostnames: A list of hostnames, or a dict keyed by hostname
     :param _raise: Whether to raise an exception if not all keys are retrieved
     :returns: A dict keyed by hostname, with the host keys as values
     """
-    if not isinstance(hostnames, list) and not isinstance(hostnames, dict):
+    if isinstance(hostnames, string_types) or \
+            not hasattr(hostnames, '__iter__'):
         raise TypeError("'hostnames' must be a list")
     hostnames = [canonicalize_hostname(name, user=None) for name in
                  hostnames]
     keys_dict = dict()
-    for hostname in hostnames:
-        with safe_while(
-            sleep=1,
-            tries=5 if _raise else 1,
-            _raise=_raise,
-            action="ssh_keyscan " + hostname,
-        ) as proceed:
-            while proceed():
-                key = _ssh_keyscan(hostname)
-                if key:
-                    keys_dict[hostname] = key
-                    break
+    with safe_while(
+        sleep=1,
+        tries=5 if _raise else 1,
+        _raise=_raise,
+        action="ssh_keyscan of %d host(s)" % len(hostnames),
+    ) as proceed:
+        while proceed():
+            missing = [name for name in hostnames if name not in keys_dict]
+            keys_dict.update(_ssh_keyscan_many(missing))
+            if len(keys_dict) == len(hostnames):
+                break
     if len(keys_dict) != len(hostnames):
         missing = set(hostnames) - set(keys_dict.keys())
         msg = "Unable to scan these host keys: %s" % ' '.join(missing)
@@ -1129,27 +1175,57 @@ def ssh_keyscan(hostnames, _raise=True):
     return keys_dict
 
 
+# How many hosts to pass to each ssh-keyscan process. ssh-keyscan scans all
+# of its hosts concurrently, but needs a file descriptor for each one, and
+# its command line shouldn't grow without bound.
+KEYSCAN_BATCH_SIZE = 128
+
+
+def _ssh_keyscan_many(hostnames, batch_size=KEYSCAN_BATCH_SIZE):
+    """
+    Fetch the SSH public keys of several hosts, running one ssh-keyscan
+    process per batch_size hosts, all at the same time
+
+    :param hostnames:  A list of hostnames
+    :param batch_size: How many hosts to pass to each process
+    :returns:          A dict keyed by hostname, with the host keys as values,
+                       for the hosts whose keys were retrieved
+    """
+    procs = []
+    for i in range(0, len(hostnames), batch_size):
+        args = ['ssh-keyscan', '-T', '1', '-t', 'rsa']
+        args.extend(hostnames[i:i + batch_size])
+        procs.append(subprocess.Popen(
+            args=args,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+        ))
+    wanted = set(hostnames)
+    keys_dict = dict()
+    for p in procs:
+        stdout, stderr = p.communicate()
+        for line in ensure_str(stderr).splitlines():
+            line = line.strip()
+            if line and not line.startswith('#'):
+                log.error(line)
+        for line in ensure_str(stdout).splitlines():
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            host, key = line.split(' ', 1)
+            if host in wanted:
+                keys_dict.setdefault(host, key)
+    return keys_dict
+
+
 def _ssh_keyscan(hostname):
     """
-    Fetch the SSH public key of one or more hosts
+    Fetch the SSH public key of a host
 
     :param hostname: The hostname
-    :returns: The host key
+    :returns: The host key, or None
     """
-    args = ['ssh-keyscan', '-T', '1', '-t', 'rsa', hostname]
-    p = subprocess.Popen(
-        args=args,
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE,
-    )
-    p.wait()
-    for line in p.stderr.readlines():
-        line = ensure_str(line.strip())
-        if line and not line.startswith('#'):
-            log.error(line)
-    for line in p.stdout.readlines():
-        host, key = ensure_str(line.strip()).split(' ', 1)
-        return key
+    return _ssh_keyscan_many([hostname]).get(hostname)
 
 
 def ssh_keyscan_wait(hostname):
@@ -252,7 +252,7 @@ def nuke(ctx, should_unlock, sync_clocks=True, reboot_all=True, noipmi=False):
                         log.info(
                             "Not nuking %s because description doesn't match",
                             lock['name'])
-    with parallel() as p:
+    with parallel(concurrency=config.max_concurrent_node_ops) as p:
         for target, hostkey in ctx.config['targets'].items():
             p.spawn(
                 nuke_one,
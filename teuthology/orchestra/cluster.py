@@ -2,7 +2,11 @@
 Cluster definition
 part of context, Cluster is used to save connection information.
 """
+from collections import OrderedDict
+
 import teuthology.misc
+from teuthology.exceptions import ClusterCommandError
+from teuthology.parallel import parallel
 
 
 class Cluster(object):
@@ -56,7 +60,8 @@ class Cluster(object):
 
         Goes through nodes in alphabetical order.
 
-        If you don't specify wait=False, this will be sequentially.
+        If you don't specify wait=False, this will be sequentially; see
+        run_parallel() to run it on all of them at once.
 
         Returns a list of `RemoteProcess`.
         """
@@ -74,6 +79,54 @@ class Cluster(object):
         remotes = sorted(self.remotes.keys(), key=lambda rem: rem.name)
         return [remote.sh(**kwargs) for remote in remotes]
 
+    def run_parallel(self, concurrency=None, **kwargs):
+        """
+        Run a command on all the nodes in this cluster at the same time, or
+        on at most concurrency of them at a time.
+
+        Unlike run(), this goes on running the command on the other nodes
+        when it fails on some of them, and then raises a ClusterCommandError
+        naming each of those.
+
+        Returns a dict of `RemoteProcess`, keyed by remote, in alphabetical
+        order.
+        """
+        return self._run_parallel(
+            concurrency, lambda remote: remote.run(**kwargs))
+
+    def sh_parallel(self, concurrency=None, **kwargs):
+        """
+        Like sh(), but run the command on all the nodes at the same time, as
+        run_parallel() does.
+
+        Returns a dict of the command outputs, keyed by remote, in
+        alphabetical order.
+        """
+        return self._run_parallel(
+            concurrency, lambda remote: remote.sh(**kwargs))
+
+    def _run_parallel(self, concurrency, func):
+        def run_one(remote):
+            try:
+                return remote, func(remote), None
+            except Exception as e:
+                return remote, None, e
+
+        remotes = sorted(self.remotes.keys(), key=lambda rem: rem.name)
+        results = OrderedDict()
+        errors = OrderedDict()
+        with parallel(concurrency=concurrency, ordered=True) as p:
+            for remote in remotes:
+                p.spawn(run_one, remote)
+            for remote, result, error in p:
+                if error is None:
+                    results[remote] = result
+                else:
+                    errors[remote] = error
+        if errors:
+            raise ClusterCommandError(errors)
+        return results
+
     def write_file(self, file_name, content, sudo=False, perms=None, owner=None):
         """
         Write text to a file on each node.
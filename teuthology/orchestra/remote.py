@@ -19,6 +19,7 @@ import logging
 from io import BytesIO
 import os
 import pwd
+import shutil
 import tempfile
 import netaddr
 
@@ -54,6 +55,9 @@ class Remote(object):
         self.keep_alive = keep_alive
         self._console = console
         self.ssh = ssh
+        # the SFTP session, and the connection it was opened on
+        self._sftp = None
+        self._sftp_ssh = None
 
     def connect(self, timeout=None, create_key=None, context='connect'):
         args = dict(user_at_host=self.name, host_key=self._host_key,
@@ -69,6 +73,7 @@ class Remote(object):
         if timeout:
             args['timeout'] = timeout
 
+        self._close_sftp()
         self.ssh = connection.connect(**args)
         return self.ssh
 
@@ -77,6 +82,7 @@ class Remote(object):
         Attempts to re-establish connection. Returns True for success; False
         for failure.
         """
+        self._close_sftp()
         if self.ssh is not None:
             self.ssh.close()
         if not timeout:
@@ -305,24 +311,52 @@ class Remote(object):
         self.run(args="sudo chcon {con} {path}".format(
             con=context, path=file_path))
 
+    @property
+    def sftp(self):
+        """
+        A paramiko.SFTPClient using the current SSH connection. It is opened
+        when first needed, and then reused until it's closed or the
+        connection changes.
+        """
+        if self._sftp is None or self._sftp_ssh is not self.ssh or \
+                self._sftp.get_channel().closed:
+            self._close_sftp()
+            self._sftp = self.ssh.open_sftp()
+            self._sftp_ssh = self.ssh
+        return self._sftp
+
+    def _close_sftp(self):
+        sftp = getattr(self, '_sftp', None)
+        self._sftp = self._sftp_ssh = None
+        if sftp is None:
+            return
+        try:
+            sftp.close()
+        except Exception:
+            log.debug("Failed to close SFTP session to %s", self.shortname,
+                      exc_info=True)
+
     def _sftp_put_file(self, local_path, remote_path):
         """
         Use the paramiko.SFTPClient to put a file. Returns the remote filename.
         """
-        sftp = self.ssh.open_sftp()
-        sftp.put(local_path, remote_path)
+        self.sftp.put(local_path, remote_path)
         return
 
     def _sftp_get_file(self, remote_path, local_path):
         """
         Use the paramiko.SFTPClient to get a file. Returns the local filename.
         """
-        file_size = self._format_size(
-            self._sftp_get_size(remote_path)
-        ).strip()
-        log.debug("{}:{} is {}".format(self.shortname, remote_path, file_size))
-        sftp = self.ssh.open_sftp()
-        sftp.get(remote_path, local_path)
+        with self._sftp_open_file(remote_path) as remote_file:
+            file_size = remote_file.stat().st_size
+            log.debug("{}:{} is {}".format(
+                self.shortname, remote_path,
+                self._format_size(file_size).strip()))
+            # request the whole file up front rather than one block per
+            # round trip
+            remote_file.prefetch(file_size)
+            with open(local_path, 'wb') as local_file:
+                shutil.copyfileobj(remote_file, local_file, 32768)
         return local_path
 
     def _sftp_open_file(self, remote_path):
@@ -330,15 +364,13 @@ class Remote(object):
         Use the paramiko.SFTPClient to open a file. Returns a
         paramiko.SFTPFile object.
         """
-        sftp = self.ssh.open_sftp()
-        return sftp.open(remote_path)
+        return self.sftp.open(remote_path)
 
     def _sftp_get_size(self, remote_path):
         """
-        Via _sftp_open_file, return the filesize in bytes
+        Return the filesize in bytes
         """
-        with self._sftp_open_file(remote_path) as f:
-            return f.stat().st_size
+        return self.sftp.stat(remote_path).st_size
 
     @staticmethod
     def _format_size(file_size):
@@ -426,22 +458,39 @@ class Remote(object):
         self._sftp_get_file(remote_temp_path, to_path)
         self.remove(remote_temp_path)
 
-    def get_tar_stream(self, path, sudo=False):
+    def get_tar_stream(self, path, sudo=False, compress_level=None):
         """
         Tar-compress a remote directory and return the RemoteProcess
         for streaming
+
+        :param compress_level: If set, compress with gzip (or pigz, where it
+                               is installed) at this level rather than with
+                               tar's default gzip settings. The stream is
+                               gzip-compressed either way.
         """
         args = []
         if sudo:
             args.append('sudo')
         args.extend([
             'tar',
-            'cz',
+            'c' if compress_level else 'cz',
             '-f', '-',
             '-C', path,
             '--',
             '.',
             ])
+        if compress_level:
+            args.extend([
+                run.Raw('|'),
+                run.Raw('$(command -v pigz || echo gzip)'),
+                '-%d' % compress_level,
+                ])
+            # without pipefail a failing tar would be masked by the
+            # compressor's exit status
+            args = [
+                'bash', '-c',
+                'set -o pipefail; ' + run.quote(args),
+                ]
         return self.run(args=args, wait=False, stdout=run.PIPE)
 
     @property
@@ -514,6 +563,7 @@ class Remote(object):
         return self._init_system
 
     def __del__(self):
+        self._close_sftp()
         if self.ssh is not None:
             self.ssh.close()
 
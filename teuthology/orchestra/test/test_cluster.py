@@ -1,8 +1,13 @@
+import functools
+
 import fudge
+import gevent
 import pytest
 
 from mock import patch, Mock
 
+from teuthology.exceptions import (ClusterCommandError, CommandFailedError,
+                                   ConnectionLostError)
 from teuthology.orchestra import cluster, remote
 
 
@@ -238,3 +243,53 @@ class TestWriteFile(object):
     def test_with_sudo(self, m_sudo_write_file):
         self.c.write_file("filename", "content", sudo=True)
         m_sudo_write_file.assert_called_with(self.r1, "filename", "content", owner=None, perms=None)
+
+
+class TestRunParallel(object):
+    def setup(self):
+        self.remotes = [Mock(name='r%d' % i) for i in range(4)]
+        for i, r in enumerate(self.remotes):
+            r.name = 'r%d' % i
+        self.c = cluster.Cluster(
+            remotes=[(r, ['role%d' % i]) for i, r in enumerate(self.remotes)],
+        )
+
+    def test_run_parallel(self):
+        got = self.c.run_parallel(args=['test'])
+        assert list(got.keys()) == self.remotes
+        for r in self.remotes:
+            r.run.assert_called_once_with(args=['test'])
+            assert got[r] is r.run.return_value
+
+    def test_sh_parallel(self):
+        for r in self.remotes:
+            r.sh.return_value = r.name
+        got = self.c.sh_parallel(script='hostname')
+        assert list(got.values()) == ['r0', 'r1', 'r2', 'r3']
+
+    def test_concurrency(self):
+        running = set()
+        most_running = []
+
+        def run(r, **kwargs):
+            running.add(r)
+            most_running.append(len(running))
+            gevent.sleep(0.01)
+            running.remove(r)
+        for r in self.remotes:
+            r.run.side_effect = functools.partial(run, r)
+        self.c.run_parallel(concurrency=2, args=['test'])
+        assert max(most_running) == 2
+
+    def test_errors(self):
+        self.remotes[1].run.side_effect = CommandFailedError('test', 1, 'r1')
+        self.remotes[3].run.side_effect = ConnectionLostError('test', 'r3')
+        with pytest.raises(ClusterCommandError) as exc:
+            self.c.run_parallel(args=['test'])
+        assert list(exc.value.errors.keys()) == \
+            [self.remotes[1], self.remotes[3]]
+        assert 'r1: ' in str(exc.value)
+        assert 'r3: ' in str(exc.value)
+        # it still ran everywhere
+        for r in self.remotes:
+            r.run.assert_called_once_with(args=['test'])
@@ -165,16 +165,71 @@ class TestRemote(object):
                 assert f == m_file_obj
 
     def test_sftp_get_size(self):
-        m_file_obj = MagicMock()
-        m_stat = Mock()
-        m_stat.st_size = 42
-        m_file_obj.stat.return_value = m_stat
-        m_open = MagicMock()
-        m_open.return_value = m_file_obj
-        m_open.return_value.__enter__.return_value = m_file_obj
-        with patch.object(remote.Remote, '_sftp_open_file', new=m_open):
-            rem = remote.Remote(name='jdoe@xyzzy.example.com', ssh=self.m_ssh)
-            assert rem._sftp_get_size('/fake/file') == 42
+        m_sftp = self.m_ssh.open_sftp.return_value
+        m_sftp.get_channel.return_value.closed = False
+        m_sftp.stat.return_value.st_size = 42
+        rem = remote.Remote(name='jdoe@xyzzy.example.com', ssh=self.m_ssh)
+        assert rem._sftp_get_size('/fake/file') == 42
+        m_sftp.stat.assert_called_once_with('/fake/file')
+        m_sftp.open.assert_not_called()
+
+    def test_sftp_reused(self):
+        m_sftp = self.m_ssh.open_sftp.return_value
+        m_sftp.get_channel.return_value.closed = False
+        rem = remote.Remote(name='jdoe@xyzzy.example.com', ssh=self.m_ssh)
+        rem._sftp_put_file('/local', '/remote')
+        rem._sftp_get_size('/remote')
+        rem._sftp_open_file('/remote')
+        # in the same mode as before the session was shared
+        m_sftp.open.assert_called_once_with('/remote')
+        assert self.m_ssh.open_sftp.call_count == 1
+        # a closed session is replaced
+        m_sftp.get_channel.return_value.closed = True
+        rem._sftp_get_size('/remote')
+        assert self.m_ssh.open_sftp.call_count == 2
+
+    def test_sftp_closed_on_reconnect(self):
+        m_sftp = self.m_ssh.open_sftp.return_value
+        m_sftp.get_channel.return_value.closed = False
+        rem = remote.Remote(name='jdoe@xyzzy.example.com', ssh=self.m_ssh)
+        rem._sftp_get_size('/remote')
+        with patch.object(rem, '_reconnect') as m_reconnect:
+            m_reconnect.return_value = True
+            rem.reconnect()
+        m_sftp.close.assert_called_once_with()
+        rem.ssh = MagicMock()
+        rem._sftp_get_size('/remote')
+        rem.ssh.open_sftp.assert_called_once_with()
+
+    def test_sftp_get_file(self, tmpdir):
+        m_sftp = self.m_ssh.open_sftp.return_value
+        m_sftp.get_channel.return_value.closed = False
+        m_file = m_sftp.open.return_value.__enter__.return_value
+        m_file.stat.return_value.st_size = 5
+        m_file.read.side_effect = [b'hello', b'']
+        rem = remote.Remote(name='jdoe@xyzzy.example.com', ssh=self.m_ssh)
+        local_path = str(tmpdir.join('file'))
+        assert rem._sftp_get_file('/remote', local_path) == local_path
+        m_file.prefetch.assert_called_once_with(5)
+        with open(local_path, 'rb') as f:
+            assert f.read() == b'hello'
+
+    def test_get_tar_stream(self):
+        rem = remote.Remote(name='jdoe@xyzzy.example.com', ssh=self.m_ssh)
+        with patch.object(rem, 'run') as m_run:
+            rem.get_tar_stream('/archive', sudo=True)
+        args = m_run.call_args[1]['args']
+        assert args == ['sudo', 'tar', 'cz', '-f', '-', '-C', '/archive',
+                        '--', '.']
+
+    def test_get_tar_stream_compressed(self):
+        rem = remote.Remote(name='jdoe@xyzzy.example.com', ssh=self.m_ssh)
+        with patch.object(rem, 'run') as m_run:
+            rem.get_tar_stream('/archive', sudo=True, compress_level=6)
+        args = m_run.call_args[1]['args']
+        assert args[:2] == ['bash', '-c']
+        assert args[2].startswith('set -o pipefail; sudo tar c ')
+        assert args[2].endswith('| $(command -v pigz || echo gzip) -6')
 
     def test_format_size(self):
         assert remote.Remote._format_size(1023).strip() == '1023B'
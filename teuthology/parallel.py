@@ -1,3 +1,4 @@
+import functools
 import logging
 import sys
 
@@ -7,6 +8,8 @@ import gevent.queue
 
 from six import reraise
 
+from teuthology.exceptions import ParallelTimeoutError
+
 log = logging.getLogger(__name__)
 
 
@@ -60,27 +63,87 @@ class parallel(object):
 
     At the end of the with block, the main thread waits until all
     spawned functions have completed, or, if one exited with an exception,
-    kills the rest and raises the exception.
+    raises the exception.
+
+    The behaviour can be adjusted with these keyword arguments:
+
+    - concurrency: the maximum number of spawned functions to run at once.
+      When that many are running, spawn() waits for one of them to finish.
+    - timeout: the number of seconds each function may run for. One that
+      runs for longer throws a ParallelTimeoutError.
+    - fail_fast: as soon as one of the functions throws an exception, kill
+      the ones still running, and throw it from spawn() or the iteration,
+      whichever comes first.
+    - collect_all: let every function finish, iterate over the results of
+      the ones that didn't throw, and then throw the first exception.
+    - ordered: iterate over the results in the order the functions were
+      spawned in, rather than in the order they finished in.
+
+    ::
+
+        with parallel(concurrency=10, ordered=True) as p:
+            for remote in remotes:
+                p.spawn(remote.run, args=['hostname'])
+            hostnames = list(p)
     """
 
-    def __init__(self):
-        self.group = gevent.pool.Group()
+    def __init__(self, concurrency=None, timeout=None, fail_fast=False,
+                 collect_all=False, ordered=False):
+        if fail_fast and collect_all:
+            raise ValueError("fail_fast and collect_all can't both be set")
+        if concurrency:
+            self.group = gevent.pool.Pool(concurrency)
+        else:
+            self.group = gevent.pool.Group()
+        self.timeout = timeout
+        self.fail_fast = fail_fast
+        self.collect_all = collect_all
+        self.ordered = ordered
         self.results = gevent.queue.Queue()
         self.count = 0
         self.any_spawned = False
         self.iteration_stopped = False
+        # the number of functions spawned, and of their results handled
+        self.spawned = 0
+        self.handled = 0
+        # results that finished before the ones spawned earlier, if ordered
+        self.early_results = dict()
+        # the first exception, if fail_fast or collect_all
+        self.exception = None
 
     def spawn(self, func, *args, **kwargs):
+        if self.fail_fast and self.exception is not None:
+            self._kill()
+            resurrect_traceback(self.exception)
+        index = self.spawned
+        self.spawned += 1
         self.count += 1
         self.any_spawned = True
-        greenlet = self.group.spawn(capture_traceback, func, *args, **kwargs)
-        greenlet.link(self._finish)
+        greenlet = self.group.spawn(self._run, func, *args, **kwargs)
+        greenlet.link(functools.partial(self._finish, index))
+
+    def _run(self, func, *args, **kwargs):
+        if self.timeout is None:
+            return capture_traceback(func, *args, **kwargs)
+        timeout = gevent.Timeout(
+            self.timeout, ParallelTimeoutError(func, self.timeout))
+        timeout.start()
+        try:
+            return capture_traceback(func, *args, **kwargs)
+        finally:
+            timeout.cancel()
+
+    def _kill(self):
+        self.iteration_stopped = True
+        self.group.kill(block=False)
 
     def __enter__(self):
         return self
 
     def __exit__(self, type_, value, traceback):
         if value is not None:
+            if self.fail_fast:
+                self._kill()
             return False
 
         # raises if any greenlets exited with an exception
@@ -93,26 +156,46 @@ class parallel(object):
         return self
 
     def __next__(self):
-        if not self.any_spawned or self.iteration_stopped:
-            raise StopIteration()
-        result = self.results.get()
-
-        try:
+        while True:
+            if not self.any_spawned or self.iteration_stopped:
+                raise StopIteration()
+            if self.handled == self.spawned:
+                self.iteration_stopped = True
+                if self.exception is not None:
+                    resurrect_traceback(self.exception)
+                raise StopIteration()
+            result = self._next_result()
+            self.handled += 1
+            if not isinstance(result, (ExceptionHolder, BaseException)):
+                return result
+            if self.collect_all:
+                if self.exception is None:
+                    self.exception = result
+                continue
+            if self.fail_fast:
+                self._kill()
             resurrect_traceback(result)
-        except StopIteration:
-            self.iteration_stopped = True
-            raise
-
-        return result
 
     next = __next__
 
-    def _finish(self, greenlet):
+    def _next_result(self):
+        if not self.ordered:
+            return self.results.get()[1]
+        while self.handled not in self.early_results:
+            index, result = self.results.get()
+            if self.fail_fast and isinstance(
+                    result, (ExceptionHolder, BaseException)):
+                return result
+            self.early_results[index] = result
+        return self.early_results.pop(self.handled)
+
+    def _finish(self, index, greenlet):
         if greenlet.successful():
-            self.results.put(greenlet.value)
+            result = greenlet.value
         else:
-            self.results.put(greenlet.exception)
-
+            result = greenlet.exception
+        if (self.fail_fast and self.exception is None and
+                isinstance(result, (ExceptionHolder, BaseException))):
+            self.exception = result
+        self.results.put((index, result))
         self.count -= 1
-        if self.count <= 0:
-            self.results.put(StopIteration())
@@ -0,0 +1,141 @@
+"""
+Fetch the teuthology and suite branches that queued jobs will need - and
+bootstrap teuthology's - before workers reserve the jobs, so that workers
+don't all wait on each other to do it when jobs for a new branch arrive.
+"""
+import logging
+import os
+import time
+
+from teuthology import beanstalk
+from teuthology import setup_log_file, install_except_hook
+from teuthology.config import config as teuth_config
+from teuthology.exceptions import BranchNotFoundError
+from teuthology.repo_utils import (bootstrap_teuthology, fetch_repo,
+                                   teuthology_git_url)
+
+log = logging.getLogger(__name__)
+
+
+def main(ctx):
+    loglevel = logging.INFO
+    if ctx.verbose:
+        loglevel = logging.DEBUG
+    log.setLevel(loglevel)
+
+    if ctx.log_dir:
+        setup_log_file(os.path.join(ctx.log_dir, 'prefetch.{pid}'.format(
+            pid=os.getpid())))
+    install_except_hook()
+    teuth_config.load()
+
+    connection = beanstalk.connect()
+    prefetcher = Prefetcher(connection, ctx.tube, job_count=ctx.jobs)
+    while True:
+        try:
+            prefetcher.prefetch()
+        except Exception:
+            log.exception("Failed to prefetch the queued jobs' checkouts")
+        time.sleep(ctx.interval)
+        teuth_config.load()
+
+
+def job_checkouts(job_config):
+    """
+    Work out which checkouts worker.prep_job() will need for a job
+
+    :param job_config: The job's config
+    :returns:          A list of (repo_url, branch, bootstrap) tuples, as
+                       fetch_repo() takes them
+    """
+    checkouts = []
+    if teuth_config.teuthology_path is None:
+        checkouts.append((
+            teuthology_git_url(),
+            job_config.get('teuthology_branch', 'master'),
+            bootstrap_teuthology,
+        ))
+    ceph_branch = job_config.get('branch', 'master')
+    suite_branch = job_config.get('suite_branch', ceph_branch)
+    suite_repo = job_config.get('suite_repo') or \
+        teuth_config.get_ceph_qa_suite_git_url()
+    checkouts.append((suite_repo, suite_branch, None))
+    return checkouts
+
+
+class Prefetcher(object):
+    """
+    Looks at the next jobs in some tubes and fetches the checkouts they need.
+
+    Each checkout is fetched when it is first seen in the queue, and again
+    every refresh seconds while it stays there. Once it has been fetched,
+    workers only need a quick incremental fetch - and no bootstrap - of their
+    own. A checkout that can't be fetched is left to the workers, and only
+    tried again once it is due to be refreshed.
+
+    :param connection: A beanstalkc.Connection
+    :param tubes:      The names of the tubes to look in
+    :param job_count:  How many of the next jobs in each tube to look at
+    :param refresh:    How often to fetch a checkout again, in seconds
+    :param tries:      How many times fetch_repo() tries each checkout
+    """
+    def __init__(self, connection, tubes, job_count=100, refresh=600,
+                 tries=3):
+        self.connection = connection
+        self.tubes = tubes
+        self.job_count = job_count
+        self.refresh = refresh
+        self.tries = tries
+        # Maps each checkout to when it was last fetched, or failed to be
+        self.fetched = dict()
+
+    def queued_checkouts(self):
+        """
+        :returns: The checkouts the next jobs need, in the order the jobs
+                  will be run, without duplicates
+        """
+        checkouts = []
+        for tube in self.tubes:
+            jobs = beanstalk.peek_ready_jobs(self.connection, tube,
+                                             job_count=self.job_count)
+            for job_id, job_config, job in jobs:
+                if not isinstance(job_config, dict):
+                    continue
+                for checkout in job_checkouts(job_config):
+                    if checkout not in checkouts:
+                        checkouts.append(checkout)
+        return checkouts
+
+    def prefetch(self):
+        """
+        Fetch whichever of the queued jobs' checkouts haven't been fetched
+        recently
+
+        :returns: How many checkouts were fetched
+        """
+        checkouts = self.queued_checkouts()
+        # Forget about checkouts that are no longer queued, so they are
+        # fetched again if they are queued again
+        for checkout in list(self.fetched):
+            if checkout not in checkouts:
+                del self.fetched[checkout]
+        count = 0
+        for checkout in checkouts:
+            last = self.fetched.get(checkout)
+            if last is not None and time.time() - last < self.refresh:
+                continue
+            url, branch, bootstrap = checkout
+            log.info("Prefetching %s %s", url, branch)
+            try:
+                fetch_repo(url, branch, bootstrap, tries=self.tries)
+            except BranchNotFoundError:
+                # The workers will mark the jobs dead
+                log.warning("%s has no branch %s", url, branch)
+            except Exception:
+                # e.g. an invalid branch name, or git failing
+                log.exception("Failed to prefetch %s %s", url, branch)
+                self.fetched[checkout] = time.time()
+                continue
+            self.fetched[checkout] = time.time()
+            count += 1
+        return count
@@ -1,11 +1,14 @@
-import gzip
 import logging
 import os
 import shutil
+import subprocess
 import time
 
+from collections import Counter
+
 import teuthology
 from teuthology.contextutil import safe_while
+from teuthology.util.logs import write_tail
 
 log = logging.getLogger(__name__)
 
@@ -27,9 +30,12 @@ def main(args):
     fail_days = int(args['--fail'])
     remotes_days = int(args['--remotes'])
     compress_days = int(args['--compress'])
+    processes = int(args['--jobs'])
+    compressor = args['--compressor']
 
     prune_archive(
-        archive_dir, pass_days, fail_days, remotes_days, compress_days, dry_run
+        archive_dir, pass_days, fail_days, remotes_days, compress_days,
+        dry_run, processes=processes, compressor=compressor,
     )
 
 
@@ -40,10 +46,17 @@ def prune_archive(
         remotes_days,
         compress_days,
         dry_run=False,
+        processes=1,
+        compressor='gzip',
 ):
     """
-    Walk through the archive_dir, calling the cleanup functions to process
-    directories that might be old enough
+    Walk through the archive_dir, calling prune_run() to process directories
+    that might be old enough
+
+    :param processes:  How many logs to compress at once
+    :param compressor: 'gzip' or 'zstd'
+    :returns:          A Counter like the ones prune_run() returns, summed
+                       over every run
     """
     min_days = min(filter(
         lambda n: n >= 0, [pass_days, fail_days, remotes_days]))
@@ -59,11 +72,68 @@ def prune_archive(
                 is_old_enough(child, min_days)):
             run_dirs.append(child)
     run_dirs.sort(key=lambda p: os.path.getctime(p), reverse=True)
-    for run_dir in run_dirs:
-        log.debug("Processing %s ..." % run_dir)
-        maybe_remove_jobs(run_dir, pass_days, fail_days, dry_run)
-        maybe_remove_remotes(run_dir, remotes_days, dry_run)
-        maybe_compress_logs(run_dir, compress_days, dry_run)
+    totals = Counter()
+    with LogCompressor(processes, compressor) as log_compressor:
+        for run_dir in run_dirs:
+            log.debug("Processing %s ..." % run_dir)
+            totals.update(prune_run(
+                run_dir, pass_days, fail_days, remotes_days, compress_days,
+                log_compressor, dry_run,
+            ))
+    if dry_run:
+        log.info(
+            "Would remove {jobs} jobs and the remote logs of {remotes} more, "
+            "freeing {bytes} bytes, and compress {logs} logs totalling "
+            "{log_bytes} bytes".format(**totals))
+    else:
+        totals['log_bytes'] = log_compressor.saved
+        log.info(
+            "Removed {jobs} jobs and the remote logs of {remotes} more, and "
+            "compressed {logs} logs, saving {log_bytes} bytes".format(
+                **totals))
+    return totals
+
+
+def prune_run(run_dir, pass_days, fail_days, remotes_days, compress_days,
+              log_compressor, dry_run=False):
+    """
+    Look at each job directory in run_dir just once, and decide whether to
+    remove it, remove its remote logs, or compress its teuthology.log
+
+    :param log_compressor: The LogCompressor to hand logs to
+    :returns: A Counter of the number of 'jobs', 'remotes' and 'logs'
+              removed or compressed. For a dry run it also has the 'bytes'
+              that removing would free and the 'log_bytes' that would be
+              compressed.
+    """
+    counts = Counter(jobs=0, remotes=0, logs=0, bytes=0, log_bytes=0)
+    contents = listdir(run_dir)
+    if PRESERVE_FILE in contents:
+        return counts
+    for child in contents:
+        job_dir = os.path.join(run_dir, child)
+        # Ensure the path isn't marked for preservation and that it is a
+        # directory
+        if should_preserve(job_dir) or not os.path.isdir(job_dir):
+            continue
+        freed = maybe_remove_job(job_dir, pass_days, fail_days, dry_run)
+        if freed is not None:
+            counts['jobs'] += 1
+            counts['bytes'] += freed
+            continue
+        # The job directory's age is what counts for both of these; stat it
+        # before removing anything from it changes its mtime
+        mtime = os.path.getmtime(job_dir)
+        freed = maybe_remove_remotes(job_dir, remotes_days, mtime, dry_run)
+        if freed is not None:
+            counts['remotes'] += 1
+            counts['bytes'] += freed
+        log_size = maybe_compress_log(
+            job_dir, compress_days, mtime, log_compressor, dry_run)
+        if log_size is not None:
+            counts['logs'] += 1
+            counts['log_bytes'] += log_size
+    return counts
 
 
 def listdir(path):
@@ -88,8 +158,9 @@ def should_preserve(dir_name):
     return False
 
 
-def is_old_enough(file_name, days):
+def is_old_enough(file_name, days, mtime=None):
     """
+    :param mtime: The file's modification time, if it is already known
     :returns: True if the file's modification date is earlier than the amount
               of days specified
     """
@@ -97,7 +168,9 @@ def is_old_enough(file_name, days):
         return False
     now = time.time()
     secs_to_days = lambda s: s / (60 * 60 * 24)
-    age = now - os.path.getmtime(file_name)
+    if mtime is None:
+        mtime = os.path.getmtime(file_name)
+    age = now - mtime
     if secs_to_days(age) > days:
         return True
     return False
@@ -114,69 +187,65 @@ def remove(path):
         log.exception("Failed to remove %s !" % path)
 
 
-def maybe_remove_jobs(run_dir, pass_days, fail_days, dry_run=False):
+def maybe_remove_job(job_dir, pass_days, fail_days, dry_run=False):
     """
-    Remove entire job log directories if they are old enough and the job passed
+    Remove an entire job log directory if it is old enough and the job passed
+    (or failed, according to fail_days)
+
+    :returns: None if the job isn't to be removed. Otherwise, for a dry run
+              the number of bytes removing it would free, or else 0.
     """
     if pass_days < 0 and fail_days < 0:
         return
-    contents = listdir(run_dir)
-    if PRESERVE_FILE in contents:
+    # Is it a job dir?
+    summary_path = os.path.join(job_dir, 'summary.yaml')
+    if not os.path.exists(summary_path):
         return
-    for child in contents:
-        job_path = os.path.join(run_dir, child)
-        # Ensure the path isn't marked for preservation and that it is a
-        # directory
-        if should_preserve(job_path) or not os.path.isdir(job_path):
-            continue
-        # Is it a job dir?
-        summary_path = os.path.join(job_path, 'summary.yaml')
-        if not os.path.exists(summary_path):
-            continue
-        # Depending on whether it passed or failed, we have a different age
-        # threshold
-        summary_lines = [line.strip() for line in
-                         open(summary_path).readlines()]
-        if 'success: true' in summary_lines:
-            status = 'passed'
-            days = pass_days
-        elif 'success: false' in summary_lines:
-            status = 'failed'
-            days = fail_days
-        else:
-            continue
-        # Ensure the directory is old enough to remove
-        if not is_old_enough(summary_path, days):
-            continue
-        log.info("{job} is a {days}-day old {status} job; removing".format(
-            job=job_path, days=days, status=status))
-        if not dry_run:
-            remove(job_path)
+    # Depending on whether it passed or failed, we have a different age
+    # threshold
+    summary_lines = [line.strip() for line in
+                     open(summary_path).readlines()]
+    if 'success: true' in summary_lines:
+        status = 'passed'
+        days = pass_days
+    elif 'success: false' in summary_lines:
+        status = 'failed'
+        days = fail_days
+    else:
+        return
+    # Ensure the directory is old enough to remove
+    if not is_old_enough(summary_path, days):
+        return
+    log.info("{job} is a {days}-day old {status} job; removing".format(
+        job=job_dir, days=days, status=status))
+    if dry_run:
+        return disk_usage(job_dir)
+    remove(job_dir)
+    return 0
 
 
-def maybe_remove_remotes(run_dir, days, dry_run=False):
+def maybe_remove_remotes(job_dir, days, mtime=None, dry_run=False):
     """
-    Remove remote logs (not teuthology logs) from job directories if they are
+    Remove remote logs (not teuthology logs) from a job directory if it is
     old enough
+
+    :param mtime: The job directory's modification time, if already known
+    :returns: None if there was nothing to remove. Otherwise, for a dry run
+              the number of bytes removing it would free, or else 0.
     """
-    if days < 0:
+    if not is_old_enough(job_dir, days, mtime):
         return
-    contents = listdir(run_dir)
     subdirs = dict(
         remote='remote logs',
         data='mon data',
     )
-    if PRESERVE_FILE in contents:
-        return
-    for child in contents:
-        item = os.path.join(run_dir, child)
-        # Ensure the path isn't marked for preservation, that it is a
-        # directory, and that it is old enough
-        if (should_preserve(item) or not os.path.isdir(item) or not
-                is_old_enough(item, days)):
-            continue
-        for (subdir, description) in subdirs.items():
-            _maybe_remove_subdir(item, subdir, days, description, dry_run)
+    freed = None
+    for (subdir, description) in subdirs.items():
+        subdir_freed = _maybe_remove_subdir(
+            job_dir, subdir, days, description, dry_run)
+        if subdir_freed is not None:
+            freed = (freed or 0) + subdir_freed
+    return freed
 
 
 def _maybe_remove_subdir(job_dir, subdir, days, description, dry_run=False):
@@ -189,49 +258,129 @@ def _maybe_remove_subdir(job_dir, subdir, days, description, dry_run=False):
         days=days,
         desc=description,
     ))
-    if not dry_run:
-        remove(subdir_path)
+    if dry_run:
+        return disk_usage(subdir_path)
+    remove(subdir_path)
+    return 0
 
 
-def maybe_compress_logs(run_dir, days, dry_run=False):
-    if days < 0:
+def maybe_compress_log(job_dir, days, mtime, log_compressor, dry_run=False):
+    """
+    Have log_compressor compress a job's teuthology.log if the job directory
+    is old enough. The end of it is kept uncompressed, for
+    teuthology.util.logs.tail_log().
+
+    :param mtime: The job directory's modification time, if already known
+    :returns: The log's size, or None if it isn't to be compressed
+    """
+    if not is_old_enough(job_dir, days, mtime):
         return
-    contents = listdir(run_dir)
-    if PRESERVE_FILE in contents:
+    log_name = 'teuthology.log'
+    log_path = os.path.join(job_dir, log_name)
+    try:
+        size = os.path.getsize(log_path)
+    except OSError:
         return
-    for child in contents:
-        item = os.path.join(run_dir, child)
-        # Ensure the path isn't marked for preservation, that it is a
-        # directory, and that it is old enough
-        if (should_preserve(item) or not os.path.isdir(item) or not
-                is_old_enough(item, days)):
-            continue
-        log_name = 'teuthology.log'
-        log_path = os.path.join(item, log_name)
-        if not os.path.exists(log_path):
-            continue
-        log.info("{job} is {days} days old; compressing {name}".format(
-            job=item,
-            days=days,
-            name=log_name,
-        ))
-        if dry_run:
-            continue
-        zlog_path = log_path + '.gz'
+    log.info("{job} is {days} days old; compressing {name}".format(
+        job=job_dir,
+        days=days,
+        name=log_name,
+    ))
+    if not dry_run:
         try:
-            _compress(log_path, zlog_path)
-        except Exception:
-            log.exception("Failed to compress %s", log_path)
-            os.remove(zlog_path)
-        else:
-            os.remove(log_path)
+            write_tail(log_path)
+        except (IOError, OSError):
+            log.exception("Failed to save the end of %s", log_path)
+        log_compressor.compress(log_path)
+    return size
 
 
-def _compress(in_path, out_path):
+def disk_usage(path):
     """
-    Compresses a file using gzip, preserving the original permissions, atime,
-    and mtime.  Does not remove the original.
+    :returns: The number of bytes of disk space used by path and everything
+              under it
     """
-    with open(in_path, 'rb') as src, gzip.open(out_path, 'wb') as dest:
-        shutil.copyfileobj(src, dest)
-        shutil.copystat(in_path, out_path)
+    def usage(st):
+        blocks = getattr(st, 'st_blocks', None)
+        return blocks * 512 if blocks is not None else st.st_size
+
+    total = usage(os.lstat(path))
+    for root, dirs, files in os.walk(path):
+        for name in dirs + files:
+            try:
+                total += usage(os.lstat(os.path.join(root, name)))
+            except OSError:
+                pass
+    return total
+
+
+class LogCompressor(object):
+    """
+    Compresses files using gzip or zstd, running up to `processes` of them at
+    once, preserving the original permissions, atime, and mtime. The
+    originals are removed once compressed.
+
+    Use it as a context manager; leaving the context waits for everything to
+    be compressed.
+    """
+    suffixes = dict(gzip='.gz', zstd='.zst')
+
+    def __init__(self, processes=1, program='gzip'):
+        if program not in self.suffixes:
+            raise ValueError("Unsupported compressor: %s" % program)
+        self.processes = max(processes, 1)
+        self.program = program
+        self.running = list()
+        # Bytes saved by compressing
+        self.saved = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.wait()
+
+    def compress(self, path):
+        """
+        Start compressing path, first waiting for a process to finish if
+        self.processes are already running
+        """
+        self._reap()
+        while len(self.running) >= self.processes:
+            self._finish(*self.running.pop(0))
+        out_path = path + self.suffixes[self.program]
+        # -k: we remove the original ourselves, once its stats are copied
+        args = [self.program, '-q', '-k', '-f', path]
+        try:
+            proc = subprocess.Popen(args)
+        except OSError:
+            log.exception("Failed to compress %s", path)
+            return
+        self.running.append((proc, path, out_path))
+
+    def wait(self):
+        """
+        Wait for all running processes to finish
+        """
+        while self.running:
+            self._finish(*self.running.pop(0))
+
+    def _reap(self):
+        for item in list(self.running):
+            if item[0].poll() is not None:
+                self.running.remove(item)
+                self._finish(*item)
+
+    def _finish(self, proc, path, out_path):
+        if proc.wait() != 0:
+            log.error("Failed to compress %s: %s exited with status %s",
+                      path, self.program, proc.returncode)
+            if os.path.exists(out_path):
+                os.remove(out_path)
+            return
+        try:
+            shutil.copystat(path, out_path)
+            self.saved += os.path.getsize(path) - os.path.getsize(out_path)
+            os.remove(path)
+        except OSError:
+            log.exception("Failed to compress %s", path)
@@ -1,3 +1,5 @@
+import hashlib
+import json
 import logging
 import os
 import re
@@ -21,6 +23,12 @@ log = logging.getLogger(__name__)
 # Similar for teuthology's bootstrap
 FRESHNESS_INTERVAL = 60
 
+# The files in a teuthology checkout that decide what ./bootstrap installs
+BOOTSTRAP_INPUTS = ('bootstrap', 'setup.py', 'requirements.txt',
+                    'requirements2.txt', 'requirements3.txt')
+# Written in a checkout's virtualenv when it is an overlay on a cached one
+VENV_CACHE_KEY_FILE = '.venv_cache_key'
+
 
 def touch_file(path):
     out = subprocess.check_output(('touch', path))
@@ -61,8 +69,14 @@ def ls_remote(url, ref):
     """
     Return the current sha1 for a given repository and ref
 
+    Answers are remembered for a short while; see RefCache.
+
     :returns: The sha1 if found; else None
     """
+    return ref_cache.ls_remote(url, ref)
+
+
+def _ls_remote(url, ref):
     sha1 = None
     cmd = "git ls-remote {} {}".format(url, ref)
     result = subprocess.check_output(
@@ -73,6 +87,123 @@ def ls_remote(url, ref):
     return sha1
 
 
+def _list_refs(url):
+    """
+    :returns: A list of [sha1, ref] pairs for each of a repo's branches and
+              tags - including peeled tags, e.g. refs/tags/v1.0^{} - in the
+              order 'git ls-remote' lists them
+    """
+    out = ensure_str(subprocess.check_output(
+        ('git', 'ls-remote', '--heads', '--tags', url)))
+    refs = [line.split('\t', 1) for line in out.splitlines() if '\t' in line]
+    log.debug("git ls-remote %s -> %d refs", url, len(refs))
+    return refs
+
+
+def match_ref(refs, pattern):
+    """
+    Find a ref the way 'git ls-remote <url> <pattern>' would: the first one
+    that is the pattern or ends with '/' and the pattern
+
+    :param refs:    A list of [sha1, ref] pairs, as _list_refs() returns
+    :param pattern: e.g. 'master', 'refs/heads/master' or 'v1.0^{}'
+    :returns:       The ref's sha1, or None
+    """
+    for sha1, ref in refs:
+        if ref == pattern or ref.endswith('/' + pattern):
+            return sha1
+    return None
+
+
+class RefCache(object):
+    """
+    Answers ls_remote() from a single 'git ls-remote' of each repo's branches
+    and tags, rather than one per ref.
+
+    Listings are kept for ttl seconds as small JSON files under path, one
+    directory per repo, so that they are shared by every process on the
+    host. Refs that aren't branches or tags, e.g. refs/pull/* or HEAD, are
+    queried one at a time, and those answers are kept the same way.
+
+    :param path: Where to keep listings. Defaults to config.ref_cache_path,
+                 or the 'refs' directory in config.src_base_path.
+    :param ttl:  How long to keep listings, in seconds. 0 means not to keep
+                 them, and to query each ref separately. Defaults to
+                 config.ref_cache_ttl.
+    """
+    def __init__(self, path=None, ttl=None):
+        self._path = path
+        self._ttl = ttl
+        # Listings made before this time are ignored, as if they had expired
+        self.since = 0
+
+    @property
+    def path(self):
+        return self._path or config.ref_cache_path or \
+            os.path.join(config.src_base_path, 'refs')
+
+    @property
+    def ttl(self):
+        return config.ref_cache_ttl if self._ttl is None else self._ttl
+
+    def ls_remote(self, url, ref):
+        """
+        :returns: What 'git ls-remote <url> <ref>' would: the sha1 of the
+                  first matching ref, or None
+        """
+        if not self.ttl:
+            return _ls_remote(url, ref)
+        sha1 = match_ref(self._get(url, None, _list_refs), ref)
+        if sha1 is None and not ref.startswith(('refs/heads/', 'refs/tags/')):
+            sha1 = self._get(url, ref, _ls_remote)
+        return sha1
+
+    def _get(self, url, ref, read):
+        repo_dir = os.path.join(self.path, url_to_dirname(url))
+        if not os.path.isdir(repo_dir):
+            os.makedirs(repo_dir)
+        key = url if ref is None else url + '\0' + ref
+        entry_path = os.path.join(
+            repo_dir, hashlib.sha1(key.encode()).hexdigest() + '.json')
+        # only let one process query the repo at a time
+        with FileLock(entry_path + '.lock'):
+            entry = self._load(entry_path)
+            if entry is None:
+                value = read(url) if ref is None else read(url, ref)
+                entry = dict(time=time.time(), url=url, ref=ref, value=value)
+                tmp_path = '%s.%d' % (entry_path, os.getpid())
+                with open(tmp_path, 'w') as f:
+                    json.dump(entry, f)
+                os.rename(tmp_path, entry_path)
+        return entry['value']
+
+    def _load(self, entry_path):
+        try:
+            with open(entry_path) as f:
+                entry = json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+        now = time.time()
+        if entry['time'] < self.since or now - entry['time'] >= self.ttl:
+            return None
+        return entry
+
+    def invalidate(self, url=None):
+        """
+        Forget what was listed for a repo, or for every repo
+
+        :param url: The repo's URL
+        """
+        if url is None:
+            shutil.rmtree(self.path, ignore_errors=True)
+        else:
+            shutil.rmtree(os.path.join(self.path, url_to_dirname(url)),
+                          ignore_errors=True)
+
+
+ref_cache = RefCache()
+
+
 def enforce_repo_state(repo_url, dest_path, branch, remove_on_error=True):
     """
     Use git to either clone or update a given repo, forcing it to switch to the
@@ -105,6 +236,109 @@ def enforce_repo_state(repo_url, dest_path, branch, remove_on_error=True):
         raise
 
 
+def enforce_worktree_state(repo_url, dest_path, branch, lock=True):
+    """
+    Like enforce_repo_state(), but rather than each checkout being a clone of
+    its own, the branch is fetched into a bare mirror of the repo that is
+    shared by every checkout of it, and dest_path is a worktree of that
+    mirror. Objects are only fetched - and stored - once for all branches.
+
+    :param repo_url:  The full URL to the repo (not including the branch)
+    :param dest_path: The full path to the destination directory
+    :param branch:    The branch.
+    :param lock:      Whether to lock the mirror while updating it. Only
+                      pass False if nothing else could be using it.
+    :raises:          BranchNotFoundError if the branch is not found;
+                      GitError for other errors
+    """
+    validate_branch(branch)
+    mirror = mirror_path(repo_url)
+    if not os.path.isdir(os.path.dirname(mirror)):
+        os.makedirs(os.path.dirname(mirror))
+    sentinel = os.path.join(dest_path, '.fetched')
+    try:
+        # fetches of different branches into the mirror would race to update
+        # its shallow file
+        with FileLock(mirror + '.lock', noop=not lock):
+            fetched = False
+            if not is_fresh(sentinel):
+                init_mirror(repo_url, mirror)
+                fetch_branch(mirror, branch)
+                fetched = True
+            else:
+                log.info("%s was just updated; assuming it is current",
+                         dest_path)
+            if not os.path.exists(os.path.join(dest_path, '.git')):
+                log.info("Adding a worktree of %s at %s", mirror, dest_path)
+                # forget about worktrees whose directories were removed
+                run_git(['worktree', 'prune'], mirror)
+                run_git(['worktree', 'add', '--detach', dest_path,
+                         remote_branch(branch)], mirror)
+        if fetched:
+            touch_file(sentinel)
+        reset_repo(repo_url, dest_path, branch)
+    except BranchNotFoundError:
+        shutil.rmtree(dest_path, ignore_errors=True)
+        raise
+
+
+def mirror_path(repo_url):
+    """
+    :returns: The path to the bare mirror of repo_url that
+              enforce_worktree_state() keeps
+    """
+    return os.path.join(config.src_base_path, 'mirrors',
+                        url_to_dirname(repo_url) + '.git')
+
+
+def init_mirror(repo_url, mirror):
+    """
+    Create a bare mirror of a repo to fetch branches into, or make sure an
+    existing one fetches from the right URL
+
+    :param repo_url: The full URL to the repo
+    :param mirror:   The path to the mirror
+    :raises:         GitError if the operation fails
+    """
+    if os.path.exists(os.path.join(mirror, 'HEAD')):
+        set_remote(mirror, repo_url)
+        return
+    log.info("Creating a mirror of %s at %s", repo_url, mirror)
+    shutil.rmtree(mirror, ignore_errors=True)
+    run_git(['init', '--bare', mirror])
+    run_git(['remote', 'add', 'origin', repo_url], mirror)
+
+
+def remote_branch(branch):
+    """
+    :returns: What fetch_branch() fetches a branch or ref as, e.g.
+              'origin/master'
+    """
+    if '/' in branch:
+        return lsstrip(remote_ref_from_ref(branch), 'refs/remotes/')
+    return 'origin/%s' % branch
+
+
+def run_git(args, repo_path=None):
+    """
+    Run a git command, logging its output if it fails
+
+    :param args:      The arguments to git
+    :param repo_path: The directory to run it in
+    :raises:          GitError if the command fails
+    """
+    proc = subprocess.Popen(
+        ['git'] + args,
+        cwd=repo_path,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT)
+    out = ensure_str(proc.communicate()[0])
+    if proc.returncode != 0:
+        log.error(out)
+        raise GitError("git %s failed!" % args[0])
+    return out
+
+
 def clone_repo(repo_url, dest_path, branch, shallow=True):
     """
     Clone a repo into a path
@@ -275,10 +509,7 @@ def reset_repo(repo_url, dest_path, branch):
                       GitError for other errors
     """
     validate_branch(branch)
-    if '/' in branch:
-        reset_branch = lsstrip(remote_ref_from_ref(branch), 'refs/remotes/')
-    else:
-        reset_branch = 'origin/%s' % branch
+    reset_branch = remote_branch(branch)
     log.info('Resetting repo at %s to branch %s', dest_path, reset_branch)
     # This try/except block will notice if the requested branch doesn't
     # exist, whether it was cloned or fetched.
@@ -302,15 +533,21 @@ def validate_branch(branch):
         raise ValueError("Illegal branch name: '%s'" % branch)
 
 
-def fetch_repo(url, branch, bootstrap=None, lock=True):
+def fetch_repo(url, branch, bootstrap=None, lock=True, tries=60):
     """
     Make sure we have a given project's repo checked out and up-to-date with
     the current branch requested
 
+    Each branch is checked out in a worktree of a mirror shared by all the
+    repo's branches; see enforce_worktree_state(). Checkouts made as
+    separate clones, before there were mirrors, are still updated as clones.
+
     :param url:        The URL to the repo
     :param bootstrap:  An optional callback function to execute. Gets passed a
                        dest_dir argument: the path to the repo on-disk.
     :param branch:     The branch we want
+    :param tries:      How many times to try, 10 seconds apart, before giving
+                       up and removing the checkout
     :returns:          The destination path
     """
     src_base_path = config.src_base_path
@@ -322,11 +559,15 @@ def fetch_repo(url, branch, bootstrap=None, lock=True):
     # only let one worker create/update the checkout at a time
     lock_path = dest_path.rstrip('/') + '.lock'
     with FileLock(lock_path, noop=not lock):
-        with safe_while(sleep=10, tries=60) as proceed:
+        with safe_while(sleep=10, tries=tries) as proceed:
             try:
                 while proceed():
                     try:
-                        enforce_repo_state(url, dest_path, branch)
+                        if os.path.isdir(os.path.join(dest_path, '.git')):
+                            enforce_repo_state(url, dest_path, branch)
+                        else:
+                            enforce_worktree_state(url, dest_path, branch,
+                                                   lock=lock)
                         if bootstrap:
                             bootstrap(dest_path)
                         break
@@ -356,9 +597,10 @@ def url_to_dirname(url):
         https://github.com/ceph/ceph -> github.com_ceph_ceph
         https://github.com/liewegas/ceph.git -> github.com_liewegas_ceph
         file:///my/dir/has/ceph.git -> my_dir_has_ceph
+        /my/dir/has/ceph.git -> my_dir_has_ceph
     """
-    # Strip protocol from left-hand side
-    string = re.match('.*://(.*)', url).groups()[0]
+    # Strip protocol, if any, from left-hand side
+    string = re.match('(?:.*://)?(.*)', url).groups()[0]
     # Strip '.git' from the right-hand side
     string = string.rstrip('.git')
     # Replace certain characters with underscores
@@ -388,36 +630,193 @@ def fetch_teuthology(branch, lock=True):
     :param branch: The branch we want
     :returns:      The destination path
     """
-    url = config.ceph_git_base_url + 'teuthology.git'
-    return fetch_repo(url, branch, bootstrap_teuthology, lock)
+    return fetch_repo(teuthology_git_url(), branch, bootstrap_teuthology,
+                      lock)
+
+
+def teuthology_git_url():
+    """
+    :returns: The URL of the teuthology repo
+    """
+    return config.ceph_git_base_url + 'teuthology.git'
 
 
 def bootstrap_teuthology(dest_path):
-        sentinel = os.path.join(dest_path, '.bootstrapped')
-        if is_fresh(sentinel):
-            log.info(
-                "Skipping bootstrap as it was already done in the last %ss",
-                FRESHNESS_INTERVAL,
-            )
-            return
-        log.info("Bootstrapping %s", dest_path)
-        # This magic makes the bootstrap script not attempt to clobber an
-        # existing virtualenv. But the branch's bootstrap needs to actually
-        # check for the NO_CLOBBER variable.
-        env = os.environ.copy()
-        env['NO_CLOBBER'] = '1'
-        cmd = './bootstrap'
-        boot_proc = subprocess.Popen(cmd, shell=True, cwd=dest_path, env=env,
-                                     stdout=subprocess.PIPE,
-                                     stderr=subprocess.STDOUT)
-        out, err = boot_proc.communicate()
-        returncode = boot_proc.wait()
-        log.info("Bootstrap exited with status %s", returncode)
-        if returncode != 0:
-            for line in out.split():
-                log.warn(line.strip())
-            venv_path = os.path.join(dest_path, 'virtualenv')
-            log.info("Removing %s", venv_path)
-            shutil.rmtree(venv_path, ignore_errors=True)
-            raise BootstrapError("Bootstrap failed!")
-        touch_file(sentinel)
+    """
+    Make sure a teuthology checkout has a virtualenv it can run from.
+
+    The virtualenvs that ./bootstrap builds are kept in venv_cache_path(),
+    named by the requirements_hash() of the checkout they were built from, so
+    that each set of requirements is only installed once. Each checkout's own
+    'virtualenv' is an overlay on the cached one: it uses the cached one's
+    packages, and has just the checkout itself installed.
+
+    Checkouts whose virtualenv was made before there was a cache have it
+    bootstrapped in place, as it always was.
+
+    :param dest_path: The path to the checkout
+    :raises:          BootstrapError if the virtualenv can't be made
+    """
+    sentinel = os.path.join(dest_path, '.bootstrapped')
+    if is_fresh(sentinel):
+        log.info(
+            "Skipping bootstrap as it was already done in the last %ss",
+            FRESHNESS_INTERVAL,
+        )
+        return
+    venv_path = os.path.join(dest_path, 'virtualenv')
+    if os.path.isdir(venv_path) and \
+            not os.path.exists(os.path.join(venv_path, VENV_CACHE_KEY_FILE)):
+        run_bootstrap(dest_path, venv_path)
+    else:
+        key = requirements_hash(dest_path)
+        cached_path = get_cached_venv(dest_path, key)
+        if cached_path is not None:
+            make_overlay_venv(dest_path, venv_path, cached_path, key)
+    touch_file(sentinel)
+
+
+def venv_cache_path():
+    """
+    :returns: The directory the bootstrapped virtualenvs are kept in
+    """
+    return config.venv_cache_path or \
+        os.path.join(config.src_base_path, 'virtualenvs')
+
+
+def requirements_hash(repo_path):
+    """
+    Hash the files that decide what a teuthology checkout's ./bootstrap
+    would install, along with the python it would use
+
+    :param repo_path: The path to the checkout
+    :returns:         A hex digest
+    """
+    sha = hashlib.sha1()
+    sha.update(os.environ.get('PYTHON', '').encode())
+    for name in BOOTSTRAP_INPUTS:
+        path = os.path.join(repo_path, name)
+        if not os.path.exists(path):
+            continue
+        with open(path, 'rb') as f:
+            sha.update(b'\0' + name.encode() + b'\0' + f.read())
+    return sha.hexdigest()
+
+
+def get_cached_venv(repo_path, key):
+    """
+    Return the cached virtualenv for a requirements hash, running a
+    checkout's ./bootstrap to build it if there isn't one yet
+
+    :param repo_path: The path to the checkout to bootstrap from
+    :param key:       The checkout's requirements_hash()
+    :returns:         The path to the cached virtualenv, or None if the
+                      checkout's ./bootstrap is too old to build one outside
+                      the checkout, and built the checkout's own instead
+    """
+    cache_path = venv_cache_path()
+    if not os.path.exists(cache_path):
+        os.makedirs(cache_path)
+    cached_path = os.path.join(cache_path, key)
+    sentinel = os.path.join(cached_path, '.bootstrapped')
+    with FileLock(cached_path + '.lock'):
+        if os.path.exists(sentinel):
+            log.info("Using cached virtualenv %s", cached_path)
+        else:
+            shutil.rmtree(cached_path, ignore_errors=True)
+            run_bootstrap(repo_path, cached_path)
+            if not os.path.isdir(cached_path):
+                log.info("%s/bootstrap ignored VENV; not caching its "
+                         "virtualenv", repo_path)
+                return None
+            touch_file(sentinel)
+    return cached_path
+
+
+def make_overlay_venv(repo_path, venv_path, cached_path, key):
+    """
+    Make a checkout's virtualenv an overlay on a cached one, unless it
+    already is one on the same cached virtualenv
+
+    :param repo_path:   The path to the checkout
+    :param venv_path:   The path to the checkout's virtualenv
+    :param cached_path: The path to the cached virtualenv
+    :param key:         The checkout's requirements_hash()
+    :raises:            BootstrapError if the virtualenv can't be made
+    """
+    key_path = os.path.join(venv_path, VENV_CACHE_KEY_FILE)
+    if os.path.exists(key_path):
+        with open(key_path) as f:
+            if f.read().strip() == key:
+                return
+    log.info("Creating %s on top of %s", venv_path, cached_path)
+    shutil.rmtree(venv_path, ignore_errors=True)
+    python = os.path.join(venv_path, 'bin', 'python')
+    try:
+        _check_output(['virtualenv', '--python',
+                       os.path.join(cached_path, 'bin', 'python'),
+                       '--no-pip', '--no-setuptools', '--no-wheel',
+                       venv_path])
+        # Let the overlay use the cached virtualenv's packages - including
+        # setuptools, which the next step needs
+        with open(os.path.join(_site_packages(python),
+                               'teuthology-venv-cache.pth'), 'w') as f:
+            f.write('import site; site.addsitedir(%r)\n' %
+                    _site_packages(os.path.join(cached_path, 'bin',
+                                                'python')))
+        _check_output([python, 'setup.py', 'develop', '--no-deps'],
+                      cwd=repo_path)
+    except BootstrapError:
+        shutil.rmtree(venv_path, ignore_errors=True)
+        raise
+    with open(key_path, 'w') as f:
+        f.write(key + '\n')
+
+
+def _site_packages(python):
+    return _check_output(
+        [python, '-c',
+         'import sysconfig; print(sysconfig.get_paths()["purelib"])'],
+    ).strip()
+
+
+def _check_output(args, cwd=None):
+    proc = subprocess.Popen(args, cwd=cwd, stdout=subprocess.PIPE,
+                            stderr=subprocess.STDOUT)
+    out = ensure_str(proc.communicate()[0])
+    if proc.returncode != 0:
+        for line in out.splitlines():
+            log.warn(line)
+        raise BootstrapError("%s failed!" % ' '.join(args[:2]))
+    return out
+
+
+def run_bootstrap(repo_path, venv_path):
+    """
+    Run a teuthology checkout's ./bootstrap
+
+    :param repo_path: The path to the checkout
+    :param venv_path: Where ./bootstrap should make the virtualenv
+    :raises:          BootstrapError if it fails
+    """
+    log.info("Bootstrapping %s into %s", repo_path, venv_path)
+    # This magic makes the bootstrap script not attempt to clobber an
+    # existing virtualenv. But the branch's bootstrap needs to actually
+    # check for the NO_CLOBBER variable.
+    env = os.environ.copy()
+    env['NO_CLOBBER'] = '1'
+    # ./bootstrap only takes paths relative to the checkout
+    env['VENV'] = os.path.relpath(venv_path, repo_path)
+    cmd = './bootstrap'
+    boot_proc = subprocess.Popen(cmd, shell=True, cwd=repo_path, env=env,
+                                 stdout=subprocess.PIPE,
+                                 stderr=subprocess.STDOUT)
+    out, err = boot_proc.communicate()
+    returncode = boot_proc.wait()
+    log.info("Bootstrap exited with status %s", returncode)
+    if returncode != 0:
+        for line in out.split():
+            log.warn(line.strip())
+        log.info("Removing %s", venv_path)
+        shutil.rmtree(venv_path, ignore_errors=True)
+        raise BootstrapError("Bootstrap failed!")
@@ -1,15 +1,23 @@
+import errno
+import fcntl
 import os
+import random
+import time
 import yaml
 import json
 import re
 import requests
 import logging
 import socket
+from collections import defaultdict
 from datetime import datetime
 
 import teuthology
+from teuthology.archive_index import ArchiveIndex
 from teuthology.config import config
 from teuthology.job_status import get_status, set_status
+from teuthology.parallel import parallel
+from teuthology.util.logs import find_log
 
 report_exceptions = (requests.exceptions.RequestException, socket.error)
 
@@ -38,10 +46,12 @@ def main(args):
     archive_base = os.path.abspath(os.path.expanduser(args['--archive'])) or \
         config.archive_base
     save = not args['--no-save']
+    concurrency = int(args['--concurrency'])
 
     log = init_logging()
     reporter = ResultsReporter(archive_base, save=save, refresh=refresh,
-                               log=log)
+                               log=log, concurrency=concurrency,
+                               bulk=args['--bulk'])
     if dead and not job:
         for run_name in run:
             try_mark_run_dead(run[0])
@@ -62,12 +72,80 @@ class ResultsSerializer(object):
     This class exists to poke around in the archive directory doing things like
     assembling lists of test runs, lists of their jobs, and merging sets of job
     YAML files together to form JSON objects.
+
+    Unless use_index is False, what it finds is kept in an ArchiveIndex, and
+    only directories and files that have changed since are read again.
     """
     yamls = ('orig.config.yaml', 'config.yaml', 'info.yaml', 'summary.yaml')
+    simple_yamls = ('orig.config.yaml', 'info.yaml')
 
-    def __init__(self, archive_base, log=None):
+    def __init__(self, archive_base, log=None, use_index=True):
         self.archive_base = archive_base or config.archive_base
         self.log = log or init_logging()
+        self.index = ArchiveIndex(self.archive_base) if use_index else None
+
+    def _cached(self, key, paths, read):
+        """
+        Call read(), or look up what it returned last time in self.index if
+        none of paths have been modified since.
+
+        :param key:   A string identifying what read() returns
+        :param paths: The paths read() looks at. Missing ones are skipped.
+        :param read:  A function to call with the paths that exist
+        """
+        stamp = []
+        existing = []
+        for path in paths:
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            existing.append(path)
+            stamp.append([os.path.basename(path), st.st_mtime, st.st_size])
+        if self.index is None or not existing:
+            return read(existing)
+        return self.index.get(
+            key, stamp, lambda: read(existing),
+            mtime=max(mtime for (_, mtime, _) in stamp),
+        )
+
+    def _forget_missing(self, dir_path, names):
+        """
+        Remove what the index holds about the runs or jobs in dir_path
+        other than names, e.g. because teuthology-prune removed them
+
+        :param dir_path: The archive directory, or a run's directory
+        :param names:    The names of the directories still in dir_path
+        """
+        if self.index is None:
+            return
+        names = set(names)
+        stale = []
+        for kind in ('job', 'jobs'):
+            prefix = '%s:%s' % (kind, os.path.join(dir_path, ''))
+            for key in self.index.keys(prefix):
+                # Keys look like jobs:<run_dir> and job:<job_dir>:<yamls>.
+                # Run names may contain ':', but job ids can't.
+                rest = key[len(prefix):]
+                if '/' in rest:
+                    name = rest.split('/', 1)[0]
+                elif kind == 'job':
+                    name = rest.split(':', 1)[0]
+                else:
+                    name = rest
+                if name not in names:
+                    stale.append(key)
+        self.index.delete(stale)
+
+    @staticmethod
+    def _merge_yamls(yaml_paths):
+        merged = {}
+        for yaml_path in yaml_paths:
+            with open(yaml_path) as yaml_file:
+                partial_info = yaml.safe_load(yaml_file)
+                if partial_info is not None:
+                    merged.update(partial_info)
+        return merged
 
 
     def job_info(self, run_name, job_id, pretty=False, simple=False):
@@ -82,19 +160,12 @@ class ResultsSerializer(object):
         job_archive_dir = os.path.join(self.archive_base,
                                        run_name,
                                        job_id)
-        job_info = {}
-
-        if simple:
-            self.yamls = ('orig.config.yaml', 'info.yaml')
-
-        for yaml_name in self.yamls:
-            yaml_path = os.path.join(job_archive_dir, yaml_name)
-            if not os.path.exists(yaml_path):
-                continue
-            with open(yaml_path) as yaml_file:
-                partial_info = yaml.safe_load(yaml_file)
-                if partial_info is not None:
-                    job_info.update(partial_info)
+        yaml_names = self.simple_yamls if simple else self.yamls
+        job_info = self._cached(
+            'job:%s:%s' % (job_archive_dir, ','.join(yaml_names)),
+            [os.path.join(job_archive_dir, name) for name in yaml_names],
+            self._merge_yamls,
+        )
 
         if 'job_id' not in job_info:
             job_info['job_id'] = job_id
@@ -102,8 +173,8 @@ class ResultsSerializer(object):
         if simple:
             return job_info
 
-        log_path = os.path.join(job_archive_dir, 'teuthology.log')
-        if os.path.exists(log_path):
+        log_path = find_log(os.path.join(job_archive_dir, 'teuthology.log'))
+        if log_path is not None:
             mtime = int(os.path.getmtime(log_path))
             mtime_dt = datetime.fromtimestamp(mtime)
             job_info['updated'] = str(mtime_dt)
@@ -139,15 +210,21 @@ class ResultsSerializer(object):
         archive_dir = os.path.join(self.archive_base, run_name)
         if not os.path.isdir(archive_dir):
             return {}
-        jobs = {}
-        for item in os.listdir(archive_dir):
-            if not re.match('\d+$', item):
-                continue
-            job_id = item
-            job_dir = os.path.join(archive_dir, job_id)
-            if os.path.isdir(job_dir):
-                jobs[job_id] = job_dir
-        return jobs
+
+        def list_jobs(paths):
+            job_ids = []
+            for item in os.listdir(archive_dir):
+                if not re.match('\d+$', item):
+                    continue
+                if os.path.isdir(os.path.join(archive_dir, item)):
+                    job_ids.append(item)
+            self._forget_missing(archive_dir, job_ids)
+            return job_ids
+
+        job_ids = self._cached('jobs:%s' % archive_dir, [archive_dir],
+                               list_jobs)
+        return dict((job_id, os.path.join(archive_dir, job_id))
+                    for job_id in job_ids)
 
     def running_jobs_for_run(self, run_name):
         """
@@ -171,19 +248,39 @@ class ResultsSerializer(object):
         archive_base = self.archive_base
         if not os.path.isdir(archive_base):
             return []
-        runs = []
-        for run_name in os.listdir(archive_base):
-            if not os.path.isdir(os.path.join(archive_base, run_name)):
-                continue
-            runs.append(run_name)
-        return runs
+
+        def list_runs(paths):
+            runs = []
+            for run_name in os.listdir(archive_base):
+                if run_name == ArchiveIndex.dir_name:
+                    continue
+                if not os.path.isdir(os.path.join(archive_base, run_name)):
+                    continue
+                runs.append(run_name)
+            self._forget_missing(archive_base, runs)
+            return runs
+
+        return self._cached('runs:%s' % archive_base, [archive_base],
+                            list_runs)
 
 
 class ResultsReporter(object):
     last_run_file = 'last_successful_run'
+    reported_runs_file = 'reported_runs'
+    # How many jobs to send in each request to the bulk endpoint
+    bulk_size = 100
+    headers = {'content-type': 'application/json'}
 
     def __init__(self, archive_base=None, base_uri=None, save=False,
-                 refresh=False, log=None):
+                 refresh=False, log=None, concurrency=1, bulk=False):
+        """
+        :param concurrency: How many runs, and how many jobs of each run, to
+                            report at once. No more than this many requests
+                            are in flight at any time.
+        :param bulk:        Try reporting jobs via the results server's bulk
+                            endpoint first. If the server doesn't have one,
+                            jobs are reported one at a time.
+        """
         self.log = log or init_logging()
         self.archive_base = archive_base or config.archive_base
         self.base_uri = base_uri or config.results_server
@@ -193,6 +290,8 @@ class ResultsReporter(object):
         self.serializer = ResultsSerializer(archive_base, log=self.log)
         self.save_last_run = save
         self.refresh = refresh
+        self.concurrency = max(concurrency, 1)
+        self.bulk = bulk
         self.session = self._make_session()
 
         if not self.base_uri:
@@ -201,7 +300,13 @@ class ResultsReporter(object):
 
     def _make_session(self, max_retries=10):
         session = requests.Session()
-        adapter = requests.adapters.HTTPAdapter(max_retries=max_retries)
+        # pool_block makes greenlets wait for a free connection rather than
+        # opening more than self.concurrency of them
+        adapter = requests.adapters.HTTPAdapter(
+            max_retries=max_retries,
+            pool_maxsize=self.concurrency,
+            pool_block=True,
+        )
         session.mount('http://', adapter)
         return session
 
@@ -216,25 +321,43 @@ class ResultsReporter(object):
             runs = all_runs[next_index:]
         else:
             runs = all_runs
+        if self.save_last_run:
+            reported = self.reported_runs
+            if reported:
+                self.log.info("Skipping %s runs reported previously",
+                              len(reported))
+                runs = [run for run in runs if run not in reported]
         return self.report_runs(runs)
 
     def report_runs(self, run_names):
         """
-        Report several runs to the results server.
+        Report several runs to the results server, self.concurrency at a
+        time.
+
+        If saving progress, each run is recorded in self.reported_runs_file
+        as soon as it has been reported, so that an interrupted
+        report_all_runs() can pick up where it left off.
 
         :param run_names: The names of the runs.
         """
         num_runs = len(run_names)
         num_jobs = 0
         self.log.info("Posting %s runs", num_runs)
-        for run in run_names:
-            job_count = self.report_run(run)
-            num_jobs += job_count
-            if self.save_last_run:
-                self.last_run = run
+        with parallel(concurrency=self.concurrency, collect_all=True) as p:
+            for run in run_names:
+                p.spawn(self._report_run_and_save, run)
+            for job_count in p:
+                num_jobs += job_count
         del self.last_run
+        del self.reported_runs
         self.log.info("Total: %s jobs in %s runs", num_jobs, len(run_names))
 
+    def _report_run_and_save(self, run_name):
+        job_count = self.report_run(run_name)
+        if self.save_last_run:
+            self.add_reported_run(run_name)
+        return job_count
+
     def report_run(self, run_name, dead=False):
         """
         Report a single run to the results server.
@@ -264,11 +387,91 @@ class ResultsReporter(object):
         """
         Report several jobs to the results server.
 
+        If self.bulk is set, they are first sent in batches to the bulk
+        endpoint. Whatever isn't reported that way is reported one job at a
+        time, self.concurrency jobs at once.
+
         :param run_name: The name of the run.
         :param job_ids:  The jobs' ids
         """
-        for job_id in job_ids:
-            self.report_job(run_name, job_id, dead=dead)
+        job_ids = list(job_ids)
+        if self.bulk:
+            job_ids = self._report_jobs_bulk(run_name, job_ids, dead=dead)
+        with parallel(concurrency=self.concurrency, collect_all=True) as p:
+            for job_id in job_ids:
+                p.spawn(self.report_job, run_name, job_id, dead=dead)
+
+    def _report_jobs_bulk(self, run_name, job_ids, dead=False):
+        """
+        POST lists of up to self.bulk_size jobs to the results server's bulk
+        endpoint. If the server turns out not to have one, self.bulk is
+        cleared so it isn't tried again.
+
+        :param run_name: The name of the run. The run must already exist.
+        :param job_ids:  The jobs' ids
+        :returns:        The ids of the jobs that weren't reported
+        """
+        unreported = []
+        for i in range(0, len(job_ids), self.bulk_size):
+            chunk = job_ids[i:i + self.bulk_size]
+            if not self.bulk:
+                unreported.extend(chunk)
+                continue
+            jobs = [self._job_info(run_name, job_id, dead=dead)
+                    for job_id in chunk]
+            if not self._post_bulk(run_name, jobs):
+                unreported.extend(chunk)
+        return unreported
+
+    def _post_bulk(self, run_name, jobs):
+        """
+        POST a list of job info dicts to the results server's bulk endpoint,
+        clearing self.bulk if the server turns out not to have one
+
+        :returns: Whether the jobs were reported
+        """
+        uri = "{base}/runs/{name}/jobs/bulk/".format(
+            base=self.base_uri, name=run_name)
+        response = self.session.post(uri, data=json.dumps(jobs),
+                                     headers=self.headers)
+        if response.status_code == 200:
+            return True
+        if response.status_code in (404, 405, 501):
+            self.log.info(
+                "%s has no bulk endpoint; reporting jobs one at a time",
+                self.base_uri)
+            self.bulk = False
+        else:
+            self.log.warning(
+                "POST to %s failed with status %s; reporting those jobs "
+                "one at a time", uri, response.status_code)
+        return False
+
+    def report_jobs_info(self, run_name, jobs_info):
+        """
+        Report several jobs whose info is already known - rather than read
+        from the archive - e.g. to update their 'updated' times.
+
+        If self.bulk is set, they are sent in one request to the bulk
+        endpoint; otherwise, or if that fails, one job at a time.
+
+        :param run_name:  The name of the run. The run must already exist.
+        :param jobs_info: A list of the jobs' info dicts, each with a job_id
+        """
+        jobs_info = list(jobs_info)
+        if not jobs_info:
+            return
+        if self.bulk and self._post_bulk(run_name, jobs_info):
+            return
+        for job_info in jobs_info:
+            self.report_job(run_name, job_info['job_id'], job_info)
+
+    def _job_info(self, run_name, job_id, job_info=None, dead=False):
+        if job_info is None:
+            job_info = self.serializer.job_info(run_name, job_id)
+        if dead and get_status(job_info) is None:
+            set_status(job_info, 'dead')
+        return job_info
 
     def report_job(self, run_name, job_id, job_info=None, dead=False):
         """
@@ -283,12 +486,9 @@ class ResultsReporter(object):
             raise TypeError("job_info must be a dict")
         run_uri = "{base}/runs/{name}/jobs/".format(
             base=self.base_uri, name=run_name,)
-        if job_info is None:
-            job_info = self.serializer.job_info(run_name, job_id)
-        if dead and get_status(job_info) is None:
-            set_status(job_info, 'dead')
+        job_info = self._job_info(run_name, job_id, job_info, dead=dead)
         job_json = json.dumps(job_info)
-        headers = {'content-type': 'application/json'}
+        headers = self.headers
         response = self.session.post(run_uri, data=job_json, headers=headers)
 
         if response.status_code == 200:
@@ -345,6 +545,31 @@ class ResultsReporter(object):
         if os.path.exists(self.last_run_file):
             os.remove(self.last_run_file)
 
+    @property
+    def reported_runs(self):
+        """
+        The runs recorded by add_reported_run(), as a set.
+        """
+        if not os.path.exists(self.reported_runs_file):
+            return set()
+        with open(self.reported_runs_file) as f:
+            return set(line.strip() for line in f if line.strip())
+
+    @reported_runs.deleter
+    def reported_runs(self):
+        if os.path.exists(self.reported_runs_file):
+            os.remove(self.reported_runs_file)
+
+    def add_reported_run(self, run_name):
+        """
+        Record that a run has been reported, along with the others in
+        self.reported_runs_file.
+
+        :param run_name: The name of the run
+        """
+        with open(self.reported_runs_file, 'a') as f:
+            f.write(run_name + '\n')
+
     def get_jobs(self, run_name, job_id=None, fields=None):
         """
         Query the results server for jobs in a run
@@ -502,6 +727,271 @@ def try_push_job_info(job_config, extra_info=None):
                       config.results_server)
 
 
+def try_push_jobs_info(job_configs, extra_info=None, reporter=None):
+    """
+    Like try_push_job_info(), but for several jobs at once. A single
+    ResultsReporter - and so a single pooled HTTP session - is used for all of
+    them. A failure to push one job is logged and does not stop the others.
+
+    :param job_configs: A list of job config dicts to push
+    :param extra_info:  Optional dict to push along with each job
+    :param reporter:    Optional ResultsReporter to use, e.g. to keep using
+                        the same session across calls
+    """
+    log = init_logging()
+
+    if not config.results_server:
+        log.warning('No results_server in config; not reporting results')
+        return
+
+    if reporter is None:
+        reporter = ResultsReporter()
+    if not reporter.base_uri:
+        return
+
+    log.debug("Pushing info for %d jobs to %s", len(job_configs),
+              config.results_server)
+    for job_config in job_configs:
+        if job_config.get('job_id') is None:
+            log.warning('No job_id found; not reporting results')
+            continue
+        if extra_info is not None:
+            job_info = extra_info.copy()
+            job_info.update(job_config)
+        else:
+            job_info = job_config
+        try:
+            reporter.report_job(job_config['name'], job_config['job_id'],
+                                job_info)
+        except report_exceptions:
+            log.exception("Could not report results to %s",
+                          config.results_server)
+
+
+class HeartbeatAggregator(object):
+    """
+    Sends "still running" heartbeats for every job on this host - including
+    those run by other worker processes - to the results server together,
+    rather than once per job.
+
+    Each heartbeat is recorded as a small file in spool_dir. Whenever a
+    flush is due, whichever process records a heartbeat first takes the
+    spool's lock and sends all the recent ones, one request per run, over
+    its own persistent session. Flushes are due every interval seconds, less
+    a random jitter so that hosts don't all report at once while no flush is
+    due later than the next heartbeat; after failures the interval is doubled
+    each time, up to max_backoff times.
+
+    :param spool_dir:   Where heartbeats are recorded. Defaults to
+                        config.heartbeat_spool_dir.
+    :param interval:    How often to send heartbeats, in seconds. Defaults to
+                        config.watchdog_interval.
+    :param jitter:      How much to randomly vary the interval, as a fraction
+                        of it
+    :param max_backoff: The most the interval is multiplied by after
+                        failures
+    :param reporter:    The ResultsReporter to send heartbeats with. By
+                        default one is made when first needed.
+    """
+    lock_name = '.lock'
+    state_name = '.state'
+
+    def __init__(self, spool_dir=None, interval=None, jitter=0.1,
+                 max_backoff=8, reporter=None):
+        self.spool_dir = spool_dir or config.heartbeat_spool_dir
+        self.interval = interval or config.watchdog_interval
+        self.jitter = jitter
+        self.max_backoff = max_backoff
+        self.log = init_logging()
+        self._reporter = reporter
+
+    @property
+    def reporter(self):
+        if self._reporter is None:
+            self._reporter = ResultsReporter(log=self.log, bulk=True)
+        return self._reporter
+
+    def _path(self, job_info):
+        name = '%s.%s' % (job_info['name'], job_info['job_id'])
+        return os.path.join(self.spool_dir, name.replace('/', '_'))
+
+    def beat(self, jobs_info):
+        """
+        Record that jobs are still running, and send heartbeats if a flush is
+        due
+
+        :param jobs_info: A list of dicts, each with the 'name' of a job's
+                          run and its 'job_id'
+        """
+        if not os.path.isdir(self.spool_dir):
+            os.makedirs(self.spool_dir)
+        for job_info in jobs_info:
+            path = self._path(job_info)
+            tmp_path = os.path.join(
+                self.spool_dir, '.%s.%d' % (os.path.basename(path),
+                                            os.getpid()))
+            with open(tmp_path, 'w') as f:
+                json.dump(dict(name=job_info['name'],
+                               job_id=job_info['job_id']), f)
+            os.rename(tmp_path, path)
+        self.maybe_flush()
+
+    def end(self, job_info):
+        """
+        Stop sending heartbeats for a job
+        """
+        try:
+            os.remove(self._path(job_info))
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+
+    def maybe_flush(self):
+        """
+        Send heartbeats if a flush is due and no other process is already
+        sending them
+
+        :returns: Whether heartbeats were sent
+        """
+        with open(os.path.join(self.spool_dir, self.lock_name), 'a') as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except (IOError, OSError) as e:
+                if e.errno in (errno.EAGAIN, errno.EACCES):
+                    return False
+                raise
+            try:
+                state = self._read_state()
+                now = time.time()
+                if state is None:
+                    # The first heartbeats are sent an interval after the
+                    # first jobs start, as the watchdog's are
+                    self._write_state(now, failures=0)
+                    return False
+                if now < state['due']:
+                    return False
+                failures = 0 if self.flush() else state['failures'] + 1
+                self._write_state(time.time(), failures)
+                return True
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _read_state(self):
+        try:
+            with open(os.path.join(self.spool_dir, self.state_name)) as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+
+    def _write_state(self, now, failures):
+        backoff = min(2 ** failures, self.max_backoff)
+        due = now + self.interval * backoff * random.uniform(
+            1 - self.jitter, 1)
+        with open(os.path.join(self.spool_dir, self.state_name), 'w') as f:
+            json.dump(dict(due=due, failures=failures), f)
+
+    def pending(self):
+        """
+        Read the heartbeats recorded recently enough that their jobs are
+        presumably still running. Older ones - whose jobs' workers must have
+        died without ending them - are removed.
+
+        :returns: A dict mapping run names to lists of job info dicts
+        """
+        # Running jobs' heartbeats are recorded once per interval
+        oldest = time.time() - 2 * self.interval
+        by_run = defaultdict(list)
+        for name in os.listdir(self.spool_dir):
+            if name.startswith('.'):
+                continue
+            path = os.path.join(self.spool_dir, name)
+            try:
+                if os.path.getmtime(path) < oldest:
+                    os.remove(path)
+                    continue
+                with open(path) as f:
+                    job_info = json.load(f)
+            except (IOError, OSError, ValueError):
+                continue
+            by_run[job_info['name']].append(job_info)
+        return by_run
+
+    def flush(self):
+        """
+        Send the pending heartbeats, one request per run
+
+        :returns: Whether they were all sent
+        """
+        by_run = self.pending()
+        if not by_run:
+            return True
+        reporter = self.reporter
+        if not reporter.base_uri:
+            return True
+        self.log.debug("Sending heartbeats for %d jobs to %s",
+                       sum(len(jobs) for jobs in by_run.values()),
+                       reporter.base_uri)
+        ok = True
+        for run_name, jobs_info in by_run.items():
+            try:
+                reporter.report_jobs_info(run_name, jobs_info)
+            except report_exceptions:
+                self.log.exception("Could not send heartbeats to %s",
+                                   reporter.base_uri)
+                ok = False
+        return ok
+
+
+_heartbeats = None
+
+
+def get_heartbeat_aggregator():
+    """
+    :returns: This process's HeartbeatAggregator, so that its session is kept
+              open between heartbeats
+    """
+    global _heartbeats
+    if _heartbeats is None:
+        _heartbeats = HeartbeatAggregator()
+    return _heartbeats
+
+
+def try_push_heartbeats(jobs_info):
+    """
+    Record that jobs are still running, for a HeartbeatAggregator to update
+    their 'updated' times on the results server. Like try_push_job_info(),
+    this gracefully does nothing if config.results_server is not set, and
+    logs rather than raises errors.
+
+    :param jobs_info: A list of dicts, each with the 'name' of a job's run
+                      and its 'job_id'
+    """
+    log = init_logging()
+
+    if not config.results_server:
+        log.warning('No results_server in config; not reporting results')
+        return
+
+    try:
+        get_heartbeat_aggregator().beat(jobs_info)
+    except EnvironmentError:
+        log.exception("Could not send heartbeats")
+
+
+def try_end_heartbeat(job_info):
+    """
+    Stop sending heartbeats for a job, logging rather than raising errors
+
+    :param job_info: A dict with the 'name' of the job's run and its 'job_id'
+    """
+    if not config.results_server:
+        return
+    try:
+        get_heartbeat_aggregator().end(job_info)
+    except EnvironmentError:
+        init_logging().exception("Could not stop sending heartbeats")
+
+
 def try_delete_jobs(run_name, job_ids, delete_empty_run=True):
     """
     Using the same error checking and retry mechanism as try_push_job_info(),
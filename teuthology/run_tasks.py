@@ -74,6 +74,8 @@ def run_tasks(tasks, ctx):
         )
     else:
         timer = Timer()
+    # so that tasks can add their own data to timing.yaml
+    ctx.timer = timer
     stack = []
     try:
         for taskdict in tasks:
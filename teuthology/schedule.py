@@ -1,3 +1,4 @@
+import docopt
 import pprint
 import yaml
 
@@ -5,8 +6,65 @@ import teuthology.beanstalk
 from teuthology.misc import get_user, merge_configs
 from teuthology import report
 
+doc = """
+usage: teuthology-schedule -h
+       teuthology-schedule [options] --name <name> [--] [<conf_file> ...]
 
-def main(args):
+Schedule ceph integration tests
+
+positional arguments:
+  <conf_file>                          Config file to read
+
+optional arguments:
+  -h, --help                           Show this help message and exit
+  -v, --verbose                        Be more verbose
+  -n <name>, --name <name>             Name of suite run the job is part of
+  -d <desc>, --description <desc>      Job description
+  -o <owner>, --owner <owner>          Job owner
+  -w <worker>, --worker <worker>       Which worker to use (type of machine)
+                                       [default: plana]
+  -p <priority>, --priority <priority> Job priority (lower is sooner)
+                                       [default: 1000]
+  -N <num>, --num <num>                Number of times to run/queue the job
+                                       [default: 1]
+
+  --first-in-suite                     Mark the first job in a suite so suite
+                                       can note down the rerun-related info
+                                       [default: False]
+  --last-in-suite                      Mark the last job in a suite so suite
+                                       post-processing can be run
+                                       [default: False]
+  --email <email>                      Where to send the results of a suite.
+                                       Only applies to the last job in a suite.
+  --timeout <timeout>                  How many seconds to wait for jobs to
+                                       finish before emailing results. Only
+                                       applies to the last job in a suite.
+  --seed <seed>                        The random seed for rerunning the suite.
+                                       Only applies to the last job in a suite.
+  --subset <subset>                    The subset option passed to teuthology-suite.
+                                       Only applies to the last job in a suite.
+  --dry-run                            Instead of scheduling, just output the
+                                       job config.
+
+"""
+
+
+def parse_args(argv):
+    """
+    Parse teuthology-schedule's command line
+
+    :param argv: The arguments, without the command's name
+    :returns:    A docopt-style dict of arguments, as main() takes them
+    """
+    return docopt.docopt(doc, argv=argv)
+
+
+def main(args, scheduler=None):
+    """
+    :param args:      A docopt-style dict of teuthology-schedule arguments
+    :param scheduler: Optionally, a JobScheduler to queue the job with instead
+                      of opening a new beanstalk connection
+    """
     if not args['--first-in-suite']:
         first_job_args = ['subset', 'seed']
         for arg in first_job_args:
@@ -29,6 +87,8 @@ def main(args):
     job_config = build_config(args)
     if args['--dry-run']:
         pprint.pprint(job_config)
+    elif scheduler is not None:
+        scheduler.schedule(job_config, args['--num'])
     else:
         schedule_job(job_config, args['--num'])
 
@@ -82,19 +142,72 @@ def schedule_job(job_config, num=1):
     :param job_config: The complete job dict
     :param num:      The number of times to schedule the job
     """
-    num = int(num)
-    job = yaml.safe_dump(job_config)
-    tube = job_config.pop('tube')
-    beanstalk = teuthology.beanstalk.connect()
-    beanstalk.use(tube)
-    while num > 0:
-        jid = beanstalk.put(
-            job,
-            ttr=60 * 60 * 24,
-            priority=job_config['priority'],
-        )
-        print('Job scheduled with name {name} and ID {jid}'.format(
-            name=job_config['name'], jid=jid))
-        job_config['job_id'] = str(jid)
-        report.try_push_job_info(job_config, dict(status='queued'))
-        num -= 1
+    scheduler = JobScheduler()
+    try:
+        scheduler.schedule(job_config, num)
+    finally:
+        scheduler.close()
+
+
+class JobScheduler(object):
+    """
+    Schedule many jobs from a single process.
+
+    One beanstalk connection is opened on first use and reused for every job,
+    and each job's 'queued' status is pushed to the results server right
+    after the job is put in the queue, over a single session.
+    """
+    def __init__(self, connection=None):
+        self._connection = connection
+        self._tube = None
+        self._reporter = None
+
+    @property
+    def connection(self):
+        if self._connection is None:
+            self._connection = teuthology.beanstalk.connect()
+        return self._connection
+
+    @property
+    def reporter(self):
+        if self._reporter is None:
+            self._reporter = report.ResultsReporter()
+        return self._reporter
+
+    def schedule(self, job_config, num=1):
+        """
+        Put a job in the queue.
+
+        :param job_config: The complete job dict
+        :param num:        The number of times to schedule the job
+        :returns:          A list of the new job ids
+        """
+        num = int(num)
+        job = yaml.safe_dump(job_config)
+        tube = job_config.pop('tube')
+        if tube != self._tube:
+            self.connection.use(tube)
+            self._tube = tube
+        job_ids = list()
+        while num > 0:
+            jid = self.connection.put(
+                job,
+                ttr=60 * 60 * 24,
+                priority=job_config['priority'],
+            )
+            print('Job scheduled with name {name} and ID {jid}'.format(
+                name=job_config['name'], jid=jid))
+            job_config['job_id'] = str(jid)
+            # straight away, so that it can't overwrite the status of a
+            # worker that has already started the job
+            report.try_push_jobs_info([job_config], dict(status='queued'),
+                                      reporter=self.reporter)
+            job_ids.append(str(jid))
+            num -= 1
+        return job_ids
+
+    def close(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+            self._tube = None
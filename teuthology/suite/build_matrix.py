@@ -7,7 +7,8 @@ from teuthology.suite import matrix
 log = logging.getLogger(__name__)
 
 
-def build_matrix(path, subset=None, seed=None):
+def build_matrix(path, subset=None, seed=None, lazy=False,
+                 facet_filter=None, limit=None):
     """
     Return a list of items descibed by path such that if the list of
     items is chunked into mincyclicity pieces, each piece is still a
@@ -44,21 +45,44 @@ def build_matrix(path, subset=None, seed=None):
     component will appear as a file with braces listing the selection
     of chosen subitems.
 
+    If lazy is True, a Combinations object is returned instead of a list.
+    It has the same length and yields the same tuples, but generates them
+    one at a time as it is iterated over.
+
+    If a facet_filter is given, the parts of the suite it rules out are left
+    out of the matrix. The result is then the same set of items, less some
+    that the filter would have discarded, though not in the same order.
+    Since leaving out items changes which ones end up in each subset, which
+    random items get picked, and which items come first, the filter is
+    ignored when a subset or a limit is given, or when the suite has random
+    ('$') items.
+
     :param path:        The path to search for yaml fragments
     :param subset:	(index, outof)
     :param seed:        The seed for repeatable random test
+    :param lazy:        Generate items on demand rather than all up front
+    :param facet_filter: A teuthology.suite.util.FacetFilter
+    :param limit:       The number of items that will be used, if only the
+                        first few will
     """
     if subset:
         log.info(
             'Subset=%s/%s' %
             (str(subset[0]), str(subset[1]))
         )
-    random.seed(seed)
-    mat, first, matlimit = _get_matrix(path, subset)
-    return generate_combinations(path, mat, first, matlimit)
+        facet_filter = None
+    if limit:
+        # only the first items are used, so they must be the same ones
+        # that would come first without pruning
+        facet_filter = None
+    mat, first, matlimit = _get_matrix(path, subset, facet_filter)
+    combinations = Combinations(path, mat, first, matlimit, seed=seed)
+    if lazy:
+        return combinations
+    return list(combinations)
 
 
-def _get_matrix(path, subset=None):
+def _get_matrix(path, subset=None, facet_filter=None):
     mat = None
     first = None
     matlimit = None
@@ -72,18 +96,65 @@ def _get_matrix(path, subset=None):
             matlimit = (mat.size() // outof) * (index + 1)
     else:
         first = 0
-        mat = _build_matrix(path)
+        mat = None
+        if facet_filter is not None:
+            mat = _build_matrix(path, facet_filter=facet_filter)
+            if mat is _EXCLUDED:
+                log.info('No part of %s matches the filters', path)
+                return None, 0, 0
+            if mat is not None and not mat.deterministic():
+                log.debug('Not pruning %s, it has random items', path)
+                mat = None
+        if mat is None:
+            mat = _build_matrix(path)
         matlimit = mat.size()
     return mat, first, matlimit
 
 
-def _build_matrix(path, mincyclicity=0, item=''):
+# returned by _build_matrix() for the parts of a suite a FacetFilter rules out
+_EXCLUDED = object()
+
+
+def _build_matrix(path, mincyclicity=0, item='', facet_filter=None,
+                  top=True):
+    mat = _build_submatrix(path, mincyclicity, item, facet_filter, top)
+    if (top and facet_filter is not None and
+            mat is not None and mat is not _EXCLUDED and
+            not facet_filter.may_match(path, mat.names())):
+        return _EXCLUDED
+    return mat
+
+
+def _build_submatrices(path, files, mincyclicity, facet_filter, top):
+    """
+    Build the matrix for each of files in the directory path. Returns the
+    ones that aren't empty or excluded, and whether any were excluded.
+    """
+    submats = []
+    excluded = False
+    for fn in sorted(files):
+        submat = _build_matrix(
+            os.path.join(path, fn),
+            mincyclicity,
+            fn,
+            facet_filter,
+            top)
+        if submat is _EXCLUDED:
+            excluded = True
+        elif submat is not None:
+            submats.append(submat)
+    return submats, excluded
+
+
+def _build_submatrix(path, mincyclicity, item, facet_filter, top):
     if os.path.basename(path)[0] == '.':
         return None
     if not os.path.exists(path):
         raise IOError('%s does not exist (abs %s)' % (path, os.path.abspath(path)))
     if os.path.isfile(path):
         if path.endswith('.yaml'):
+            if facet_filter is not None and facet_filter.excludes(path):
+                return _EXCLUDED
             return matrix.Base(item)
         return None
     if os.path.isdir(path):
@@ -95,14 +166,10 @@ def _build_matrix(path, mincyclicity=0, item=''):
         if '+' in files:
             # concatenate items
             files.remove('+')
-            submats = []
-            for fn in sorted(files):
-                submat = _build_matrix(
-                    os.path.join(path, fn),
-                    mincyclicity,
-                    fn)
-                if submat is not None:
-                    submats.append(submat)
+            submats, excluded = _build_submatrices(
+                path, files, mincyclicity, facet_filter, False)
+            if excluded:
+                return _EXCLUDED
             return matrix.Concat(item, submats)
         elif path.endswith('$') or '$' in files:
             # pick a random item -- make sure we don't pick any magic files
@@ -110,26 +177,18 @@ def _build_matrix(path, mincyclicity=0, item=''):
                 files.remove('$')
             if '%' in files:
                 files.remove('%')
-            submats = []
-            for fn in sorted(files):
-                submat = _build_matrix(
-                    os.path.join(path, fn),
-                    mincyclicity,
-                    fn)
-                if submat is not None:
-                    submats.append(submat)
+            submats, excluded = _build_submatrices(
+                path, files, mincyclicity, facet_filter, False)
+            if excluded and not submats:
+                return _EXCLUDED
             return matrix.PickRandom(item, submats)
         elif '%' in files:
             # convolve items
             files.remove('%')
-            submats = []
-            for fn in sorted(files):
-                submat = _build_matrix(
-                    os.path.join(path, fn),
-                    mincyclicity=0,
-                    item=fn)
-                if submat is not None:
-                    submats.append(submat)
+            submats, excluded = _build_submatrices(
+                path, files, 0, facet_filter, False)
+            if excluded:
+                return _EXCLUDED
             mat = matrix.Product(item, submats)
             if mat and mat.cyclicity() < mincyclicity:
                 mat = matrix.Cycle(
@@ -138,20 +197,16 @@ def _build_matrix(path, mincyclicity=0, item=''):
             return mat
         else:
             # list items
-            submats = []
-            for fn in sorted(files):
-                submat = _build_matrix(
-                    os.path.join(path, fn),
-                    mincyclicity,
-                    fn)
-                if submat is None:
-                    continue
+            submats, excluded = _build_submatrices(
+                path, files, mincyclicity, facet_filter, top)
+            if excluded and not submats:
+                return _EXCLUDED
+            for i, submat in enumerate(submats):
                 if submat.cyclicity() < mincyclicity:
-                    submat = matrix.Cycle(
+                    submats[i] = matrix.Cycle(
                         ((mincyclicity + submat.cyclicity() - 1) //
                          submat.cyclicity()),
                         submat)
-                submats.append(submat)
             return matrix.Sum(item, submats)
     assert False, "Invalid path %s seen in _build_matrix" % path
     return None
@@ -181,13 +236,43 @@ def generate_combinations(path, mat, generate_from, generate_to):
     component will appear as a file with braces listing the selection
     of chosen subitems.
     """
-    ret = []
+    return list(iter_combinations(path, mat, generate_from, generate_to))
+
+
+def iter_combinations(path, mat, generate_from, generate_to):
+    """
+    Like generate_combinations(), but yield the items one at a time
+    """
     for i in range(generate_from, generate_to):
         output = mat.index(i)
-        ret.append((
+        yield (
             matrix.generate_desc(combine_path, output),
-            matrix.generate_paths(path, output, combine_path)))
-    return ret
+            matrix.generate_paths(path, output, combine_path))
+
+
+class Combinations(object):
+    """
+    The (description, [file list]) tuples for indices [generate_from,
+    generate_to) of mat, generated on demand.
+
+    Unlike a generator this may be iterated over more than once. The random
+    module is reseeded with seed at the start of each iteration, so every
+    iteration picks the same random ('$') items.
+    """
+    def __init__(self, path, mat, generate_from, generate_to, seed=None):
+        self.path = path
+        self.mat = mat
+        self.generate_from = generate_from
+        self.generate_to = generate_to
+        self.seed = seed
+
+    def __len__(self):
+        return max(self.generate_to - self.generate_from, 0)
+
+    def __iter__(self):
+        random.seed(self.seed)
+        return iter_combinations(
+            self.path, self.mat, self.generate_from, self.generate_to)
 
 
 def combine_path(left, right):
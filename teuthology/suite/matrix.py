@@ -1,6 +1,5 @@
 import os
 import random
-import heapq
 from fractions import gcd
 from functools import reduce
 
@@ -9,6 +8,21 @@ def lcm(a, b):
 def lcml(l):
     return reduce(lcm, l)
 
+
+class BoundedCache(dict):
+    """
+    A dict that empties itself once it holds more than limit entries, to
+    memoize results without letting memory grow with the size of a suite.
+    """
+    def __init__(self, limit=4096):
+        super(BoundedCache, self).__init__()
+        self.limit = limit
+
+    def __setitem__(self, key, value):
+        if len(self) >= self.limit:
+            self.clear()
+        super(BoundedCache, self).__setitem__(key, value)
+
 class Matrix:
     """
     Interface for sets
@@ -45,6 +59,20 @@ class Matrix:
         """
         return self.size() // self.minscanlen()
 
+    def deterministic(self):
+        """
+        True if index(i) always returns the same result for the same i,
+        i.e. there is no PickRandom below this Matrix. Only the results of
+        deterministic matrices may be cached.
+        """
+        return True
+
+    def names(self):
+        """
+        Yield the item of every matrix in this one (including itself)
+        """
+        yield self.item
+
     def tostr(self, depth):
         pass
 
@@ -72,6 +100,12 @@ class Cycle(Matrix):
     def minscanlen(self):
         return self.mat.minscanlen()
 
+    def deterministic(self):
+        return self.mat.deterministic()
+
+    def names(self):
+        return self.mat.names()
+
     def tostr(self, depth):
         return '\t'*depth + "Cycle({num}):\n".format(num=self.num) + self.mat.tostr(depth + 1)
 
@@ -121,6 +155,15 @@ class Product(Matrix):
         else:
             self._minscanlen += 1
 
+        self._deterministic = all(i.deterministic() for i in _submats)
+        self._cache = BoundedCache()
+
+    def names(self):
+        yield self.item
+        for i in self.submats:
+            for name in i[1].names():
+                yield name
+
     def tostr(self, depth):
         ret = '\t'*depth + "Product({item}):\n".format(item=self.item)
         return ret + ''.join([i[1].tostr(depth+1) for i in self.submats])
@@ -128,6 +171,9 @@ class Product(Matrix):
     def minscanlen(self):
         return self._minscanlen
 
+    def deterministic(self):
+        return self._deterministic
+
     def size(self):
         return self._size
 
@@ -171,8 +217,14 @@ class Product(Matrix):
         return combine(litems, combine(ritems))
 
     def index(self, i):
-        items = self._index(i, self.submats)
-        return (self.item, items)
+        if not self._deterministic:
+            return (self.item, self._index(i, self.submats))
+        i = i % self._size
+        ret = self._cache.get(i)
+        if ret is None:
+            ret = (self.item, self._index(i, self.submats))
+            self._cache[i] = ret
+        return ret
 
 class Concat(Matrix):
     """
@@ -181,6 +233,8 @@ class Concat(Matrix):
     def __init__(self, item, submats):
         self.submats = submats
         self.item = item
+        self._deterministic = all(i.deterministic() for i in submats)
+        self._result = None
 
     def size(self):
         return 1
@@ -188,13 +242,26 @@ class Concat(Matrix):
     def minscanlen(self):
         return 1
 
+    def deterministic(self):
+        return self._deterministic
+
     def index(self, i):
+        if self._result is not None:
+            return self._result
         out = frozenset()
         for submat in self.submats:
             for i in range(submat.size()):
                 out = out | frozenset([submat.index(i)])
+        if self._deterministic:
+            self._result = (self.item, out)
         return (self.item, out)
 
+    def names(self):
+        yield self.item
+        for i in self.submats:
+            for name in i.names():
+                yield name
+
     def tostr(self, depth):
         ret = '\t'*depth + "Concat({item}):\n".format(item=self.item)
         return ret + ''.join([i.tostr(depth+1) for i in self.submats])
@@ -213,12 +280,21 @@ class PickRandom(Matrix):
     def minscanlen(self):
         return 1
 
+    def deterministic(self):
+        return False
+
     def index(self, i):
         indx = random.randint(0, len(self.submats) - 1)
         submat = self.submats[indx]
         out = frozenset([submat.index(indx)])
         return (self.item, out)
 
+    def names(self):
+        yield self.item
+        for i in self.submats:
+            for name in i.names():
+                yield name
+
     def tostr(self, depth):
         ret = '\t'*depth + "PickRandom({item}):\n".format(item=self.item)
         return ret + ''.join([i.tostr(depth+1) for i in self.submats])
@@ -242,9 +318,13 @@ class Sum(Matrix):
     an offset (position in input list) and a multiple (pseudo_size / size)
     such that the psuedo_index for index i is <offset> + i*<multiple>.
 
-    I don't have a good way to map index to pseudo index, so we'll
-    precompute a mapping in the constructor (self._i_so_sis) from
-    index to (subset_index, subset).
+    Because every multiple is itself a multiple of the number of
+    subsequences, no two subsequences share a pseudo index, and the
+    subsequence a pseudo index belongs to is simply pseudo_index modulo the
+    number of subsequences.  To map index i onto a pseudo index we bisect
+    [0, pseudo_size) for the smallest pseudo index pi such that
+    pseudo_index_to_index(pi) == i, which takes O(n log(pseudo_size)) time
+    rather than precomputing an O(size) table.
     """
     def __init__(self, item, _submats):
         assert len(_submats) > 0, \
@@ -266,25 +346,33 @@ class Sum(Matrix):
 
             return submat.minscanlen() * multiple
 
-        def index_to_pindex_generator(submats):
-            assert len(submats) > 0, "submats must be non-empty"
-            h = []
-            for (offset, multiple), submat in submats:
-                heapq.heappush(h, (offset, 0, multiple, submat))
-            while True:
-                cur, si, multiple, submat = heapq.heappop(h)
-                heapq.heappush(
-                    h,
-                    (cur + multiple, si + 1, multiple, submat))
-                yield si, submat
-
-        self._i_to_sis = dict(
-            zip(range(self._size), index_to_pindex_generator(self._submats))
-        )
-
         self._minscanlen = self.pseudo_index_to_index(
             max(map(sm_to_pmsl, self._submats)))
 
+        self._deterministic = all(i.deterministic() for i in _submats)
+        self._cache = BoundedCache()
+
+    def index_to_pseudo_index(self, i):
+        """
+        The smallest pseudo index pi with pseudo_index_to_index(pi) == i
+        """
+        lo, hi = 0, self._pseudo_size - 1
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.pseudo_index_to_index(mid) < i:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def index_to_sis(self, i):
+        """
+        Map index i onto a tuple of (subset_index, subset)
+        """
+        pi = self.index_to_pseudo_index(i)
+        (offset, multiple), submat = self._submats[pi % len(self._submats)]
+        return (pi - offset) // multiple, submat
+
     def pi_to_sis(self, pi, offset_multiple):
         """
         offset_multiple tuple of offset and multiple
@@ -302,6 +390,12 @@ class Sum(Matrix):
         """
         return sum((self.pi_to_sis(pi, i) + 1 for i, _ in self._submats)) - 1
 
+    def names(self):
+        yield self.item
+        for i in self._submats:
+            for name in i[1].names():
+                yield name
+
     def tostr(self, depth):
         ret = '\t'*depth + "Sum({item}):\n".format(item=self.item)
         return ret + ''.join([i[1].tostr(depth+1) for i in self._submats])
@@ -312,19 +406,37 @@ class Sum(Matrix):
     def size(self):
         return self._size
 
+    def deterministic(self):
+        return self._deterministic
+
     def index(self, i):
-        si, submat = self._i_to_sis[i % self._size]
-        return (self.item, submat.index(si))
+        i = i % self._size
+        ret = self._cache.get(i)
+        if ret is None:
+            si, submat = self.index_to_sis(i)
+            ret = (self.item, submat.index(si))
+            if self._deterministic:
+                self._cache[i] = ret
+        return ret
+
+# Memoized results for the sub-results shared between many jobs
+_lists_cache = BoundedCache()
+_desc_cache = BoundedCache()
+_path_cache = BoundedCache()
+
 
 def generate_lists(result):
     """
     Generates a set of tuples representing paths to concatenate
     """
+    ret = _lists_cache.get(result)
+    if ret is not None:
+        return ret
     if isinstance(result, frozenset):
         ret = []
         for i in result:
             ret.extend(generate_lists(i))
-        return frozenset(ret)
+        ret = frozenset(ret)
     elif isinstance(result, tuple):
         ret = []
         (item, children) = result
@@ -332,28 +444,44 @@ def generate_lists(result):
             nf = [item]
             nf.extend(f)
             ret.append(tuple(nf))
-        return frozenset(ret)
+        ret = frozenset(ret)
     else:
-        return frozenset([(result,)])
+        ret = frozenset([(result,)])
+    _lists_cache[result] = ret
+    return ret
 
 
 def generate_paths(path, result, joinf=os.path.join):
     """
     Generates from the result set a list of sorted paths to concatenate
     """
-    return [reduce(joinf, i, path) for i in sorted(generate_lists(result))]
+    ret = []
+    for i in sorted(generate_lists(result)):
+        key = (path, i, joinf)
+        joined = _path_cache.get(key)
+        if joined is None:
+            joined = reduce(joinf, i, path)
+            _path_cache[key] = joined
+        ret.append(joined)
+    return ret
 
 
 def generate_desc(joinf, result):
     """
     Generates the text description of the test represented by result
     """
+    key = (joinf, result)
+    ret = _desc_cache.get(key)
+    if ret is not None:
+        return ret
     if isinstance(result, frozenset):
         ret = sorted([generate_desc(joinf, i) for i in result])
-        return '{' + ' '.join(ret) + '}'
+        ret = '{' + ' '.join(ret) + '}'
     elif isinstance(result, tuple):
         (item, children) = result
         cdesc = generate_desc(joinf, children)
-        return joinf(str(item), cdesc)
+        ret = joinf(str(item), cdesc)
     else:
-        return str(result)
+        ret = str(result)
+    _desc_cache[key] = ret
+    return ret
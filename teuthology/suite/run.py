@@ -4,18 +4,16 @@ import os
 import pwd
 import re
 import time
-import yaml
 
 from datetime import datetime
 from tempfile import NamedTemporaryFile
 
 from teuthology.config import config, JobConfig
-from teuthology.exceptions import (
-    BranchNotFoundError, CommitNotFoundError, VersionNotFoundError
-)
+from teuthology.exceptions import BranchNotFoundError, CommitNotFoundError
 from teuthology.misc import deep_merge, get_results_url
 from teuthology.orchestra.opsys import OS
-from teuthology.repo_utils import build_git_url
+from teuthology.repo_utils import build_git_url, ref_cache
+from teuthology.schedule import JobScheduler
 
 from teuthology.suite import util
 from teuthology.suite.build_matrix import combine_path, build_matrix
@@ -30,6 +28,7 @@ class Run(object):
     __slots__ = (
         'args', 'name', 'base_config', 'suite_repo_path', 'base_yaml_paths',
         'base_args', 'package_versions', 'kernel_dict', 'config_input',
+        'scheduler', 'fragment_cache',
     )
 
     def __init__(self, args):
@@ -38,6 +37,9 @@ class Run(object):
         """
         self.args = args
         self.name = self.make_run_name()
+        # branches may have been pushed just before scheduling; resolve them
+        # afresh, but only once for the whole run
+        ref_cache.since = time.time()
 
         if self.args.ceph_repo:
             config.ceph_git_url = self.args.ceph_repo
@@ -47,6 +49,10 @@ class Run(object):
         self.base_config = self.create_initial_config()
         # caches package versions to minimize requests to gbs
         self.package_versions = dict()
+        # queues every job of the run over a single beanstalk connection
+        self.scheduler = JobScheduler()
+        # parsed yaml fragments, shared by every job (and --newest backtrack)
+        self.fragment_cache = util.FragmentCache()
 
         if self.args.suite_dir:
             self.suite_repo_path = self.args.suite_dir
@@ -314,7 +320,8 @@ class Run(object):
             args=args,
             dry_run=self.args.dry_run,
             verbose=self.args.verbose,
-            log_prefix="Memo: ")
+            log_prefix="Memo: ",
+            scheduler=self.scheduler)
 
 
     def write_result(self):
@@ -328,7 +335,8 @@ class Run(object):
             args=arg,
             dry_run=self.args.dry_run,
             verbose=self.args.verbose,
-            log_prefix="Results: ")
+            log_prefix="Results: ",
+            scheduler=self.scheduler)
         results_url = get_results_url(self.base_config.name)
         if results_url:
             log.info("Test results viewable at %s", results_url)
@@ -349,15 +357,21 @@ class Run(object):
             if not os.path.exists(full_yaml_path):
                 raise IOError("File not found: " + full_yaml_path)
 
-        num_jobs = self.schedule_suite()
+        try:
+            num_jobs = self.schedule_suite()
 
-        if num_jobs:
-            self.write_result()
+            if num_jobs:
+                self.write_result()
+        finally:
+            self.scheduler.close()
 
     def collect_jobs(self, arch, configs, newest=False):
         jobs_to_schedule = []
         jobs_missing_packages = []
+        # (os_type, os_version, flavor) of each of jobs_to_schedule
+        job_distros = []
         for description, fragment_paths in configs:
+            description = combine_path(self.base_config.suite, description)
             base_frag_paths = [
                 util.strip_fragment_path(x) for x in fragment_paths
             ]
@@ -389,9 +403,7 @@ class Run(object):
                 if not is_collected:
                     continue
 
-            raw_yaml = '\n'.join([open(a, 'r').read() for a in fragment_paths])
-
-            parsed_yaml = yaml.safe_load(raw_yaml)
+            parsed_yaml = self.fragment_cache.merge(fragment_paths)
             os_type = parsed_yaml.get('os_type') or self.base_config.os_type
             os_version = parsed_yaml.get('os_version') or self.base_config.os_version
             exclude_arch = parsed_yaml.get('exclude_arch')
@@ -421,25 +433,27 @@ class Run(object):
                 args=arg
             )
 
-            sha1 = self.base_config.sha1
             if config.suite_verify_ceph_hash:
                 full_job_config = copy.deepcopy(self.base_config.to_dict())
                 deep_merge(full_job_config, parsed_yaml)
                 flavor = util.get_install_task_flavor(full_job_config)
-                # Get package versions for this sha1, os_type and flavor. If
-                # we've already retrieved them in a previous loop, they'll be
-                # present in package_versions and gitbuilder will not be asked
-                # again for them.
-                try:
-                    self.package_versions = util.get_package_versions(
-                        sha1,
-                        os_type,
-                        os_version,
-                        flavor,
-                        self.package_versions
-                    )
-                except VersionNotFoundError:
-                    pass
+                job_distros.append((os_type, os_version, flavor))
+
+            jobs_to_schedule.append(job)
+
+        if config.suite_verify_ceph_hash:
+            sha1 = self.base_config.sha1
+            # Get package versions for every distinct sha1, os_type and
+            # flavor at once. If we've already retrieved them in a previous
+            # loop, they'll be present in package_versions and gitbuilder
+            # will not be asked again for them.
+            self.package_versions = util.get_package_versions_for_distros(
+                sha1,
+                job_distros,
+                self.package_versions
+            )
+            for job, (os_type, os_version, flavor) in zip(
+                    jobs_to_schedule, job_distros):
                 if not util.has_packages_for_distro(
                     sha1, os_type, os_version, flavor, self.package_versions
                 ):
@@ -452,7 +466,6 @@ class Run(object):
                     if newest:
                         return jobs_missing_packages, None
 
-            jobs_to_schedule.append(job)
         return jobs_missing_packages, jobs_to_schedule
 
     def schedule_jobs(self, jobs_missing_packages, jobs_to_schedule, name):
@@ -478,6 +491,7 @@ class Run(object):
                 dry_run=self.args.dry_run,
                 verbose=self.args.verbose,
                 log_prefix=log_prefix,
+                scheduler=self.scheduler,
             )
             throttle = self.args.throttle
             if not self.args.dry_run and throttle:
@@ -498,10 +512,19 @@ class Run(object):
             self.base_config.suite.replace(':', '/'),
         ))
         log.debug('Suite %s in %s' % (suite_name, suite_path))
-        configs = [
-            (combine_path(suite_name, item[0]), item[1]) for item in
-            build_matrix(suite_path, subset=self.args.subset, seed=self.args.seed)
-        ]
+        facet_filter = None
+        if self.args.filter_in or self.args.filter_out:
+            facet_filter = util.FacetFilter(
+                filter_in=self.args.filter_in,
+                filter_out=self.args.filter_out,
+                suite_name=suite_name,
+            )
+        # generated lazily by collect_jobs(), so that --limit stops the
+        # enumeration and memory use doesn't grow with the size of the matrix
+        configs = build_matrix(suite_path, subset=self.args.subset,
+                               seed=self.args.seed, lazy=True,
+                               facet_filter=facet_filter,
+                               limit=self.args.limit)
         log.info('Suite %s in %s generated %d jobs (not yet filtered)' % (
             suite_name, suite_path, len(configs)))
 
@@ -1,12 +1,97 @@
+import heapq
 import os
 import random
 
+from fractions import gcd
+from functools import reduce
 from mock import patch, MagicMock
 
-from teuthology.suite import build_matrix
+from teuthology.suite import build_matrix, matrix
+from teuthology.suite.util import FacetFilter, strip_fragment_path
 from teuthology.test.fake_fs import make_fake_fstools
 
 
+# Sum index tables built by previous_index(); the Sum is kept alongside its
+# table so that its id isn't reused
+_previous_sums = dict()
+
+
+def previous_index(mat, i):
+    """
+    mat.index(i), computed the way teuthology did before matrix results were
+    memoized and Sum's index table was replaced, to check the two agree
+    """
+    if isinstance(mat, matrix.Base):
+        return mat.item
+    if isinstance(mat, matrix.Cycle):
+        return previous_index(mat.mat, i % mat.mat.size())
+    if isinstance(mat, matrix.Concat):
+        out = frozenset()
+        for submat in mat.submats:
+            for j in range(submat.size()):
+                out = out | frozenset([previous_index(submat, j)])
+        return (mat.item, out)
+    if isinstance(mat, matrix.PickRandom):
+        indx = random.randint(0, len(mat.submats) - 1)
+        return (mat.item,
+                frozenset([previous_index(mat.submats[indx], indx)]))
+    if isinstance(mat, matrix.Product):
+        def product_index(i, submats):
+            if len(submats) == 1:
+                return frozenset([previous_index(submats[0][1], i)])
+            rsize, lmat = submats[0]
+            lsize = lmat.size()
+            cycles = gcd(rsize, lsize)
+            off = (i // ((rsize * lsize) // cycles)) % cycles
+
+            def combine(r, s=frozenset()):
+                if isinstance(r, frozenset):
+                    return s | r
+                return s | frozenset([r])
+            litems = previous_index(lmat, (i - off) % lsize)
+            return combine(litems, combine(product_index(i, submats[1:])))
+        return (mat.item, product_index(i, mat.submats))
+    if isinstance(mat, matrix.Sum):
+        if id(mat) not in _previous_sums:
+            # merge the subsets' pseudo indices into an index table
+            h = []
+            for (offset, multiple), submat in mat._submats:
+                heapq.heappush(h, (offset, 0, multiple, id(submat), submat))
+            table = []
+            for _ in range(mat.size()):
+                cur, si, multiple, key, submat = heapq.heappop(h)
+                heapq.heappush(
+                    h, (cur + multiple, si + 1, multiple, key, submat))
+                table.append((si, submat))
+            _previous_sums[id(mat)] = (mat, table)
+        si, submat = _previous_sums[id(mat)][1][i % mat.size()]
+        return (mat.item, previous_index(submat, si))
+    assert False, "Unknown matrix %r" % mat
+
+
+def previous_desc(result):
+    if isinstance(result, frozenset):
+        return '{' + ' '.join(
+            sorted([previous_desc(i) for i in result])) + '}'
+    elif isinstance(result, tuple):
+        (item, children) = result
+        return build_matrix.combine_path(str(item), previous_desc(children))
+    return str(result)
+
+
+def previous_lists(result):
+    if isinstance(result, frozenset):
+        ret = []
+        for i in result:
+            ret.extend(previous_lists(i))
+        return frozenset(ret)
+    elif isinstance(result, tuple):
+        (item, children) = result
+        return frozenset(
+            tuple([item] + list(f)) for f in previous_lists(children))
+    return frozenset([(result,)])
+
+
 class TestBuildMatrixSimple(object):
     def test_combine_path(self):
         result = build_matrix.combine_path("/path/to/left", "right/side")
@@ -33,8 +118,10 @@ class TestBuildMatrix(object):
         for ppoint in self.__class__.patchpoints:
             self.mocks[ppoint] = MagicMock()
             self.patchers[ppoint] = patch(ppoint, self.mocks[ppoint])
+        self.fake_fss = []
 
     def start_patchers(self, fake_fs):
+        self.fake_fss.append(fake_fs)
         fake_fns = make_fake_fstools(fake_fs)
         # relies on fake_fns being in same order as patchpoints
         for ppoint, fn in zip(self.__class__.patchpoints, fake_fns):
@@ -48,6 +135,33 @@ class TestBuildMatrix(object):
 
     def teardown(self):
         self.stop_patchers()
+        # every suite a test used must expand just as it used to
+        for fake_fs in list(self.fake_fss):
+            self.start_patchers(fake_fs)
+            try:
+                for path, contents in fake_fs.items():
+                    if isinstance(contents, dict):
+                        self.check_previous_algorithm(path)
+            finally:
+                self.stop_patchers()
+
+    def check_previous_algorithm(self, path):
+        mat = build_matrix._build_matrix(path)
+        if mat is None:
+            return
+        for i in range(mat.size()):
+            random.seed(i)
+            result = mat.index(i)
+            random.seed(i)
+            expected = previous_index(mat, i)
+            assert result == expected
+            assert matrix.generate_desc(build_matrix.combine_path, result) \
+                == previous_desc(expected)
+            assert matrix.generate_paths(
+                path, result, build_matrix.combine_path) == [
+                    reduce(build_matrix.combine_path, f, path)
+                    for f in sorted(previous_lists(expected))]
+        _previous_sums.clear()
 
     def fragment_occurences(self, jobs, fragment):
         # What fraction of jobs contain fragment?
@@ -316,6 +430,62 @@ class TestBuildMatrix(object):
         result = build_matrix.build_matrix('d0_0')
         assert len(result) == 4
 
+    def test_lazy(self):
+        fake_fs = {
+            'd0_0': {
+                '%': None,
+                'd1_0': {
+                    'd1_0_0.yaml': None,
+                    'd1_0_1.yaml': None,
+                },
+                'd1_1': {
+                    'd1_1_0.yaml': None,
+                    'd1_1_1.yaml': None,
+                    'd1_1_2.yaml': None,
+                },
+                'd1_2': {
+                    '$': None,
+                    'd1_2_0.yaml': None,
+                    'd1_2_1.yaml': None,
+                    'd1_2_2.yaml': None,
+                },
+            },
+        }
+        self.start_patchers(fake_fs)
+        result = build_matrix.build_matrix('d0_0', seed=42)
+        lazy = build_matrix.build_matrix('d0_0', seed=42, lazy=True)
+        assert len(lazy) == len(result) == 6
+        assert list(lazy) == result
+        # iterating again makes the same random choices
+        assert list(lazy) == result
+        subset = build_matrix.build_matrix('d0_0', subset=(1, 2), seed=42)
+        lazy = build_matrix.build_matrix(
+            'd0_0', subset=(1, 2), seed=42, lazy=True)
+        assert len(lazy) == len(subset)
+        assert list(lazy) == subset
+
+    def test_lazy_stops_early(self):
+        fake_fs = {
+            'd0_0': {
+                '%': None,
+                'd1_0': {
+                    'd1_0_0.yaml': None,
+                    'd1_0_1.yaml': None,
+                },
+                'd1_1': {
+                    'd1_1_0.yaml': None,
+                    'd1_1_1.yaml': None,
+                },
+            },
+        }
+        self.start_patchers(fake_fs)
+        lazy = build_matrix.build_matrix('d0_0', lazy=True)
+        with patch.object(lazy.mat, 'index', wraps=lazy.mat.index) as m_index:
+            for i, item in enumerate(lazy):
+                if i == 1:
+                    break
+        assert m_index.call_count == 2
+
     def test_emulate_teuthology_noceph(self):
         fake_fs = {
             'teuthology': {
@@ -576,6 +746,123 @@ class TestBuildMatrix(object):
         assert fragments[0] == 'thrash/ceph/base.yaml'
         assert fragments[1] == 'thrash/ceph-thrash/default.yaml'
 
+    def test_facet_filter_out(self):
+        fake_fs = {
+            'rados': {
+                'basic': {
+                    '%': None,
+                    'objectstore': {
+                        'bluestore.yaml': None,
+                        'filestore.yaml': None,
+                    },
+                    'tasks': {
+                        'rados_api.yaml': None,
+                        'rados_bench.yaml': None,
+                    },
+                },
+                'singleton': {
+                    '+': None,
+                    'filestore.yaml': None,
+                    'mon.yaml': None,
+                },
+            },
+        }
+        self.start_patchers(fake_fs)
+        facet_filter = FacetFilter(filter_out=['filestore'])
+        result = build_matrix.build_matrix(
+            'rados', facet_filter=facet_filter)
+        assert len(result) == 2
+        for description, fragments in result:
+            assert 'filestore' not in description
+            assert 'rados/basic/objectstore/bluestore.yaml' in fragments
+
+    def test_facet_filter_in(self):
+        fake_fs = {
+            'rados': {
+                'basic': {
+                    '%': None,
+                    'objectstore': {
+                        'bluestore.yaml': None,
+                        'filestore.yaml': None,
+                    },
+                    'tasks': {
+                        'rados_api.yaml': None,
+                        'rados_bench.yaml': None,
+                    },
+                },
+                'thrash': {
+                    '%': None,
+                    'objectstore': {
+                        'filestore.yaml': None,
+                    },
+                    'thrashers': {
+                        'default.yaml': None,
+                        'pggrow.yaml': None,
+                    },
+                },
+            },
+        }
+        self.start_patchers(fake_fs)
+        facet_filter = FacetFilter(filter_in=['basic/{objectstore/blue'])
+        result = build_matrix.build_matrix(
+            'rados', facet_filter=facet_filter)
+        # only the facets within the product can't be ruled out
+        assert len(result) == 4
+        assert all(d.startswith('basic/') for d, _ in result)
+        facet_filter = FacetFilter(filter_in=['pggrow', 'rados_bench'])
+        result = build_matrix.build_matrix(
+            'rados', facet_filter=facet_filter)
+        assert len(result) == 6
+        facet_filter = FacetFilter(filter_in=['upgrade'])
+        result = build_matrix.build_matrix(
+            'rados', facet_filter=facet_filter)
+        assert result == []
+        # the suite name is part of every description
+        facet_filter = FacetFilter(filter_in=['rados:thrash'],
+                                   suite_name='rados:thrash')
+        result = build_matrix.build_matrix(
+            'rados', facet_filter=facet_filter)
+        assert len(result) == 6
+
+    def test_facet_filter_ignored(self):
+        fake_fs = {
+            'rados': {
+                'basic': {
+                    '%': None,
+                    'objectstore': {
+                        'bluestore.yaml': None,
+                        'filestore.yaml': None,
+                    },
+                    'tasks': {
+                        '$': None,
+                        'rados_api.yaml': None,
+                        'rados_bench.yaml': None,
+                    },
+                },
+                'thrash': {
+                    'default.yaml': None,
+                },
+            },
+        }
+        self.start_patchers(fake_fs)
+        facet_filter = FacetFilter(filter_out=['thrash'])
+        # random items would be picked differently
+        result = build_matrix.build_matrix(
+            'rados', seed=1, facet_filter=facet_filter)
+        assert result == build_matrix.build_matrix('rados', seed=1)
+        del fake_fs['rados']['basic']['tasks']['$']
+        # and subsets would be made up of different items
+        result = build_matrix.build_matrix(
+            'rados', subset=(1, 2), facet_filter=facet_filter)
+        assert result == build_matrix.build_matrix('rados', subset=(1, 2))
+        assert len(build_matrix.build_matrix(
+            'rados', facet_filter=facet_filter)) == 4
+        # and with --limit, different items would come first
+        result = build_matrix.build_matrix(
+            'rados', limit=2, facet_filter=facet_filter)
+        assert result == build_matrix.build_matrix('rados')
+
+
 class TestSubset(object):
     patchpoints = [
         'os.path.exists',
@@ -717,3 +1004,46 @@ class TestSubset(object):
             dlist, mat, first, matlimit = self.generate_description_list(tree, subset)
             self.verify_facets(tree, dlist, subset, mat, first, matlimit)
             self.stop_patchers()
+
+    @staticmethod
+    def filtered(description_list, filter_in, filter_out):
+        # the filtering done by Run.collect_jobs()
+        for description, fragment_paths in description_list:
+            paths = [strip_fragment_path(x) for x in fragment_paths]
+            if filter_in and not any(
+                    f in description or any(f in x for x in paths)
+                    for f in filter_in):
+                continue
+            if any(f in description or any(f in x for x in paths)
+                   for f in filter_out):
+                continue
+            yield description, fragment_paths
+
+    def test_facet_filter_random(self):
+        for i in range(2000):
+            tree = self.generate_fake_fs(
+                self.MAX_FACETS,
+                self.MAX_FANOUT,
+                self.MAX_DEPTH)
+            self.start_patchers(tree)
+            try:
+                jobs = build_matrix.build_matrix('root')
+                # filter on bits of the descriptions, including ones that
+                # span several names
+                names = set()
+                for description, _ in jobs:
+                    for start in range(len(description)):
+                        names.add(description[start:start + 6])
+                names = sorted(names)
+                filter_in = random.sample(
+                    names, min(len(names), random.choice(range(3))))
+                filter_out = random.sample(
+                    names, min(len(names), random.choice(range(2))))
+                facet_filter = FacetFilter(filter_in, filter_out)
+                pruned = build_matrix.build_matrix(
+                    'root', facet_filter=facet_filter)
+                expected = self.filtered(jobs, filter_in, filter_out)
+                assert sorted(self.filtered(
+                    pruned, filter_in, filter_out)) == sorted(expected)
+            finally:
+                self.stop_patchers()
@@ -1,3 +1,6 @@
+import heapq
+import random
+
 from teuthology.suite import matrix
 
 
@@ -12,6 +15,10 @@ def verify_matrix_output_diversity(res):
         assert sz == len(s)
 
 
+def join(left, right):
+    return '%s/%s' % (left, right)
+
+
 def mbs(num, l):
     return matrix.Sum(num*10, [matrix.Base(i + (100*num)) for i in l])
 
@@ -80,3 +87,65 @@ class TestMatrix(object):
                     mbs(2, range(2)),
                     mbs(4, range(9)),
                     ]))
+
+    def test_sum_index_matches_heap_order(self):
+        # The original implementation precomputed index -> (subset_index,
+        # subset) by merging the subsets' pseudo indices with a heap
+        def heap_order(sm):
+            h = []
+            for (offset, multiple), submat in sm._submats:
+                heapq.heappush(h, (offset, 0, multiple, id(submat), submat))
+            for _ in range(sm.size()):
+                cur, si, multiple, _, submat = heapq.heappop(h)
+                heapq.heappush(
+                    h, (cur + multiple, si + 1, multiple, id(submat), submat))
+                yield si, submat
+
+        for sizes in ([1], [6], [2, 3], [6, 3, 2, 9], [5, 7, 1, 12, 4, 4]):
+            sm = matrix.Sum(1, [mbs(i, range(n)) for i, n in enumerate(sizes)])
+            expected = list(heap_order(sm))
+            assert [sm.index_to_sis(i) for i in range(sm.size())] == expected
+
+    def test_cached_results_match(self):
+        def build():
+            return matrix.Product(1, [
+                mbs(1, range(6)),
+                matrix.Concat(2, [mbs(3, range(3)), mbs(4, range(2))]),
+                matrix.Sum(5, [
+                    mbs(6, range(4)),
+                    matrix.Product(7, [mbs(8, range(2)), mbs(9, range(5))]),
+                ]),
+            ])
+        cached = build()
+        descs = list()
+        for i in range(cached.size() * 2):
+            result = cached.index(i)
+            descs.append((matrix.generate_desc(join, result),
+                          matrix.generate_paths('root', result, join)))
+        assert cached.index(3) is cached.index(3)
+        # a fresh matrix, with the module caches emptied, agrees
+        for cache in (matrix._lists_cache, matrix._desc_cache,
+                      matrix._path_cache):
+            cache.clear()
+        fresh = build()
+        for i in range(fresh.size() * 2):
+            result = fresh.index(i)
+            assert descs[i] == (matrix.generate_desc(join, result),
+                                matrix.generate_paths('root', result, join))
+
+    def test_pick_random_not_cached(self):
+        mat = matrix.Concat(1, [
+            matrix.PickRandom(2, [mbs(3, range(5)), mbs(4, range(5))]),
+        ])
+        assert not mat.deterministic()
+        random.seed(0)
+        results = set(mat.index(0) for i in range(50))
+        assert len(results) > 1
+
+    def test_bounded_cache(self):
+        cache = matrix.BoundedCache(limit=2)
+        cache[1] = 1
+        cache[2] = 2
+        assert len(cache) == 2
+        cache[3] = 3
+        assert cache == {3: 3}
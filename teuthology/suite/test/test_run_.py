@@ -205,7 +205,7 @@ class TestScheduleSuite(object):
     @patch('teuthology.suite.run.Run.schedule_jobs')
     @patch('teuthology.suite.run.Run.write_rerun_memo')
     @patch('teuthology.suite.util.has_packages_for_distro')
-    @patch('teuthology.suite.util.get_package_versions')
+    @patch('teuthology.suite.util.get_package_versions_for_distros')
     @patch('teuthology.suite.util.get_install_task_flavor')
     @patch('teuthology.suite.run.open')
     @patch('teuthology.suite.run.build_matrix')
@@ -213,8 +213,12 @@ class TestScheduleSuite(object):
     @patch('teuthology.suite.util.package_version_for_hash')
     @patch('teuthology.suite.util.git_validate_sha1')
     @patch('teuthology.suite.util.get_arch')
+    @patch('teuthology.suite.util.open', create=True)
+    @patch('teuthology.suite.util.os.path.getmtime')
     def test_successful_schedule(
         self,
+        m_getmtime,
+        m_frag_open,
         m_get_arch,
         m_git_validate_sha1,
         m_package_version_for_hash,
@@ -222,7 +226,7 @@ class TestScheduleSuite(object):
         m_build_matrix,
         m_open,
         m_get_install_task_flavor,
-        m_get_package_versions,
+        m_get_package_versions_for_distros,
         m_has_packages_for_distro,
         m_write_rerun_memo,
         m_schedule_jobs,
@@ -239,13 +243,16 @@ class TestScheduleSuite(object):
         m_build_matrix.return_value = build_matrix_output
         frag1_read_output = 'field1: val1'
         frag2_read_output = 'field2: val2'
-        m_open.side_effect = [
+        m_getmtime.return_value = 0
+        m_frag_open.side_effect = [
             StringIO(frag1_read_output),
             StringIO(frag2_read_output),
+        ]
+        m_open.side_effect = [
             contextlib.closing(BytesIO())
         ]
         m_get_install_task_flavor.return_value = 'basic'
-        m_get_package_versions.return_value = dict()
+        m_get_package_versions_for_distros.return_value = dict()
         m_has_packages_for_distro.return_value = True
         # schedule_jobs() is just neutered; check calls below
 
@@ -255,6 +262,8 @@ class TestScheduleSuite(object):
         count = runobj.schedule_suite()
         assert(count == 1)
         assert runobj.base_config['suite_sha1'] == 'suite_hash'
+        m_get_package_versions_for_distros.assert_called_once_with(
+            'ceph_sha1', [('ubuntu', '14.04', 'basic')], {})
         m_has_packages_for_distro.assert_has_calls(
             [call('ceph_sha1', 'ubuntu', '14.04', 'basic', {})],
         )
@@ -281,7 +290,7 @@ class TestScheduleSuite(object):
     @patch('teuthology.suite.util.find_git_parent')
     @patch('teuthology.suite.run.Run.schedule_jobs')
     @patch('teuthology.suite.util.has_packages_for_distro')
-    @patch('teuthology.suite.util.get_package_versions')
+    @patch('teuthology.suite.util.get_package_versions_for_distros')
     @patch('teuthology.suite.util.get_install_task_flavor')
     @patch('teuthology.suite.run.open', create=True)
     @patch('teuthology.suite.run.build_matrix')
@@ -289,8 +298,12 @@ class TestScheduleSuite(object):
     @patch('teuthology.suite.util.package_version_for_hash')
     @patch('teuthology.suite.util.git_validate_sha1')
     @patch('teuthology.suite.util.get_arch')
+    @patch('teuthology.suite.util.open', create=True)
+    @patch('teuthology.suite.util.os.path.getmtime')
     def test_newest_failure(
         self,
+        m_getmtime,
+        m_frag_open,
         m_get_arch,
         m_git_validate_sha1,
         m_package_version_for_hash,
@@ -298,7 +311,7 @@ class TestScheduleSuite(object):
         m_build_matrix,
         m_open,
         m_get_install_task_flavor,
-        m_get_package_versions,
+        m_get_package_versions_for_distros,
         m_has_packages_for_distro,
         m_schedule_jobs,
         m_find_git_parent,
@@ -313,9 +326,10 @@ class TestScheduleSuite(object):
             (build_matrix_desc, build_matrix_frags),
         ]
         m_build_matrix.return_value = build_matrix_output
-        m_open.side_effect = [StringIO('field: val\n') for i in range(11)]
+        m_getmtime.return_value = 0
+        m_frag_open.side_effect = [StringIO('field: val\n')]
         m_get_install_task_flavor.return_value = 'basic'
-        m_get_package_versions.return_value = dict()
+        m_get_package_versions_for_distros.return_value = dict()
         m_has_packages_for_distro.side_effect = [
             False for i in range(11)
         ]
@@ -336,7 +350,7 @@ class TestScheduleSuite(object):
     @patch('teuthology.suite.run.Run.schedule_jobs')
     @patch('teuthology.suite.run.Run.write_rerun_memo')
     @patch('teuthology.suite.util.has_packages_for_distro')
-    @patch('teuthology.suite.util.get_package_versions')
+    @patch('teuthology.suite.util.get_package_versions_for_distros')
     @patch('teuthology.suite.util.get_install_task_flavor')
     @patch('teuthology.suite.run.open', create=True)
     @patch('teuthology.suite.run.build_matrix')
@@ -344,8 +358,12 @@ class TestScheduleSuite(object):
     @patch('teuthology.suite.util.package_version_for_hash')
     @patch('teuthology.suite.util.git_validate_sha1')
     @patch('teuthology.suite.util.get_arch')
+    @patch('teuthology.suite.util.open', create=True)
+    @patch('teuthology.suite.util.os.path.getmtime')
     def test_newest_success(
         self,
+        m_getmtime,
+        m_frag_open,
         m_get_arch,
         m_git_validate_sha1,
         m_package_version_for_hash,
@@ -353,7 +371,7 @@ class TestScheduleSuite(object):
         m_build_matrix,
         m_open,
         m_get_install_task_flavor,
-        m_get_package_versions,
+        m_get_package_versions_for_distros,
         m_has_packages_for_distro,
         m_write_rerun_memo,
         m_schedule_jobs,
@@ -372,13 +390,14 @@ class TestScheduleSuite(object):
             (build_matrix_desc, build_matrix_frags),
         ]
         m_build_matrix.return_value = build_matrix_output
+        m_getmtime.return_value = 0
+        # the fragment is only read once, however many times we backtrack
+        m_frag_open.side_effect = [StringIO('field: val\n')]
         m_open.side_effect = [
-            StringIO('field: val\n') for i in range(NUM_FAILS+1)
-        ] + [
             contextlib.closing(BytesIO())
-        ] 
+        ]
         m_get_install_task_flavor.return_value = 'basic'
-        m_get_package_versions.return_value = dict()
+        m_get_package_versions_for_distros.return_value = dict()
         # NUM_FAILS, then success
         m_has_packages_for_distro.side_effect = \
             [False for i in range(NUM_FAILS)] + [True]
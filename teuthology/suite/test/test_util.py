@@ -1,15 +1,26 @@
+import gevent
 import os
 import pytest
+import shutil
 import tempfile
+import yaml
 
 from copy import deepcopy
-from mock import Mock, patch
+from mock import Mock, call, patch
 
 from teuthology.config import config
+from teuthology.exceptions import VersionNotFoundError
 from teuthology.orchestra.opsys import OS
 from teuthology.suite import util
 
 
+@pytest.fixture(autouse=True)
+def ref_cache_path(tmpdir):
+    config.ref_cache_path = str(tmpdir.join('refs'))
+    yield
+    config.ref_cache_path = None
+
+
 REPO_PROJECTS_AND_URLS = [
     'ceph',
     'https://github.com/not_ceph/ceph.git',
@@ -145,6 +156,35 @@ class TestUtil(object):
         assert len(m_requests_get.mock_calls) == 2
         assert parent_sha1 == 'sha1_p'
 
+    @patch('teuthology.suite.util.subprocess.check_call')
+    def test_teuthology_schedule_in_process(self, m_check_call):
+        scheduler = Mock()
+        util.teuthology_schedule(
+            args=['--name', 'the_run', '--worker', 'smithi',
+                  '--priority', '50', '--num', '2', '--description', 'desc'],
+            verbose=0,
+            dry_run=False,
+            scheduler=scheduler,
+        )
+        m_check_call.assert_not_called()
+        job_config, num = scheduler.schedule.call_args[0]
+        assert num == '2'
+        assert job_config['name'] == 'the_run'
+        assert job_config['tube'] == 'smithi'
+        assert job_config['priority'] == 50
+        assert job_config['description'] == 'desc'
+
+    @patch('teuthology.suite.util.subprocess.check_call')
+    def test_teuthology_schedule_subprocess(self, m_check_call):
+        util.teuthology_schedule(
+            args=['--name', 'the_run'],
+            verbose=0,
+            dry_run=False,
+        )
+        args = m_check_call.call_args[1]['args']
+        assert args[0].endswith('teuthology-schedule')
+        assert args[1:] == ['--name', 'the_run']
+
 
 class TestFlavor(object):
 
@@ -272,6 +312,62 @@ class TestMissingPackages(object):
         expected = deepcopy(self.pv)
         assert result == expected
 
+    @patch("teuthology.suite.util.package_version_for_hash")
+    def test_package_versions_for_distros(self, m_package_versions_for_hash):
+        m_package_versions_for_hash.side_effect = \
+            lambda sha1, flavor, distro, distro_version: distro_version
+        distros = [
+            ('ubuntu', '14.04', 'basic'),
+            ('rhel', '7.0', 'basic'),
+            ('ubuntu', '16.04', 'basic'),
+            ('rhel', '7.0', 'basic'),
+        ]
+        result = util.get_package_versions_for_distros(
+            "sha1", distros, package_versions=self.pv)
+        expected = deepcopy(self.pv)
+        expected['sha1']['rhel'] = {'7.0': {'basic': '7.0'}}
+        expected['sha1']['ubuntu']['16.04'] = {'basic': '16.04'}
+        assert result == expected
+        # only what wasn't already known, and only once
+        assert m_package_versions_for_hash.call_count == 2
+        m_package_versions_for_hash.assert_has_calls([
+            call('sha1', 'basic', distro='rhel', distro_version='7.0'),
+            call('sha1', 'basic', distro='ubuntu', distro_version='16.04'),
+        ], any_order=True)
+
+    @patch("teuthology.suite.util.package_version_for_hash")
+    def test_package_versions_for_distros_concurrency(
+            self, m_package_versions_for_hash):
+        in_flight = []
+        max_in_flight = []
+
+        def lookup(sha1, flavor, distro, distro_version):
+            in_flight.append(distro_version)
+            max_in_flight.append(len(in_flight))
+            gevent.sleep(0.01)
+            in_flight.remove(distro_version)
+            return distro_version
+        m_package_versions_for_hash.side_effect = lookup
+        distros = [('ubuntu', str(i), 'basic') for i in range(5)]
+        result = util.get_package_versions_for_distros(
+            "sha1", distros, concurrency=2)
+        assert max(max_in_flight) == 2
+        assert result['sha1']['ubuntu'] == dict(
+            (str(i), {'basic': str(i)}) for i in range(5))
+
+    @patch("teuthology.suite.util.package_version_for_hash")
+    def test_package_versions_for_distros_not_found(
+            self, m_package_versions_for_hash):
+        m_package_versions_for_hash.side_effect = VersionNotFoundError('url')
+        distros = [('rhel', '7.0', 'basic')]
+        result = util.get_package_versions_for_distros("sha1", distros)
+        assert result == {'sha1': {'rhel': {'7.0': {'basic': None}}}}
+        assert not util.has_packages_for_distro(
+            "sha1", "rhel", "7.0", "basic", package_versions=result)
+        # not looked up again
+        util.get_package_versions_for_distros("sha1", distros, result)
+        assert m_package_versions_for_hash.call_count == 1
+
     def test_distro_has_packages(self):
         result = util.has_packages_for_distro(
             "sha1",
@@ -336,3 +432,88 @@ class TestDistroDefaults(object):
         expected = ('x86_64', 'centos7',
                     OS(name='centos', version='7', codename='core'))
         assert util.get_distro_defaults('rhel', 'magna') == expected
+
+
+class TestFragmentCache(object):
+    fragments = [
+        'overrides:\n  ceph:\n    conf: {}\ntasks:\n- install:\n',
+        '# a comment\nroles: [[mon.a, osd.0]]\n',
+        '',
+        'tasks:\n- ceph:\nos_type: ubuntu\n',
+        'anchored: &anchor\n  key: value\n',
+        'aliased: *anchor\n',
+        '---\nexplicit: document\n',
+        'parent:\n',
+        '  child: 2\n',
+        '- not\n- a mapping\n',
+    ]
+
+    def setup(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.paths = list()
+        for i, text in enumerate(self.fragments):
+            path = os.path.join(self.tmpdir, '%d.yaml' % i)
+            with open(path, 'w') as f:
+                f.write(text)
+            self.paths.append(path)
+
+    def teardown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def concatenated(self, paths):
+        return yaml.safe_load('\n'.join(open(p).read() for p in paths))
+
+    @pytest.mark.parametrize('indices', [
+        [0, 1, 2, 3],
+        [3, 0],
+        [2],
+        [4, 5],
+        [6],
+        [7, 8],
+    ])
+    def test_merge_matches_concatenation(self, indices):
+        paths = [self.paths[i] for i in indices]
+        cache = util.FragmentCache()
+        merged = cache.merge(paths)
+        expected = self.concatenated(paths)
+        assert merged == expected
+        # key order matters too, as it shows up in job configs
+        assert list(merged or []) == list(expected or [])
+
+    def test_merge_error(self):
+        cache = util.FragmentCache()
+        with pytest.raises(yaml.YAMLError):
+            cache.merge([self.paths[0], self.paths[6]])
+
+    def test_last_key_wins(self):
+        cache = util.FragmentCache()
+        merged = cache.merge(self.paths[:4])
+        assert merged['tasks'] == [{'ceph': None}]
+
+    def test_unmergeable(self):
+        cache = util.FragmentCache()
+        for i in (5, 6, 8, 9):
+            assert cache.load(self.paths[i])[1] is cache.UNMERGEABLE
+        assert cache.load(self.paths[2])[1] is None
+
+    def test_parses_once(self):
+        cache = util.FragmentCache()
+        with patch.object(util.yaml, 'safe_load',
+                          wraps=util.yaml.safe_load) as m_safe_load:
+            for i in range(10):
+                cache.merge(self.paths[:4])
+        assert m_safe_load.call_count == 4
+
+    def test_merged_is_a_copy(self):
+        cache = util.FragmentCache()
+        cache.merge(self.paths[:1])['overrides']['ceph']['conf']['x'] = 1
+        assert cache.merge(self.paths[:1])['overrides']['ceph']['conf'] == {}
+
+    def test_mtime_invalidates(self):
+        cache = util.FragmentCache()
+        assert cache.merge(self.paths[7:8]) == dict(parent=None)
+        with open(self.paths[7], 'w') as f:
+            f.write('parent: 2\n')
+        mtime = os.path.getmtime(self.paths[7]) + 10
+        os.utime(self.paths[7], (mtime, mtime))
+        assert cache.merge(self.paths[7:8]) == dict(parent=2)
@@ -1,21 +1,26 @@
 import copy
+import gevent.pool
 import logging
 import os
+import re
 import requests
 import smtplib
 import socket
 import subprocess
 import six
 import sys
+import yaml
 
 from email.mime.text import MIMEText
 
 import teuthology.lock.query
 import teuthology.lock.util
+import teuthology.schedule
 from teuthology import repo_utils
 
 from teuthology.config import config
-from teuthology.exceptions import BranchNotFoundError, ScheduleFailError
+from teuthology.exceptions import (BranchNotFoundError, ScheduleFailError,
+                                   VersionNotFoundError)
 from teuthology.misc import deep_merge
 from teuthology.repo_utils import fetch_qa_suite, fetch_teuthology
 from teuthology.orchestra.opsys import OS
@@ -31,8 +36,8 @@ def fetch_repos(branch, test_name):
     Fetch the suite repo (and also the teuthology repo) so that we can use it
     to build jobs. Repos are stored in ~/src/.
 
-    The reason the teuthology repo is also fetched is that currently we use
-    subprocess to call teuthology-schedule to schedule jobs so we need to make
+    The reason the teuthology repo is also fetched is that teuthology-schedule
+    may still be called via subprocess to schedule jobs so we need to make
     sure it is up-to-date. For that reason we always fetch the master branch
     for test scheduling, regardless of what teuthology branch is requested for
     testing.
@@ -300,6 +305,143 @@ def strip_fragment_path(original_path):
     return original_path
 
 
+class FacetFilter(object):
+    """
+    Decides which parts of a suite can't produce a job that would survive
+    --filter and --filter-out, so that build_matrix() can leave them out
+    instead of generating every job and discarding most of them.
+
+    It only ever rules out jobs that Run.collect_jobs() would drop anyway,
+    which still applies the filters to everything that's left.
+
+    A job is dropped by --filter-out if one of the strings appears in its
+    description or in one of its fragment paths; so every job using a
+    fragment whose (stripped) path contains one of them is dropped.
+
+    A job is kept by --filter if one of the strings appears in its
+    description or in one of its fragment paths. Both are made up of the
+    suite name and the names of the files and directories the job is built
+    from, separated by '/', ' ', '{' or '}'. So a string can only match if
+    each of its pieces between those separators is part of one of those
+    names. Only directories outside any '%', '+' or '$' directory are ruled
+    out this way, since the rest of a job's names come from other facets.
+    """
+    _separators_re = re.compile(r'[/ {}]+')
+
+    def __init__(self, filter_in=None, filter_out=None, suite_name=''):
+        """
+        :param filter_in:  The --filter strings
+        :param filter_out: The --filter-out strings
+        :param suite_name: The name the descriptions of the jobs start with
+        """
+        self.filter_in = filter_in or []
+        self.filter_out = filter_out or []
+        self.suite_name = suite_name
+        self._pieces = [
+            [piece for piece in self._separators_re.split(filt) if piece]
+            for filt in self.filter_in
+        ]
+
+    def excludes(self, path):
+        """
+        :param path: The path to a suite fragment
+        :returns:    True if every job using the fragment would be dropped
+        """
+        stripped = strip_fragment_path(path)
+        return any(filt in stripped for filt in self.filter_out)
+
+    def may_match(self, path, names):
+        """
+        :param path:  The path to a directory (or fragment) of the suite
+        :param names: The names of everything below path that jobs built
+                      from it may use
+        :returns:     False if no job built from path could be kept
+        """
+        if not self.filter_in:
+            return True
+        names = set(names)
+        names.update(strip_fragment_path(path).split('/'))
+        names.add(self.suite_name)
+        for pieces in self._pieces:
+            if all(any(piece in name for name in names) for piece in pieces):
+                return True
+        return False
+
+
+class FragmentCache(object):
+    """
+    Parsed suite YAML fragments, keyed by path and mtime, so that each
+    fragment is only parsed once no matter how many jobs include it.
+
+    Loading the concatenated text of several fragments gives the same result
+    as loading each fragment alone and updating a dict with them in order:
+    a top-level key that appears again later replaces the earlier value. A
+    fragment that can't be handled alone - one that doesn't parse on its own
+    (e.g. it uses an alias anchored in another fragment), whose top level
+    isn't a mapping, which contains YAML document markers, or which starts
+    indented - makes merge() fall back to parsing the concatenated text.
+    """
+    UNMERGEABLE = object()
+    _unsafe_re = re.compile(r'^(---|\.\.\.|%)', re.MULTILINE)
+
+    def __init__(self):
+        # path -> (mtime, text, parsed)
+        self._fragments = dict()
+
+    def load(self, path):
+        """
+        :param path: The path to a YAML fragment
+        :returns:    A tuple of the fragment's text and its parsed contents.
+                     The latter is FragmentCache.UNMERGEABLE if the fragment
+                     can't be merged on its own.
+        """
+        mtime = os.path.getmtime(path)
+        cached = self._fragments.get(path)
+        if cached is not None and cached[0] == mtime:
+            return cached[1:]
+        with open(path, 'r') as fragment:
+            text = fragment.read()
+        parsed = self._parse(text)
+        self._fragments[path] = (mtime, text, parsed)
+        return text, parsed
+
+    def _parse(self, text):
+        if self._unsafe_re.search(text):
+            return self.UNMERGEABLE
+        for line in text.splitlines():
+            if not line.strip() or line.lstrip().startswith('#'):
+                continue
+            if line[0].isspace():
+                return self.UNMERGEABLE
+            break
+        try:
+            parsed = yaml.safe_load(text)
+        except yaml.YAMLError:
+            return self.UNMERGEABLE
+        if parsed is not None and not isinstance(parsed, dict):
+            return self.UNMERGEABLE
+        return parsed
+
+    def merge(self, paths):
+        """
+        Equivalent to ``yaml.safe_load('\\n'.join(<text of each path>))``
+
+        :param paths: A list of paths to YAML fragments
+        :returns:     The merged contents; the caller is free to modify it
+        """
+        fragments = [self.load(path) for path in paths]
+        if any(parsed is self.UNMERGEABLE for _, parsed in fragments):
+            return yaml.safe_load('\n'.join(text for text, _ in fragments))
+        merged = None
+        for _, parsed in fragments:
+            if parsed is None:
+                continue
+            if merged is None:
+                merged = dict()
+            merged.update(parsed)
+        return copy.deepcopy(merged)
+
+
 def get_install_task_flavor(job_config):
     """
     Pokes through the install task's configuration (including its overrides) to
@@ -390,6 +532,62 @@ def get_package_versions(sha1, os_type, os_version, flavor,
     return package_versions
 
 
+def get_package_versions_for_distros(sha1, distros, package_versions=None,
+                                     concurrency=8):
+    """
+    Like get_package_versions(), but for several distros and flavors at
+    once. The ones not already in package_versions are looked up
+    concurrently, each only once.
+
+    A version that can't be found is recorded as None, so that it isn't
+    looked up again; has_packages_for_distro() returns False for it.
+
+    :param sha1:             The sha1 hash of the ceph version.
+    :param distros:          An iterable of (os_type, os_version, flavor)
+                             tuples
+    :param package_versions: Use this optionally to use cached results of
+                             previous calls to gitbuilder.
+    :param concurrency:      The maximum number of lookups in flight at once
+    :returns:                A dict of package versions, in the format
+                             described in get_package_versions()
+    """
+    if package_versions is None:
+        package_versions = dict()
+
+    def is_known(os_type, os_version, flavor):
+        return flavor in package_versions.get(sha1, dict()).get(
+            os_type, dict()).get(os_version, dict())
+
+    wanted = []
+    for os_type, os_version, flavor in distros:
+        distro = (str(os_type), os_version, flavor)
+        if distro not in wanted and not is_known(*distro):
+            wanted.append(distro)
+    if not wanted:
+        return package_versions
+
+    def lookup(distro):
+        os_type, os_version, flavor = distro
+        try:
+            return package_version_for_hash(
+                sha1,
+                flavor,
+                distro=os_type,
+                distro_version=os_version,
+            )
+        except VersionNotFoundError:
+            return None
+
+    log.info("Looking up packages for %d distro(s) of %s",
+             len(wanted), sha1)
+    pool = gevent.pool.Pool(concurrency)
+    for distro, version in zip(wanted, pool.map(lookup, wanted)):
+        os_type, os_version, flavor = distro
+        package_versions.setdefault(sha1, dict()).setdefault(
+            os_type, dict()).setdefault(os_version, dict())[flavor] = version
+    return package_versions
+
+
 def has_packages_for_distro(sha1, os_type, os_version, flavor,
                             package_versions=None):
     """
@@ -418,7 +616,8 @@ def has_packages_for_distro(sha1, os_type, os_version, flavor,
     return bool(flavors.get(flavor, None))
 
 
-def teuthology_schedule(args, verbose, dry_run, log_prefix=''):
+def teuthology_schedule(args, verbose, dry_run, log_prefix='',
+                        scheduler=None):
     """
     Run teuthology-schedule to schedule individual jobs.
 
@@ -427,6 +626,11 @@ def teuthology_schedule(args, verbose, dry_run, log_prefix=''):
 
     If --dry-run has been passed and --verbose has been passed multiple times,
     do both.
+
+    If a scheduler (a teuthology.schedule.JobScheduler) is passed, the
+    arguments are handled in-process exactly as teuthology-schedule would
+    handle them, and the job is queued using the scheduler's connection
+    instead of spawning a new process for it.
     """
     exec_path = os.path.join(
         os.path.dirname(sys.argv[0]),
@@ -446,7 +650,11 @@ def teuthology_schedule(args, verbose, dry_run, log_prefix=''):
             ' '.join(printable_args),
         ))
     if not dry_run or (dry_run and verbose > 1):
-        subprocess.check_call(args=args)
+        if scheduler is None:
+            subprocess.check_call(args=args)
+        else:
+            schedule_args = teuthology.schedule.parse_args(args[1:])
+            teuthology.schedule.main(schedule_args, scheduler=scheduler)
 
 
 def find_git_parent(project, sha1):
@@ -18,6 +18,7 @@ from teuthology.config import config as teuth_config
 from teuthology.exceptions import VersionNotFoundError
 from teuthology.job_status import get_status, set_status
 from teuthology.orchestra import cluster, remote, run
+from teuthology.parallel import parallel
 
 log = logging.getLogger(__name__)
 
@@ -328,6 +329,37 @@ def fetch_binaries_for_coredumps(path, remote):
             remote.get_file(debug_path, coredump_path)
 
 
+def pull_archive(remote, archive_dir, logdir):
+    """
+    Transfer a remote's archive directory into logdir, along with the
+    binaries needed to make sense of any coredumps in it.
+
+    The archive_max_bytes_per_host and archive_timeout_per_host settings
+    bound how much of it is transferred.
+
+    :returns: (remote.shortname, dict of transfer statistics)
+    """
+    path = os.path.join(logdir, remote.shortname)
+    start = time.time()
+    nbytes = misc.pull_directory(
+        remote, archive_dir, path,
+        max_bytes=teuth_config.archive_max_bytes_per_host,
+        timeout=teuth_config.archive_timeout_per_host,
+        compress_level=teuth_config.archive_compress_level,
+    )
+    # Check for coredumps and pull binaries
+    fetch_binaries_for_coredumps(path, remote)
+    seconds = time.time() - start
+    stats = dict(
+        bytes=nbytes,
+        seconds=round(seconds, 3),
+        bytes_per_second=int(nbytes / seconds) if seconds else None,
+    )
+    log.info('Transferred %d bytes from %s in %.1f seconds',
+             nbytes, remote.shortname, seconds)
+    return remote.shortname, stats
+
+
 @contextlib.contextmanager
 def archive(ctx, config):
     """
@@ -356,11 +388,17 @@ def archive(ctx, config):
             logdir = os.path.join(ctx.archive, 'remote')
             if (not os.path.exists(logdir)):
                 os.mkdir(logdir)
-            for rem in ctx.cluster.remotes.keys():
-                path = os.path.join(logdir, rem.shortname)
-                misc.pull_directory(rem, archive_dir, path)
-                # Check for coredumps and pull binaries
-                fetch_binaries_for_coredumps(path, rem)
+            transfers = dict()
+            with parallel(
+                    concurrency=teuth_config.archive_concurrency,
+                    collect_all=True) as p:
+                for rem in ctx.cluster.remotes.keys():
+                    p.spawn(pull_archive, rem, archive_dir, logdir)
+                for shortname, stats in p:
+                    transfers[shortname] = stats
+            timer = getattr(ctx, 'timer', None)
+            if timer is not None:
+                timer.add_data('archive_transfers', transfers)
 
         log.info('Removing archive directory...')
         run.wait(
@@ -395,7 +433,7 @@ def sudo(ctx, config):
         yield
     finally:
         log.info('Restoring {0}...'.format(sudoers_file))
-        ctx.cluster.run(
+        ctx.cluster.run_parallel(
             args="sudo mv -f {path}{ext} {path}".format(
                 path=sudoers_file, ext=backup_ext
             )
@@ -6,6 +6,7 @@ import yaml
 import teuthology.lock.ops
 import teuthology.lock.query
 import teuthology.lock.util
+import teuthology.lock.wait
 from teuthology import misc
 from teuthology import provision
 from teuthology import report
@@ -42,20 +43,48 @@ def lock_machines(ctx, config):
     # change the status during the locking process
     report.try_push_job_info(ctx.config, dict(status='waiting'))
 
+    # How long to hold on to some of the machines while waiting for the rest
+    partial_lock_hold = teuth_config.partial_lock_hold
+    waiter = teuthology.lock.wait.MachineWaiter(machine_type)
+
     all_locked = dict()
     requested = total_requested
+    partial_since = None
+    released_since = None
     while True:
+        if partial_since is not None and \
+                time.time() - partial_since > partial_lock_hold:
+            log.info('Could not lock the rest of the machines in %ss; '
+                     'unlocking %s and starting over',
+                     partial_lock_hold, len(all_locked))
+            for machine in all_locked:
+                teuthology.lock.ops.unlock_one(ctx, machine, ctx.owner,
+                                               ctx.archive)
+            all_locked = dict()
+            requested = total_requested
+            partial_since = None
+            # Give the machines to other waiting jobs: don't lock a partial
+            # set again for a while, and let them react before looking
+            released_since = time.time()
+            waiter.reset()
+            waiter.wait()
+            continue
+        if released_since is not None and \
+                time.time() - released_since > partial_lock_hold:
+            released_since = None
+
         # get a candidate list of machines
         machines = teuthology.lock.query.list_locks(machine_type=machine_type, up=True,
                                                     locked=False, count=requested + reserved)
         if machines is None:
             if ctx.block:
                 log.error('Error listing machines, trying again')
-                time.sleep(20)
+                waiter.wait()
                 continue
             else:
                 raise RuntimeError('Error listing machines')
 
+        to_lock = requested
         # make sure there are machines for non-automated jobs to run
         if len(machines) < reserved + requested and ctx.owner.startswith('scheduled'):
             if ctx.block:
@@ -66,14 +95,20 @@ def lock_machines(ctx, config):
                     requested,
                     len(machines),
                 )
-                time.sleep(10)
-                continue
+                if partial_lock_hold and released_since is None and \
+                        len(machines) > reserved:
+                    # lock what we can and keep it while waiting for more
+                    to_lock = len(machines) - reserved
+                else:
+                    waiter.wait()
+                    continue
             else:
                 assert 0, ('not enough machines free; need %s + %s, have %s' %
                            (reserved, requested, len(machines)))
 
+        partial = to_lock < requested
         try:
-            newly_locked = teuthology.lock.ops.lock_many(ctx, requested, machine_type,
+            newly_locked = teuthology.lock.ops.lock_many(ctx, to_lock, machine_type,
                                                          ctx.owner, ctx.archive, os_type,
                                                          os_version, arch)
         except Exception:
@@ -99,27 +134,41 @@ def lock_machines(ctx, config):
                 log.info('Waiting for virtual machines to come up')
                 keys_dict = dict()
                 loopcount = 0
-                while len(keys_dict) != len(vmlist):
+                while True:
+                    # keys_dict is keyed by hostname without the user
+                    pending = [
+                        guest for guest in vmlist
+                        if misc.canonicalize_hostname(guest, user=None)
+                        not in keys_dict
+                    ]
+                    if not pending:
+                        break
                     loopcount += 1
                     time.sleep(10)
-                    keys_dict = misc.ssh_keyscan(vmlist)
+                    # only scan the machines that haven't come up yet
+                    keys_dict.update(misc.ssh_keyscan(pending, _raise=False))
                     log.info('virtual machine is still unavailable')
                     if loopcount == 40:
                         loopcount = 0
                         log.info('virtual machine(s) still not up, ' +
                                  'recreating unresponsive ones.')
-                        for guest in vmlist:
-                            if guest not in keys_dict.keys():
+                        for guest in pending:
+                            if misc.canonicalize_hostname(guest, user=None) \
+                                    not in keys_dict:
                                 log.info('recreating: ' + guest)
                                 full_name = misc.canonicalize_hostname(guest)
                                 provision.destroy_if_vm(ctx, full_name)
                                 provision.create_if_vm(ctx, full_name)
                 if teuthology.lock.ops.do_update_keys(keys_dict)[0]:
                     log.info("Error in virtual machine keys")
+                statuses = teuthology.lock.query.get_statuses(
+                    all_locked.keys())
+                keys = dict((status['name'], status['ssh_pub_key'])
+                            for status in statuses)
                 newscandict = {}
                 for dkey in all_locked.keys():
-                    stats = teuthology.lock.query.get_status(dkey)
-                    newscandict[dkey] = stats['ssh_pub_key']
+                    name = misc.canonicalize_hostname(dkey, user=None)
+                    newscandict[dkey] = keys[name]
                 ctx.config['targets'] = newscandict
             else:
                 ctx.config['targets'] = all_locked
@@ -137,13 +186,17 @@ def lock_machines(ctx, config):
             requested = requested - len(newly_locked)
             assert requested > 0, "lock_machines: requested counter went" \
                                   "negative, this shouldn't happen"
+            if newly_locked:
+                waiter.reset()
+                if partial and partial_since is None:
+                    partial_since = time.time()
 
         log.info(
             "{total} machines locked ({new} new); need {more} more".format(
                 total=len(all_locked), new=len(newly_locked), more=requested)
         )
         log.warn('Could not lock enough machines, waiting...')
-        time.sleep(10)
+        waiter.wait()
     try:
         yield
     finally:
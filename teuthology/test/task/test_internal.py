@@ -1,3 +1,5 @@
+from mock import Mock, patch
+
 from teuthology.config import FakeNamespace
 from teuthology.task import internal
 
@@ -55,3 +57,149 @@ class TestInternal(object):
         assert internal.buildpackages_prep(self.ctx,
                                            self.ctx.config) == internal.BUILDPACKAGES_REMOVED
         assert self.ctx.config == {'tasks': []}
+
+    @patch('teuthology.task.internal.fetch_binaries_for_coredumps')
+    @patch('teuthology.task.internal.misc.pull_directory')
+    def test_pull_archive(self, m_pull_directory, m_fetch_binaries):
+        m_pull_directory.return_value = 1024
+        rem = Mock(shortname='host')
+        shortname, stats = internal.pull_archive(rem, '/archive', '/logs')
+        assert shortname == 'host'
+        assert stats['bytes'] == 1024
+        m_pull_directory.assert_called_once_with(
+            rem, '/archive', '/logs/host',
+            max_bytes=None, timeout=None, compress_level=None)
+        m_fetch_binaries.assert_called_once_with('/logs/host', rem)
+
+
+class TestLockMachines(object):
+    def setup(self):
+        self.ctx = FakeNamespace()
+        self.ctx.config = dict()
+        self.ctx.summary = dict()
+        self.ctx.owner = 'scheduled_user@host'
+        self.ctx.archive = None
+        self.ctx.block = True
+        self.patchers = dict(
+            config=patch.multiple(
+                'teuthology.task.internal.lock_machines.teuth_config',
+                reserve_machines=0, partial_lock_hold=600,
+            ),
+            waiter=patch('teuthology.lock.wait.MachineWaiter'),
+            report=patch('teuthology.task.internal.lock_machines.report'),
+            list_locks=patch('teuthology.lock.query.list_locks'),
+            lock_many=patch('teuthology.lock.ops.lock_many'),
+            unlock_one=patch('teuthology.lock.ops.unlock_one'),
+            is_vm=patch('teuthology.lock.query.is_vm', return_value=False),
+        )
+        self.mocks = dict()
+        for name, patcher in self.patchers.items():
+            self.mocks[name] = patcher.start()
+
+    def teardown(self):
+        for patcher in self.patchers.values():
+            patcher.stop()
+
+    def machines(self, *numbers):
+        return dict(('ubuntu@smithi%03d.example.com' % i, 'key')
+                    for i in numbers)
+
+    def lock(self):
+        from teuthology.task.internal.lock_machines import lock_machines
+        with lock_machines(self.ctx, [3, 'smithi']):
+            pass
+
+    def test_partial(self):
+        self.mocks['list_locks'].side_effect = [[{}], [{}, {}]]
+        self.mocks['lock_many'].side_effect = [
+            self.machines(1), self.machines(2, 3)]
+        self.lock()
+        assert [c[0][1] for c in self.mocks['lock_many'].call_args_list] == \
+            [1, 2]
+        assert self.ctx.config['targets'] == self.machines(1, 2, 3)
+        assert not self.mocks['unlock_one'].called
+        waiter = self.mocks['waiter'].return_value
+        assert waiter.reset.call_count == 1
+        assert waiter.wait.call_count == 1
+
+    def test_partial_disabled(self):
+        self.patchers['config'].stop()
+        self.patchers['config'] = patch.multiple(
+            'teuthology.task.internal.lock_machines.teuth_config',
+            reserve_machines=0, partial_lock_hold=0,
+        )
+        self.patchers['config'].start()
+        self.mocks['list_locks'].side_effect = [[{}], [{}, {}, {}]]
+        self.mocks['lock_many'].return_value = self.machines(1, 2, 3)
+        self.lock()
+        assert self.mocks['lock_many'].call_count == 1
+        assert self.mocks['waiter'].return_value.wait.call_count == 1
+
+    @patch('teuthology.task.internal.lock_machines.time.time')
+    def test_partial_released(self, m_time):
+        # a lock server with only smithi001 free at first
+        free = ['ubuntu@smithi001.example.com']
+        competitor = []
+        events = []
+
+        def list_locks(machine_type, up, locked, count):
+            return [dict(name=name) for name in free[:count]]
+
+        def lock_many(ctx, num, machine_type, user, description, os_type,
+                      os_version, arch):
+            locked = free[:num]
+            del free[:num]
+            events.append(('lock', locked))
+            return dict((name, 'key') for name in locked)
+
+        def unlock_one(ctx, name, user, description):
+            events.append(('unlock', name))
+            free.append(name)
+
+        # the partial set is locked at 0, and held too long by the time
+        # the first wait for the rest is over
+        now = [0]
+        m_time.side_effect = lambda: now[0]
+
+        def wait():
+            events.append(('wait',))
+            assert len(events) < 20, "smithi001 was never given up"
+            if now[0] == 0:
+                now[0] = 1000
+            elif 'ubuntu@smithi001.example.com' in free:
+                # another job that was waiting takes the released machine,
+                # and then three others are freed
+                competitor.append(free.pop(0))
+                free.extend(self.machines(2, 3, 4))
+        self.mocks['waiter'].return_value.wait.side_effect = wait
+        self.mocks['list_locks'].side_effect = list_locks
+        self.mocks['lock_many'].side_effect = lock_many
+        self.mocks['unlock_one'].side_effect = unlock_one
+        self.lock()
+        assert competitor == ['ubuntu@smithi001.example.com']
+        assert events == [
+            ('lock', ['ubuntu@smithi001.example.com']),
+            ('wait',),
+            ('unlock', 'ubuntu@smithi001.example.com'),
+            ('wait',),
+            ('lock', sorted(self.machines(2, 3, 4))),
+        ]
+        assert self.ctx.config['targets'] == self.machines(2, 3, 4)
+
+    @patch('teuthology.task.internal.lock_machines.time.time')
+    def test_partial_not_relocked(self, m_time):
+        # after releasing a partial set, only a full one is locked until
+        # another hold period has passed
+        now = [0]
+        m_time.side_effect = lambda: now[0]
+
+        def wait():
+            now[0] += 400
+        self.mocks['waiter'].return_value.wait.side_effect = wait
+        self.mocks['list_locks'].side_effect = [
+            [{}], [], [{}], [{}, {}, {}]]
+        self.mocks['lock_many'].side_effect = [
+            self.machines(1), self.machines(1, 2, 3)]
+        self.lock()
+        assert [c[0][1] for c in self.mocks['lock_many'].call_args_list] == \
+            [1, 3]
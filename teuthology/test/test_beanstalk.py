@@ -0,0 +1,140 @@
+from mock import Mock, patch
+
+from teuthology import beanstalk
+from teuthology import kill
+
+
+class FakeConnection(object):
+    """
+    Stands in for a beanstalkc.Connection to a server holding jobs, a dict
+    mapping job ids to (tube, state, priority, body)
+    """
+    def __init__(self, jobs):
+        self.jobs = jobs
+        self.host = 'localhost'
+        self.port = 11300
+        self.reserve = Mock()
+
+    def stats(self):
+        stats = {'total-jobs': max(self.jobs)}
+        for state in ('ready', 'reserved', 'delayed', 'buried'):
+            stats['current-jobs-%s' % state] = len(
+                [job for job in self.jobs.values() if job[1] == state])
+        return stats
+
+    def stats_tube(self, tube):
+        return {'current-jobs-ready': len(
+            [job for job in self.jobs.values()
+             if job[0] == tube and job[1] == 'ready'])}
+
+    def peek(self, job_id):
+        if job_id not in self.jobs:
+            return None
+        (tube, state, pri, body) = self.jobs[job_id]
+        job = Mock(body=body)
+        job.stats.return_value = dict(id=job_id, tube=tube, state=state,
+                                      pri=pri)
+        return job
+
+    def delete(self, job_id):
+        del self.jobs[job_id]
+
+    def close(self):
+        pass
+
+
+class TestBeanstalk(object):
+    def setup(self):
+        self.connection = FakeConnection({
+            1: ('tube', 'ready', 100, 'name: run1\ndescription: desc'),
+            2: ('other', 'ready', 100, 'name: run2\ndescription: desc'),
+            3: ('tube', 'reserved', 100, 'name: run1\ndescription: desc'),
+            4: ('tube', 'ready', 10, 'name: run2\ndescription: desc'),
+            5: ('tube', 'ready', 100, 'name: run1\ndescription: desc'),
+        })
+        self.patcher = patch('beanstalkc.Connection',
+                             return_value=self.connection)
+        self.patcher.start()
+
+    def teardown(self):
+        self.patcher.stop()
+
+    def test_peek_ready_jobs(self):
+        jobs = beanstalk.peek_ready_jobs(self.connection, 'tube',
+                                         batch_size=2)
+        # in the order workers would reserve them
+        assert [job_id for (job_id, _, _) in jobs] == [4, 1, 5]
+        assert [config['name'] for (_, config, _) in jobs] == \
+            ['run2', 'run1', 'run1']
+        assert not self.connection.reserve.called
+
+    def test_peek_ready_jobs_ids_past_total(self):
+        self.connection.jobs[7] = ('tube', 'ready', 100, 'name: run3\ndescription: desc')
+        self.connection.stats = Mock(return_value={
+            'total-jobs': 5, 'current-jobs-ready': 5,
+            'current-jobs-reserved': 1, 'current-jobs-delayed': 0,
+            'current-jobs-buried': 0,
+        })
+        jobs = beanstalk.peek_ready_jobs(self.connection, 'tube',
+                                         batch_size=2)
+        assert [job_id for (job_id, _, _) in jobs] == [4, 1, 5, 7]
+
+    def test_peek_ready_jobs_job_count(self):
+        # more ready jobs than asked for: the ones returned must be those
+        # workers will reserve next, not the newest
+        for job_id in range(6, 20):
+            self.connection.jobs[job_id] = \
+                ('tube', 'ready', 100, 'name: new\ndescription: desc')
+        jobs = beanstalk.peek_ready_jobs(self.connection, 'tube',
+                                         job_count=3, batch_size=2)
+        assert [job_id for (job_id, _, _) in jobs] == [4, 1, 5]
+
+    def test_peek_ready_jobs_max_ids(self):
+        # one old ready job far below the rest
+        self.connection.jobs = {
+            1: ('tube', 'ready', 100, 'name: old\ndescription: desc'),
+        }
+        for job_id in range(10000, 10005):
+            self.connection.jobs[job_id] = \
+                ('tube', 'ready', 100, 'name: new\ndescription: desc')
+        self.connection.peek = Mock(side_effect=self.connection.peek)
+        jobs = beanstalk.peek_ready_jobs(self.connection, 'tube',
+                                         batch_size=10, max_ids=100)
+        assert [job_id for (job_id, _, _) in jobs] == list(range(10000, 10005))
+        # the ids past total-jobs, and no more than max_ids below it
+        assert self.connection.peek.call_count == 10 + 100
+        jobs = beanstalk.peek_ready_jobs(self.connection, 'tube',
+                                         batch_size=1000, max_ids=20000)
+        assert [job_id for (job_id, _, _) in jobs][0] == 1
+
+    def test_parse_job_body_cached(self):
+        with patch('teuthology.beanstalk.yaml.safe_load') as m_safe_load:
+            m_safe_load.return_value = dict(name='run')
+            beanstalk.parse_job_body(100, 'name: run')
+            beanstalk.parse_job_body(100, 'name: run')
+            assert m_safe_load.call_count == 1
+
+    @patch('teuthology.kill.beanstalk.watch_tube', return_value='tube')
+    @patch('teuthology.kill.config')
+    def test_remove_beanstalk_jobs(self, m_config, m_watch_tube):
+        m_config.queue_host = 'localhost'
+        m_config.queue_port = 11300
+        with patch('teuthology.kill.beanstalk.connect',
+                   return_value=self.connection):
+            kill.remove_beanstalk_jobs('run1', 'tube')
+        # including the last one
+        assert sorted(self.connection.jobs) == [2, 3, 4]
+
+    @patch('teuthology.kill.beanstalk.watch_tube', return_value='tube')
+    @patch('teuthology.kill.config')
+    def test_remove_beanstalk_jobs_old(self, m_config, m_watch_tube):
+        m_config.queue_host = 'localhost'
+        m_config.queue_port = 11300
+        # the run's job is far below the newest id
+        newest = 120000
+        self.connection.jobs[newest] = \
+            ('tube', 'ready', 100, 'name: run2\ndescription: desc')
+        with patch('teuthology.kill.beanstalk.connect',
+                   return_value=self.connection):
+            kill.remove_beanstalk_jobs('run1', 'tube')
+        assert sorted(self.connection.jobs) == [2, 3, 4, newest]
@@ -0,0 +1,61 @@
+import gzip
+import os
+import subprocess
+
+from distutils.spawn import find_executable
+
+import pytest
+
+from teuthology.util import logs
+
+
+class TestLogs(object):
+    lines = ['line %d' % i for i in range(5000)]
+
+    def write_log(self, tmpdir, compress=None, tail=False):
+        path = str(tmpdir.join('teuthology.log'))
+        with open(path, 'w') as f:
+            f.write('\n'.join(self.lines) + '\n')
+        if tail:
+            logs.write_tail(path)
+        if compress == 'gzip':
+            with open(path, 'rb') as src, gzip.open(path + '.gz', 'wb') as f:
+                f.write(src.read())
+            os.remove(path)
+        elif compress == 'zstd':
+            subprocess.check_call(['zstd', '-q', '--rm', path])
+        return path
+
+    def test_find_log(self, tmpdir):
+        path = self.write_log(tmpdir, compress='gzip')
+        assert logs.find_log(path) == path + '.gz'
+        assert logs.find_log(str(tmpdir.join('missing.log'))) is None
+
+    def test_tail_log_plain(self, tmpdir):
+        path = self.write_log(tmpdir)
+        assert logs.tail_log(path, lines=1) == ['line 4999']
+        assert logs.tail_log(path, lines=3000) == self.lines[-3000:]
+        assert logs.tail_log(path, lines=10000) == self.lines
+
+    def test_tail_log_gzip(self, tmpdir):
+        path = self.write_log(tmpdir, compress='gzip')
+        assert logs.tail_log(path, lines=2) == self.lines[-2:]
+
+    def test_tail_log_sidecar(self, tmpdir):
+        path = self.write_log(tmpdir, compress='gzip', tail=True)
+        # the tail file is read rather than the compressed log
+        with open(path + logs.TAIL_SUFFIX, 'a') as f:
+            f.write('from the tail file\n')
+        assert logs.tail_log(path, lines=1) == ['from the tail file']
+        assert logs.tail_log(path, lines=200) == self.lines[-200:]
+
+    @pytest.mark.skipif(not find_executable('zstd'),
+                        reason="zstd is not installed")
+    def test_grep_log_zstd(self, tmpdir):
+        path = self.write_log(tmpdir, compress='zstd')
+        assert list(logs.grep_log(path, r'^line 49\d\d$'))[:2] == \
+            ['line 4900', 'line 4901']
+
+    def test_grep_log_missing(self, tmpdir):
+        with pytest.raises(IOError):
+            list(logs.grep_log(str(tmpdir.join('missing.log')), 'x'))
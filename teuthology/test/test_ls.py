@@ -31,6 +31,23 @@ class TestLs(object):
         with pytest.raises(IOError):
             ls.ls("some/archive/dir", True)
 
+    def test_ls_indexed(self, tmpdir, capsys):
+        run_dir = tmpdir.join('run')
+        for job_id in ('1', '2'):
+            summary = run_dir.join(job_id, 'summary.yaml')
+            summary.write('success: true\nowner: me\nduration: 5\n',
+                          ensure=True)
+            summary.setmtime(0)
+        run_dir.mkdir('other')
+        ls.ls(str(run_dir), False)
+        first = capsys.readouterr().out
+        assert first.splitlines() == ['1 pass me - 5s', '2 pass me - 5s']
+        # the second time, the summaries come from the index
+        with patch("yaml.safe_load_all") as m_safe_load_all:
+            ls.ls(str(run_dir), False)
+            assert not m_safe_load_all.called
+        assert capsys.readouterr().out == first
+
     @patch("teuthology.ls.open")
     @patch("os.popen")
     @patch("os.path.isdir")
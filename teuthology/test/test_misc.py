@@ -1,10 +1,14 @@
 import argparse
+import io
+import os
+import tarfile
 from datetime import datetime
 
 from mock import Mock, patch
 from teuthology.orchestra import cluster
 from teuthology.config import config
 from teuthology import misc
+from teuthology.exceptions import CommandFailedError
 import subprocess
 
 import pytest
@@ -293,6 +297,74 @@ class TestHostnames(object):
         assert result == 'box1'
 
 
+class TestSshKeyscan(object):
+    hosts = ['box%d.example.com' % i for i in range(5)]
+
+    def setup(self):
+        config._conf = dict(lab_domain='example.com')
+        self.calls = []
+        self.up = set(self.hosts)
+        self.patcher = patch.object(misc.subprocess, 'Popen',
+                                    side_effect=self.popen)
+        self.patcher.start()
+        self.sleep_patcher = patch('teuthology.contextutil.time.sleep')
+        self.sleep_patcher.start()
+
+    def teardown(self):
+        self.sleep_patcher.stop()
+        self.patcher.stop()
+        config.load()
+
+    def popen(self, args, stdout, stderr):
+        hosts = args[5:]
+        self.calls.append(hosts)
+        out = ''.join('%s ssh-rsa key-%s\n' % (host, host)
+                      for host in hosts if host in self.up)
+        err = ''.join('# %s:22 SSH-2.0-OpenSSH\n' % host for host in hosts)
+        return Mock(communicate=Mock(return_value=(out.encode(),
+                                                   err.encode())))
+
+    def test_one_process(self):
+        keys = misc.ssh_keyscan(self.hosts)
+        assert keys == dict((host, 'ssh-rsa key-' + host)
+                            for host in self.hosts)
+        assert self.calls == [self.hosts]
+
+    def test_batches(self):
+        keys = misc._ssh_keyscan_many(self.hosts, batch_size=2)
+        assert len(keys) == 5
+        assert self.calls == [self.hosts[:2], self.hosts[2:4],
+                              self.hosts[4:]]
+
+    def test_retries_only_missing(self):
+        self.up.discard(self.hosts[3])
+
+        def bring_up(*args):
+            self.up.add(self.hosts[3])
+        with patch('teuthology.contextutil.time.sleep',
+                   side_effect=bring_up):
+            keys = misc.ssh_keyscan(['ubuntu@' + host for host in self.hosts])
+        assert len(keys) == 5
+        assert self.calls == [self.hosts, [self.hosts[3]]]
+
+    def test_partial(self):
+        self.up.discard(self.hosts[0])
+        keys = misc.ssh_keyscan(dict.fromkeys(self.hosts).keys(),
+                                _raise=False)
+        assert sorted(keys) == self.hosts[1:]
+        assert len(self.calls) == 1
+
+    def test_single(self):
+        assert misc._ssh_keyscan(self.hosts[0]) == 'ssh-rsa key-' + \
+            self.hosts[0]
+        self.up.clear()
+        assert misc._ssh_keyscan(self.hosts[0]) is None
+
+    def test_string(self):
+        with pytest.raises(TypeError):
+            misc.ssh_keyscan(self.hosts[0])
+
+
 class TestMergeConfigs(object):
     """ Tests merge_config and deep_merge in teuthology.misc """
 
@@ -366,3 +438,43 @@ class TestIsInDict(object):
 
     def test_nonmembership_with_presence_at_lower_level(self):
         assert not misc.is_in_dict('a', 'foo', {'a':{'a': 'foo'}})
+
+
+class TestPullDirectory(object):
+    def make_remote(self, files):
+        buf = io.BytesIO()
+        with tarfile.open(mode='w:gz', fileobj=buf) as tar:
+            for name, data in files:
+                ti = tarfile.TarInfo(name)
+                ti.size = len(data)
+                tar.addfile(ti, io.BytesIO(data))
+        buf.seek(0)
+        rem = Mock(shortname='host')
+        rem.get_tar_stream.return_value.stdout = Mock(read=buf.read)
+        return rem
+
+    def test_pull_directory(self, tmpdir):
+        rem = self.make_remote([('./a', b'aaa'), ('./sub/b', b'bb')])
+        dest = str(tmpdir.join('dest'))
+        assert misc.pull_directory(rem, '/archive', dest) == 5
+        rem.get_tar_stream.assert_called_once_with(
+            '/archive', sudo=True, compress_level=None)
+        with open(os.path.join(dest, 'sub', 'b'), 'rb') as f:
+            assert f.read() == b'bb'
+        rem.get_tar_stream.return_value.wait.assert_called_once_with()
+
+    def test_pull_directory_tar_fails(self, tmpdir):
+        rem = self.make_remote([('./a', b'aaa')])
+        rem.get_tar_stream.return_value.wait.side_effect = \
+            CommandFailedError('tar', 2)
+        dest = str(tmpdir.join('dest'))
+        with pytest.raises(CommandFailedError):
+            misc.pull_directory(rem, '/archive', dest)
+
+    def test_pull_directory_max_bytes(self, tmpdir):
+        rem = self.make_remote([('./a', b'aaa'), ('./b', b'bb')])
+        dest = str(tmpdir.join('dest'))
+        assert misc.pull_directory(rem, '/archive', dest, max_bytes=4) == 3
+        assert os.listdir(dest) == ['a']
+        rem.get_tar_stream.return_value.stdout.channel.close.\
+            assert_called_once_with()
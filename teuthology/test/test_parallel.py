@@ -1,3 +1,7 @@
+import gevent
+import pytest
+
+from teuthology.exceptions import ParallelTimeoutError
 from teuthology.parallel import parallel
 
 
@@ -26,3 +30,87 @@ class TestParallel(object):
             for result in para:
                 in_set.remove(result)
 
+
+    def test_concurrency(self):
+        running = set()
+        most_running = []
+
+        def work(item):
+            running.add(item)
+            most_running.append(len(running))
+            gevent.sleep(0.01)
+            running.remove(item)
+            return item
+
+        with parallel(concurrency=3) as para:
+            for i in range(10):
+                para.spawn(work, i)
+            assert sorted(para) == list(range(10))
+        assert max(most_running) == 3
+
+    def test_ordered(self):
+        def work(item):
+            gevent.sleep(0.001 * (10 - item))
+            return item
+
+        with parallel(ordered=True) as para:
+            for i in range(10):
+                para.spawn(work, i)
+            assert list(para) == list(range(10))
+
+    def test_timeout(self):
+        with pytest.raises(ParallelTimeoutError):
+            with parallel(timeout=0.01) as para:
+                para.spawn(gevent.sleep, 0)
+                para.spawn(gevent.sleep, 10)
+
+    def test_fail_fast(self):
+        finished = []
+
+        def work(item):
+            gevent.sleep(0.01 * item)
+            if item == 1:
+                raise RuntimeError(item)
+            finished.append(item)
+
+        with pytest.raises(RuntimeError):
+            with parallel(fail_fast=True) as para:
+                for i in range(5):
+                    para.spawn(work, i)
+        gevent.sleep(0.1)
+        assert finished == [0]
+
+    def test_fail_fast_spawn(self):
+        def fail():
+            raise RuntimeError()
+
+        with pytest.raises(RuntimeError):
+            with parallel(concurrency=1, fail_fast=True) as para:
+                para.spawn(fail)
+                para.spawn(identity, 1)
+                para.spawn(identity, 2)
+
+    def test_collect_all(self):
+        def work(item):
+            if item % 2:
+                raise RuntimeError(item)
+            return item
+
+        results = []
+        with pytest.raises(RuntimeError) as exc:
+            with parallel(collect_all=True) as para:
+                for i in range(6):
+                    para.spawn(work, i)
+                for result in para:
+                    results.append(result)
+        assert str(exc.value) == '1'
+        assert sorted(results) == [0, 2, 4]
+
+    def test_results_while_spawning(self):
+        # results that come in before everything has been spawned must not
+        # end the iteration early
+        with parallel(concurrency=1) as para:
+            for i in range(5):
+                para.spawn(identity, i)
+                gevent.sleep(0)
+            assert sorted(para) == list(range(5))
@@ -0,0 +1,121 @@
+import pytest
+import subprocess
+
+from mock import patch, Mock
+
+from teuthology import prefetch
+from teuthology.config import config
+from teuthology.exceptions import BranchNotFoundError
+from teuthology.repo_utils import bootstrap_teuthology
+from teuthology.test.test_beanstalk import FakeConnection
+
+
+class TestPrefetch(object):
+    def setup(self):
+        config.teuthology_path = None
+        config.ceph_git_base_url = 'https://git.example.com/'
+
+    def teardown(self):
+        config.load()
+
+    def queue(self, *job_configs):
+        return [(i, job_config, Mock())
+                for i, job_config in enumerate(job_configs)]
+
+    def test_job_checkouts(self):
+        checkouts = prefetch.job_checkouts(dict(
+            teuthology_branch='wip-teuth', branch='wip-ceph',
+            suite_repo='https://git.example.com/ceph.git'))
+        assert checkouts == [
+            ('https://git.example.com/teuthology.git', 'wip-teuth',
+             bootstrap_teuthology),
+            ('https://git.example.com/ceph.git', 'wip-ceph', None),
+        ]
+        config.teuthology_path = '/teuthology'
+        checkouts = prefetch.job_checkouts(dict(suite_branch='wip-suite'))
+        assert checkouts == [
+            (config.get_ceph_qa_suite_git_url(), 'wip-suite', None)]
+
+    @patch("teuthology.prefetch.fetch_repo")
+    @patch("teuthology.prefetch.beanstalk.peek_ready_jobs")
+    def test_prefetch(self, m_peek_ready_jobs, m_fetch_repo):
+        config.teuthology_path = '/teuthology'
+        m_peek_ready_jobs.return_value = self.queue(
+            dict(branch='a'), dict(branch='b'), dict(branch='a'),
+            dict(suite_branch='c'))
+        prefetcher = prefetch.Prefetcher(Mock(), ['tube'])
+        assert prefetcher.prefetch() == 3
+        branches = [c[0][1] for c in m_fetch_repo.call_args_list]
+        assert branches == ['a', 'b', 'c']
+        # nothing is fetched again until it is due to be refreshed
+        assert prefetcher.prefetch() == 0
+        prefetcher.fetched[(config.get_ceph_qa_suite_git_url(), 'a',
+                            None)] -= prefetcher.refresh
+        assert prefetcher.prefetch() == 1
+
+    @patch("teuthology.prefetch.fetch_repo")
+    @patch("teuthology.prefetch.beanstalk.peek_ready_jobs")
+    def test_prefetch_forgets_dequeued(self, m_peek_ready_jobs,
+                                       m_fetch_repo):
+        config.teuthology_path = '/teuthology'
+        m_fetch_repo.side_effect = [BranchNotFoundError('a'), None]
+        m_peek_ready_jobs.return_value = self.queue(dict(branch='a'))
+        prefetcher = prefetch.Prefetcher(Mock(), ['tube'])
+        assert prefetcher.prefetch() == 1
+        m_peek_ready_jobs.return_value = self.queue(dict(branch='b'))
+        assert prefetcher.prefetch() == 1
+        assert [c[1] for c in prefetcher.fetched] == ['b']
+
+    @patch("teuthology.prefetch.fetch_repo")
+    @patch("teuthology.prefetch.beanstalk.peek_ready_jobs")
+    def test_prefetch_failures(self, m_peek_ready_jobs, m_fetch_repo):
+        config.teuthology_path = '/teuthology'
+
+        def fetch_repo(url, branch, bootstrap, tries):
+            if branch == 'bad name':
+                raise ValueError(branch)
+            if branch == 'broken':
+                raise subprocess.CalledProcessError(1, 'git')
+        m_fetch_repo.side_effect = fetch_repo
+        m_peek_ready_jobs.return_value = self.queue(
+            dict(branch='bad name'), dict(branch='broken'), dict(branch='a'))
+        prefetcher = prefetch.Prefetcher(Mock(), ['tube'], tries=2)
+        assert prefetcher.prefetch() == 1
+        assert [c[0][1] for c in m_fetch_repo.call_args_list] == \
+            ['bad name', 'broken', 'a']
+        assert m_fetch_repo.call_args[1] == dict(tries=2)
+        # the failures aren't tried again until they are due
+        assert prefetcher.prefetch() == 0
+        assert m_fetch_repo.call_count == 3
+
+    @patch("teuthology.prefetch.time.sleep")
+    @patch("teuthology.prefetch.Prefetcher.prefetch")
+    @patch("teuthology.prefetch.beanstalk.connect")
+    @patch("teuthology.prefetch.teuth_config")
+    @patch("teuthology.prefetch.install_except_hook")
+    def test_main_survives(self, m_hook, m_config, m_connect, m_prefetch,
+                           m_sleep):
+        m_prefetch.side_effect = [RuntimeError('boom'), 1]
+        m_sleep.side_effect = [None, KeyboardInterrupt]
+        ctx = Mock(verbose=False, log_dir=None, tube=['tube'], jobs=10,
+                   interval=60)
+        with pytest.raises(KeyboardInterrupt):
+            prefetch.main(ctx)
+        assert m_prefetch.call_count == 2
+
+    @patch("teuthology.prefetch.fetch_repo")
+    def test_prefetch_next_jobs(self, m_fetch_repo):
+        config.teuthology_path = '/teuthology'
+        # more ready jobs than the prefetcher looks at; the older ones, and
+        # the one with the lowest priority value, are reserved first
+        connection = FakeConnection(dict(
+            (job_id, ('tube', 'ready', pri, 'branch: b%s' % job_id))
+            for (job_id, pri) in
+            [(1, 100), (2, 100), (3, 10), (4, 100), (5, 100), (6, 100)]
+        ))
+        with patch('beanstalkc.Connection', return_value=connection):
+            prefetcher = prefetch.Prefetcher(connection, ['tube'],
+                                             job_count=3)
+            assert prefetcher.prefetch() == 3
+        branches = [c[0][1] for c in m_fetch_repo.call_args_list]
+        assert branches == ['b3', 'b1', 'b2']
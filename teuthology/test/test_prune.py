@@ -0,0 +1,102 @@
+import gzip
+import os
+import time
+
+from distutils.spawn import find_executable
+
+import pytest
+
+from teuthology import prune
+from teuthology.util.logs import tail_log
+
+
+class TestPrune(object):
+    days = 60 * 60 * 24
+
+    def make_job(self, run_dir, job_id, success=None, age_days=100,
+                 log_data=b'log line\n' * 1000, remote=True, preserve=False):
+        job_dir = os.path.join(run_dir, str(job_id))
+        os.makedirs(job_dir)
+        paths = [job_dir]
+        if success is not None:
+            summary_path = os.path.join(job_dir, 'summary.yaml')
+            with open(summary_path, 'w') as f:
+                f.write('success: %s\n' % str(success).lower())
+            paths.append(summary_path)
+        if log_data is not None:
+            log_path = os.path.join(job_dir, 'teuthology.log')
+            with open(log_path, 'wb') as f:
+                f.write(log_data)
+            paths.append(log_path)
+        if remote:
+            remote_dir = os.path.join(job_dir, 'remote')
+            os.mkdir(remote_dir)
+            with open(os.path.join(remote_dir, 'ceph.log'), 'w') as f:
+                f.write('x' * 10000)
+        if preserve:
+            open(os.path.join(job_dir, prune.PRESERVE_FILE), 'w').close()
+        old = time.time() - age_days * self.days
+        for path in reversed(paths):
+            os.utime(path, (old, old))
+        return job_dir
+
+    def make_archive(self, tmpdir):
+        archive_dir = str(tmpdir)
+        run_dir = os.path.join(archive_dir, 'run')
+        self.passed = self.make_job(run_dir, 1, success=True)
+        self.failed = self.make_job(run_dir, 2, success=False)
+        self.preserved = self.make_job(run_dir, 3, success=True,
+                                       preserve=True)
+        self.recent = self.make_job(run_dir, 4, success=True, age_days=0)
+        old = time.time() - 100 * self.days
+        os.utime(run_dir, (old, old))
+        return archive_dir
+
+    def prune(self, archive_dir, **kwargs):
+        return prune.prune_archive(archive_dir, pass_days=14, fail_days=-1,
+                                   remotes_days=60, compress_days=30,
+                                   **kwargs)
+
+    def test_prune_archive(self, tmpdir):
+        archive_dir = self.make_archive(tmpdir)
+        log_path = os.path.join(self.failed, 'teuthology.log')
+        log_mtime = os.path.getmtime(log_path)
+        totals = self.prune(archive_dir, processes=2)
+        assert (totals['jobs'], totals['remotes'], totals['logs']) == \
+            (1, 1, 1)
+        assert totals['log_bytes'] > 0
+        assert not os.path.exists(self.passed)
+        assert not os.path.exists(os.path.join(self.failed, 'remote'))
+        assert not os.path.exists(log_path)
+        with gzip.open(log_path + '.gz') as f:
+            assert f.read() == b'log line\n' * 1000
+        assert os.path.getmtime(log_path + '.gz') == log_mtime
+        assert tail_log(log_path, lines=2) == ['log line'] * 2
+        assert os.path.exists(os.path.join(self.preserved, 'remote'))
+        assert os.path.exists(os.path.join(self.recent, 'remote'))
+
+    def test_prune_archive_dry_run(self, tmpdir):
+        archive_dir = self.make_archive(tmpdir)
+        totals = self.prune(archive_dir, dry_run=True)
+        assert (totals['jobs'], totals['remotes'], totals['logs']) == \
+            (1, 1, 1)
+        assert totals['bytes'] >= 20000
+        assert totals['log_bytes'] == len(b'log line\n' * 1000)
+        assert os.path.exists(self.passed)
+        assert os.path.exists(os.path.join(self.failed, 'remote'))
+        assert os.path.exists(os.path.join(self.failed, 'teuthology.log'))
+
+    @pytest.mark.skipif(not find_executable('zstd'),
+                        reason="zstd is not installed")
+    def test_prune_archive_zstd(self, tmpdir):
+        archive_dir = self.make_archive(tmpdir)
+        self.prune(archive_dir, compressor='zstd')
+        assert sorted(os.listdir(self.failed)) == \
+            ['summary.yaml', 'teuthology.log.tail', 'teuthology.log.zst']
+
+    def test_log_compressor_failure(self, tmpdir):
+        path = str(tmpdir.join('missing.log'))
+        with prune.LogCompressor() as log_compressor:
+            log_compressor.compress(path)
+        assert log_compressor.saved == 0
+        assert not os.path.exists(path + '.gz')
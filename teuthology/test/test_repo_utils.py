@@ -6,6 +6,7 @@ from pytest import raises, mark
 import shutil
 import subprocess
 import tempfile
+import time
 
 from teuthology.exceptions import BranchNotFoundError
 from teuthology import repo_utils
@@ -196,8 +197,205 @@ class TestRepoUtils(object):
         ('https://github.com/ceph/ceph', 'github.com_ceph_ceph'),
         ('https://github.com/liewegas/ceph.git', 'github.com_liewegas_ceph'),
         ('file:///my/dir/has/ceph.git', 'my_dir_has_ceph'),
+        ('/my/dir/has/ceph.git', 'my_dir_has_ceph'),
     ]
 
     @mark.parametrize("input_, expected", URLS_AND_DIRNAMES)
     def test_url_to_dirname(self, input_, expected):
         assert repo_utils.url_to_dirname(input_) == expected
+
+
+class TestVenvCache(object):
+    def setup_method(self, method):
+        self.temp_path = tempfile.mkdtemp(prefix='test_venv_cache-')
+        repo_utils.config.venv_cache_path = os.path.join(self.temp_path,
+                                                         'cache')
+
+    def teardown_method(self, method):
+        repo_utils.config.venv_cache_path = None
+        shutil.rmtree(self.temp_path)
+
+    def make_checkout(self, name, requirements='gevent\n'):
+        path = os.path.join(self.temp_path, name)
+        os.mkdir(path)
+        for file_name, content in (('bootstrap', '#!/bin/sh\n'),
+                                   ('requirements2.txt', requirements)):
+            with open(os.path.join(path, file_name), 'w') as f:
+                f.write(content)
+        return path
+
+    def test_requirements_hash(self):
+        first = self.make_checkout('first')
+        second = self.make_checkout('second')
+        third = self.make_checkout('third', requirements='gevent\nsix\n')
+        assert repo_utils.requirements_hash(first) == \
+            repo_utils.requirements_hash(second)
+        assert repo_utils.requirements_hash(first) != \
+            repo_utils.requirements_hash(third)
+
+    @mock.patch('teuthology.repo_utils.make_overlay_venv')
+    @mock.patch('teuthology.repo_utils.run_bootstrap')
+    def test_bootstrap_shares_venv(self, m_run_bootstrap,
+                                   m_make_overlay_venv):
+        m_run_bootstrap.side_effect = lambda repo, venv: os.mkdir(venv)
+        first = self.make_checkout('first')
+        second = self.make_checkout('second')
+        third = self.make_checkout('third', requirements='gevent\nsix\n')
+        for checkout in (first, second, third):
+            repo_utils.bootstrap_teuthology(checkout)
+        cache_path = repo_utils.venv_cache_path()
+        assert [c[0][0] for c in m_run_bootstrap.call_args_list] == \
+            [first, third]
+        overlays = [c[0] for c in m_make_overlay_venv.call_args_list]
+        assert overlays[0][2] == overlays[1][2]
+        assert overlays[2][2] != overlays[0][2]
+        assert os.path.dirname(overlays[0][2]) == cache_path
+        assert os.path.exists(os.path.join(overlays[0][2], '.bootstrapped'))
+
+    @mock.patch('teuthology.repo_utils.make_overlay_venv')
+    @mock.patch('teuthology.repo_utils.run_bootstrap')
+    def test_bootstrap_legacy_venv(self, m_run_bootstrap,
+                                   m_make_overlay_venv):
+        checkout = self.make_checkout('checkout')
+        venv_path = os.path.join(checkout, 'virtualenv')
+        os.mkdir(venv_path)
+        repo_utils.bootstrap_teuthology(checkout)
+        m_run_bootstrap.assert_called_once_with(checkout, venv_path)
+        assert not m_make_overlay_venv.called
+
+
+class TestWorktrees(object):
+    def setup_method(self, method):
+        self.temp_path = tempfile.mkdtemp(prefix='test_worktrees-')
+        self.src_path = os.path.join(self.temp_path, 'src')
+        self.repo_url = 'file://' + self.src_path
+        self.old_src_base_path = repo_utils.config.src_base_path
+        repo_utils.config.src_base_path = os.path.join(self.temp_path, 'base')
+        self.git('init', self.src_path)
+        self.commit('first')
+        self.git('branch', 'other')
+
+    def teardown_method(self, method):
+        repo_utils.config.src_base_path = self.old_src_base_path
+        shutil.rmtree(self.temp_path)
+
+    def git(self, *args):
+        return subprocess.check_output(
+            ('git', '-c', 'user.email=test@ceph.com', '-c',
+             'user.name=Test User') + args,
+            cwd=self.src_path if os.path.isdir(self.src_path) else None)
+
+    def commit(self, name):
+        with open(os.path.join(self.src_path, name), 'w') as f:
+            f.write(name)
+        self.git('add', name)
+        self.git('commit', '-q', '-m', name)
+
+    def test_branches_share_mirror(self):
+        master = repo_utils.fetch_repo(self.repo_url, 'master')
+        other = repo_utils.fetch_repo(self.repo_url, 'other')
+        assert master != other
+        mirror = repo_utils.mirror_path(self.repo_url)
+        for path in (master, other):
+            assert os.path.isfile(os.path.join(path, '.git'))
+            assert os.path.exists(os.path.join(path, 'first'))
+        worktrees = repo_utils.run_git(['worktree', 'list'], mirror)
+        assert master in worktrees and other in worktrees
+
+    def test_update(self):
+        path = repo_utils.fetch_repo(self.repo_url, 'master')
+        self.commit('second')
+        os.remove(os.path.join(path, '.fetched'))
+        repo_utils.fetch_repo(self.repo_url, 'master')
+        assert os.path.exists(os.path.join(path, 'second'))
+
+    def test_removed_worktree(self):
+        path = repo_utils.fetch_repo(self.repo_url, 'master')
+        shutil.rmtree(path)
+        repo_utils.fetch_repo(self.repo_url, 'master')
+        assert os.path.exists(os.path.join(path, 'first'))
+
+    def test_non_existing_branch(self):
+        dest_path = os.path.join(self.temp_path, 'dest')
+        with raises(BranchNotFoundError):
+            repo_utils.enforce_worktree_state(self.repo_url, dest_path,
+                                              'nobranch')
+        assert not os.path.exists(dest_path)
+
+    def test_existing_clone(self):
+        os.mkdir(repo_utils.config.src_base_path)
+        dest_path = os.path.join(
+            repo_utils.config.src_base_path,
+            repo_utils.url_to_dirname(self.repo_url) + '_master')
+        repo_utils.clone_repo(self.repo_url, dest_path, 'master')
+        assert repo_utils.fetch_repo(self.repo_url, 'master') == dest_path
+        assert os.path.isdir(os.path.join(dest_path, '.git'))
+        assert not os.path.exists(repo_utils.mirror_path(self.repo_url))
+
+
+class TestRefCache(object):
+    def setup_method(self, method):
+        self.temp_path = tempfile.mkdtemp(prefix='test_ref_cache-')
+        self.src_path = os.path.join(self.temp_path, 'src')
+        self.repo_url = 'file://' + self.src_path
+        self.git('init', '-q', self.src_path)
+        self.git('commit', '-q', '--allow-empty', '-m', 'first')
+        self.git('branch', 'wip-foo')
+        self.git('tag', '-a', '-m', 'v1.0', 'v1.0')
+        self.cache = repo_utils.RefCache(
+            path=os.path.join(self.temp_path, 'refs'), ttl=60)
+
+    def teardown_method(self, method):
+        shutil.rmtree(self.temp_path)
+
+    def git(self, *args):
+        return repo_utils.ensure_str(subprocess.check_output(
+            ('git', '-c', 'user.email=test@ceph.com', '-c',
+             'user.name=Test User') + args,
+            cwd=self.src_path if os.path.isdir(self.src_path) else None))
+
+    def rev_parse(self, rev):
+        return self.git('rev-parse', rev).strip()
+
+    def test_one_listing_per_repo(self):
+        expected = dict((ref, self.rev_parse(ref))
+                        for ref in ('master', 'wip-foo', 'v1.0', 'v1.0^{}'))
+        expected['refs/heads/nobranch'] = None
+        with mock.patch('teuthology.repo_utils.subprocess.check_output',
+                        wraps=subprocess.check_output) as m_check_output:
+            for _ in range(2):
+                for ref, sha1 in expected.items():
+                    assert self.cache.ls_remote(self.repo_url, ref) == sha1
+        assert m_check_output.call_count == 1
+
+    def test_other_refs(self):
+        head = self.rev_parse('HEAD')
+        # 'nobranch' might have been under refs/pull, so it is checked
+        # separately - once
+        with mock.patch('teuthology.repo_utils.subprocess.check_output',
+                        wraps=subprocess.check_output) as m_check_output:
+            for _ in range(2):
+                assert self.cache.ls_remote(self.repo_url, 'HEAD') == head
+                assert self.cache.ls_remote(self.repo_url, 'nobranch') is None
+        assert m_check_output.call_count == 3
+
+    def test_shared_and_invalidated(self):
+        assert self.cache.ls_remote(self.repo_url, 'wip-foo') is not None
+        self.git('branch', '-D', 'wip-foo')
+        # another process sharing the cache
+        other = repo_utils.RefCache(path=self.cache.path, ttl=60)
+        assert other.ls_remote(self.repo_url, 'wip-foo') is not None
+        other.invalidate(self.repo_url)
+        assert self.cache.ls_remote(self.repo_url, 'wip-foo') is None
+
+    def test_expiry(self):
+        assert self.cache.ls_remote(self.repo_url, 'wip-foo') is not None
+        self.git('branch', '-D', 'wip-foo')
+        self.cache.since = time.time() + 1
+        assert self.cache.ls_remote(self.repo_url, 'wip-foo') is None
+
+    def test_disabled(self):
+        cache = repo_utils.RefCache(path=self.cache.path, ttl=0)
+        assert cache.ls_remote(self.repo_url, 'master') == \
+            self.rev_parse('master')
+        assert not os.path.exists(cache.path)
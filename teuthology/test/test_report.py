@@ -1,5 +1,12 @@
+import os
+import shutil
 import yaml
 import json
+import threading
+import time
+from mock import patch
+from six.moves.BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
 from teuthology.test import fake_archive
 from teuthology import report
 
@@ -74,4 +81,331 @@ class TestSerializer(object):
         out_obj = json.loads(out_json)
         assert full_obj == out_obj
 
+    def test_job_info_cached(self):
+        run_name = "test_job_info_cached"
+        jobs = self.archive.create_fake_run(
+            run_name, 1, "examples/3node_ceph.yaml")
+        job_id = str(jobs[0]['job_id'])
+        serializer = self.reporter.serializer
+        serializer.index.settle_time = 0
+        info = serializer.job_info(run_name, job_id)
+        with patch('teuthology.report.yaml.safe_load') as m_safe_load:
+            assert serializer.job_info(run_name, job_id) == info
+            assert report.ResultsSerializer(self.archive_base).job_info(
+                run_name, job_id) == info
+            assert m_safe_load.call_count == 0
+
+        # a changed file is read again
+        summary_path = os.path.join(
+            self.archive_base, run_name, job_id, 'summary.yaml')
+        with open(summary_path, 'w') as f:
+            yaml.safe_dump(dict(success=False, duration=1), f)
+        mtime = os.path.getmtime(summary_path) + 10
+        os.utime(summary_path, (mtime, mtime))
+        info = serializer.job_info(run_name, job_id)
+        assert info['success'] is False
+        assert info['duration'] == 1
+
+    def test_jobs_for_run_cached(self):
+        run_name = "test_jobs_for_run_cached"
+        self.archive.create_fake_run(run_name, 3, "examples/3node_ceph.yaml")
+        serializer = self.reporter.serializer
+        serializer.index.settle_time = 0
+        got_jobs = serializer.jobs_for_run(run_name)
+        with patch('teuthology.report.os.listdir') as m_listdir:
+            assert serializer.jobs_for_run(run_name) == got_jobs
+            assert m_listdir.call_count == 0
+        assert serializer.all_runs == [run_name]
+
+    def test_index_forgets_pruned(self):
+        serializer = self.reporter.serializer
+        serializer.index.settle_time = -60
+        jobs = self.archive.create_fake_run(
+            "run1:00:00", 3, "examples/3node_ceph.yaml")
+        self.archive.create_fake_run(
+            "run2", 1, "examples/3node_ceph.yaml")
+        job_ids = [str(job['job_id']) for job in jobs]
+        for run_name in serializer.all_runs:
+            for job_id in serializer.jobs_for_run(run_name):
+                serializer.job_info(run_name, job_id, simple=True)
+        index = serializer.index
+        run1_dir = os.path.join(self.archive_base, "run1:00:00")
+        assert len(index.keys('job:' + run1_dir + '/')) == 3
+
+        # prune a job, then a whole run
+        shutil.rmtree(os.path.join(run1_dir, job_ids[0]))
+        os.utime(run1_dir, (0, 0))
+        assert sorted(serializer.jobs_for_run("run1:00:00")) == \
+            sorted(job_ids[1:])
+        assert len(index.keys('job:' + run1_dir + '/')) == 2
+        shutil.rmtree(os.path.join(self.archive_base, "run2"))
+        os.utime(self.archive_base, (0, 0))
+        assert serializer.all_runs == ["run1:00:00"]
+        run2_dir = os.path.join(self.archive_base, "run2")
+        assert index.keys('job:' + run2_dir) == []
+        assert index.keys('jobs:' + run2_dir) == []
+        assert len(index.keys('job:' + run1_dir + '/')) == 2
+        assert index.keys('jobs:' + run1_dir) == ['jobs:' + run1_dir]
+
+    def test_index_keys(self):
+        index = report.ArchiveIndex(self.archive_base)
+        index.settle_time = -60
+        for key in ('job:/a/1:x', 'job:/a/10:x', 'job:/ab/1:x', 'job:/a',
+                    u'job:/a/\xe9:x', 'jobs:/a/'):
+            index.get(key, 'stamp', lambda: 1)
+        assert sorted(index.keys('job:/a/')) == \
+            ['job:/a/10:x', 'job:/a/1:x', u'job:/a/\xe9:x']
+        plan = index.conn.execute(
+            'EXPLAIN QUERY PLAN SELECT key FROM entries '
+            'WHERE key >= ? AND key < ?', ('a', 'b')).fetchall()
+        assert 'INDEX' in str(plan)
+
+    def test_no_index(self):
+        run_name = "test_no_index"
+        self.archive.create_fake_run(run_name, 1, "examples/3node_ceph.yaml")
+        serializer = report.ResultsSerializer(self.archive_base,
+                                              use_index=False)
+        assert serializer.all_runs == [run_name]
+        assert not os.path.exists(
+            os.path.join(self.archive_base, report.ArchiveIndex.dir_name))
+
+
+class StubResultsServer(object):
+    """
+    A stand-in for the results server that records the requests it gets.
+
+    :param bulk:     Whether to have a bulk endpoint
+    :param existing: Job ids to claim already exist when POSTed
+    :param fail:     Whether to fail all POSTs with a 500 error
+    """
+    def __init__(self, bulk=False, existing=(), fail=False):
+        self.requests = []
+        self.bulk = bulk
+        self.existing = set(existing)
+        self.fail = fail
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def reply(self, status, obj=None):
+                body = json.dumps(obj).encode() if obj is not None else b''
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def record(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                body = self.rfile.read(length) if length else None
+                if body:
+                    body = json.loads(body.decode())
+                stub.requests.append((self.command, self.path, body))
+                return body
+
+            def do_HEAD(self):
+                self.record()
+                self.reply(404)
+
+            def do_PUT(self):
+                self.record()
+                self.reply(200)
+
+            def do_POST(self):
+                body = self.record()
+                if stub.fail:
+                    self.reply(500)
+                elif self.path.endswith('/bulk/'):
+                    self.reply(200 if stub.bulk else 404)
+                elif str(body['job_id']) in stub.existing:
+                    self.reply(400, dict(message='job with job_id %s '
+                                         'already exists' % body['job_id']))
+                else:
+                    self.reply(200)
+
+        self.server = HTTPServer(('127.0.0.1', 0), Handler)
+        self.uri = 'http://127.0.0.1:%d/' % self.server.server_port
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def paths(self, command):
+        return [path for (c, path, _) in self.requests if c == command]
+
+
+class TestReporter(object):
+    def setup(self):
+        self.archive = fake_archive.FakeArchive()
+        self.archive.setup()
+        self.archive_base = self.archive.archive_base
+        self.server = None
+
+    def teardown(self):
+        self.archive.teardown()
+        if self.server is not None:
+            self.server.stop()
+
+    def make_reporter(self, tmpdir, **kwargs):
+        reporter = report.ResultsReporter(
+            archive_base=self.archive_base, base_uri=self.server.uri,
+            **kwargs)
+        reporter.last_run_file = str(tmpdir.join('last_successful_run'))
+        reporter.reported_runs_file = str(tmpdir.join('reported_runs'))
+        return reporter
+
+    def create_run(self, run_name, job_count=5):
+        jobs = self.archive.create_fake_run(
+            run_name, job_count, 'examples/3node_ceph.yaml')
+        return [str(job['job_id']) for job in jobs]
+
+    def test_report_jobs(self, tmpdir):
+        self.server = StubResultsServer()
+        job_ids = self.create_run('run')
+        reporter = self.make_reporter(tmpdir, concurrency=4)
+        reporter.report_jobs('run', job_ids)
+        posted = [body['job_id'] for (_, _, body) in self.server.requests]
+        assert sorted(str(job_id) for job_id in posted) == sorted(job_ids)
+        assert self.server.paths('POST') == ['/runs/run/jobs/'] * 5
+
+    def test_report_jobs_existing(self, tmpdir):
+        job_ids = self.create_run('run')
+        self.server = StubResultsServer(existing=job_ids[:1])
+        reporter = self.make_reporter(tmpdir, concurrency=4)
+        reporter.report_jobs('run', job_ids)
+        assert self.server.paths('PUT') == \
+            ['/runs/run/jobs/%s/' % job_ids[0]]
+
+    def test_report_jobs_bulk(self, tmpdir):
+        self.server = StubResultsServer(bulk=True)
+        job_ids = self.create_run('run')
+        reporter = self.make_reporter(tmpdir, bulk=True)
+        reporter.bulk_size = 2
+        reporter.report_jobs('run', job_ids)
+        assert self.server.paths('POST') == ['/runs/run/jobs/bulk/'] * 3
+        posted = [str(job['job_id']) for (_, _, body) in self.server.requests
+                  for job in body]
+        assert sorted(posted) == sorted(job_ids)
+
+    def test_report_jobs_bulk_fallback(self, tmpdir):
+        self.server = StubResultsServer(bulk=False)
+        job_ids = self.create_run('run')
+        reporter = self.make_reporter(tmpdir, bulk=True, concurrency=2)
+        reporter.bulk_size = 2
+        reporter.report_jobs('run', job_ids)
+        assert reporter.bulk is False
+        assert self.server.paths('POST') == \
+            ['/runs/run/jobs/bulk/'] + ['/runs/run/jobs/'] * 5
+
+    def test_report_all_runs_resume(self, tmpdir):
+        self.server = StubResultsServer()
+        for run_name in ('run1', 'run2', 'run3'):
+            self.create_run(run_name, job_count=2)
+        reporter = self.make_reporter(tmpdir, save=True, concurrency=2)
+        reporter.add_reported_run('run2')
+        assert reporter.reported_runs == set(['run2'])
+        reporter.report_all_runs()
+        assert sorted(self.server.paths('HEAD')) == ['/runs/run1/',
+                                                      '/runs/run3/']
+        assert len(self.server.paths('POST')) == 4
+        # everything was reported, so there's nothing left to resume
+        assert reporter.reported_runs == set()
+
+
+class TestHeartbeatAggregator(object):
+    def setup(self):
+        self.server = None
+
+    def teardown(self):
+        if self.server is not None:
+            self.server.stop()
+
+    def make_aggregator(self, tmpdir, interval=60, **kwargs):
+        reporter = report.ResultsReporter(base_uri=self.server.uri,
+                                          bulk=True)
+        return report.HeartbeatAggregator(
+            spool_dir=str(tmpdir.join('spool')), interval=interval,
+            reporter=reporter, **kwargs)
+
+    def make_due(self, aggregator):
+        state = aggregator._read_state()
+        state['due'] = time.time() - 1
+        with open(os.path.join(aggregator.spool_dir, '.state'), 'w') as f:
+            json.dump(state, f)
+
+    def test_beat_batches_jobs(self, tmpdir):
+        self.server = StubResultsServer(bulk=True)
+        # two worker processes on the same host
+        first = self.make_aggregator(tmpdir)
+        second = self.make_aggregator(tmpdir)
+        first.beat([dict(name='run1', job_id='1')])
+        second.beat([dict(name='run1', job_id='2'),
+                     dict(name='run2', job_id='3')])
+        # the first heartbeats aren't sent until an interval has passed
+        assert self.server.requests == []
+        self.make_due(second)
+        first.beat([dict(name='run1', job_id='1')])
+        assert sorted(self.server.paths('POST')) == \
+            ['/runs/run1/jobs/bulk/', '/runs/run2/jobs/bulk/']
+        sent = dict((path, sorted(job['job_id'] for job in body))
+                    for (_, path, body) in self.server.requests)
+        assert sent['/runs/run1/jobs/bulk/'] == ['1', '2']
+        # the next flush isn't due until an interval later
+        second.beat([dict(name='run1', job_id='2')])
+        assert len(self.server.requests) == 2
+
+    def test_beat_no_bulk_endpoint(self, tmpdir):
+        self.server = StubResultsServer(bulk=False)
+        aggregator = self.make_aggregator(tmpdir)
+        aggregator.beat([dict(name='run', job_id='1'),
+                         dict(name='run', job_id='2')])
+        self.make_due(aggregator)
+        aggregator.maybe_flush()
+        assert self.server.paths('POST') == \
+            ['/runs/run/jobs/bulk/'] + ['/runs/run/jobs/'] * 2
+        assert aggregator.reporter.bulk is False
+
+    def test_flush_while_locked(self, tmpdir):
+        import fcntl
+        self.server = StubResultsServer(bulk=True)
+        aggregator = self.make_aggregator(tmpdir)
+        aggregator.beat([dict(name='run', job_id='1')])
+        self.make_due(aggregator)
+        with open(str(tmpdir.join('spool', '.lock')), 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            assert aggregator.maybe_flush() is False
+        assert aggregator.maybe_flush() is True
+
+    def test_backoff(self, tmpdir):
+        self.server = StubResultsServer(bulk=True, fail=True)
+        aggregator = self.make_aggregator(tmpdir, jitter=0)
+        aggregator.beat([dict(name='run', job_id='1')])
+        for failures in (1, 2, 3, 4):
+            self.make_due(aggregator)
+            before = time.time()
+            assert aggregator.maybe_flush() is True
+            state = aggregator._read_state()
+            assert state['failures'] == failures
+            backoff = min(2 ** failures, aggregator.max_backoff)
+            assert state['due'] - before >= aggregator.interval * backoff
+        self.server.fail = False
+        self.make_due(aggregator)
+        aggregator.maybe_flush()
+        assert aggregator._read_state()['failures'] == 0
 
+    def test_ended_and_stale_jobs(self, tmpdir):
+        self.server = StubResultsServer(bulk=True)
+        aggregator = self.make_aggregator(tmpdir)
+        aggregator.beat([dict(name='run', job_id=str(i)) for i in range(3)])
+        aggregator.end(dict(name='run', job_id='0'))
+        aggregator.end(dict(name='run', job_id='0'))
+        old = time.time() - 3 * aggregator.interval
+        stale = aggregator._path(dict(name='run', job_id='1'))
+        os.utime(stale, (old, old))
+        assert aggregator.pending() == {'run': [dict(name='run', job_id='2')]}
+        assert not os.path.exists(stale)
@@ -1,4 +1,6 @@
-from teuthology.schedule import build_config
+from mock import Mock, call, patch
+
+from teuthology.schedule import build_config, JobScheduler
 from teuthology.misc import get_user
 
 
@@ -43,3 +45,47 @@ class TestSchedule(object):
         job_dict = build_config(self.basic_args)
         assert job_dict['owner'] == 'scheduled_%s' % get_user()
 
+
+
+class TestJobScheduler(object):
+    def setup(self):
+        self.connection = Mock()
+        self.connection.put.side_effect = range(1, 100)
+
+    def job_config(self, tube='tala'):
+        return dict(name='NAME', priority=99, tube=tube)
+
+    @patch('teuthology.schedule.report.try_push_jobs_info')
+    def test_reuses_connection(self, m_push):
+        scheduler = JobScheduler(connection=self.connection)
+        assert scheduler.schedule(self.job_config()) == ['1']
+        assert scheduler.schedule(self.job_config(), num=2) == ['2', '3']
+        self.connection.use.assert_called_once_with('tala')
+        assert self.connection.put.call_count == 3
+        scheduler.close()
+        self.connection.close.assert_called_once_with()
+
+    @patch('teuthology.schedule.report.try_push_jobs_info')
+    def test_switches_tube(self, m_push):
+        scheduler = JobScheduler(connection=self.connection)
+        scheduler.schedule(self.job_config('tala'))
+        scheduler.schedule(self.job_config('mira'))
+        scheduler.schedule(self.job_config('mira'))
+        assert self.connection.use.call_args_list == [
+            call('tala'), call('mira')]
+
+    @patch('teuthology.schedule.report.try_push_jobs_info')
+    def test_pushes_status_after_put(self, m_push):
+        # each job's status is pushed before the next job is put
+        events = []
+        job_ids = iter(range(1, 100))
+        self.connection.put.side_effect = \
+            lambda *args, **kwargs: events.append('put') or next(job_ids)
+        m_push.side_effect = lambda jobs, info, reporter: events.append(
+            (jobs[0]['job_id'], info['status']))
+        scheduler = JobScheduler(connection=self.connection)
+        scheduler.schedule(self.job_config(), num=2)
+        assert events == ['put', ('1', 'queued'), 'put', ('2', 'queued')]
+        # over the same session
+        reporters = set(id(c[1]['reporter']) for c in m_push.call_args_list)
+        assert len(reporters) == 1
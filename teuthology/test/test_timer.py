@@ -18,6 +18,14 @@ class TestTimer(object):
         assert self.timer.data['marks'][0]['interval'] == 0
         assert self.timer.data['marks'][0]['message'] == ''
 
+    def test_add_data(self):
+        self.timer = timer.Timer()
+        self.timer.add_data('extra', dict(a=1))
+        assert self.timer.data == dict(extra=dict(a=1))
+        self.timer.mark()
+        assert self.timer.data['extra'] == dict(a=1)
+        assert len(self.timer.data['marks']) == 1
+
     def test_data_five_marks(self):
         self.timer = timer.Timer()
         for i in range(5):
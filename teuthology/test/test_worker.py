@@ -1,4 +1,6 @@
 import beanstalkc
+import gevent
+import gevent.event
 import os
 
 from mock import patch, Mock, MagicMock
@@ -16,6 +18,7 @@ class TestWorker(object):
         self.ctx.archive_dir = '/archive/dir'
         self.ctx.log_dir = '/log/dir'
         self.ctx.tube = 'tube'
+        self.ctx.slots = 1
 
     @patch("os.path.exists")
     def test_restart_file_path_doesnt_exist(self, m_exists):
@@ -301,3 +304,174 @@ class TestWorker(object):
         for i in range(len(jobs)):
             push_call = m_try_push_job_info.call_args_list[i]
             assert push_call[0][1]['status'] == 'dead'
+
+    @patch("teuthology.worker.load_config")
+    @patch("teuthology.worker.symlink_worker_log")
+    @patch("time.sleep")
+    @patch("tempfile.NamedTemporaryFile")
+    @patch("teuthology.worker.start_job")
+    @patch("teuthology.worker.prep_job_args")
+    @patch("teuthology.worker.prep_job")
+    @patch("teuthology.worker.teuth_config")
+    def test_dispatcher(self, m_t_config, m_prep_job, m_prep_job_args,
+                        m_start_job, m_tempfile, m_sleep, m_symlink_log,
+                        m_load_config):
+        m_t_config.results_server = None
+        # let the greenlets starting the jobs run
+        m_sleep.side_effect = lambda seconds: gevent.sleep(0)
+        m_connection = Mock()
+        jobs = [
+            Mock(jid=job_id, body=body) for (job_id, body) in enumerate([
+                'name: one',
+                'name: two',
+                'name: three\nstop_worker: true',
+            ], 1)
+        ]
+        m_connection.reserve.side_effect = jobs
+        m_prep_job.side_effect = lambda config, *args: (config, '/bin/path')
+        m_prep_job_args.return_value = (['teuthology'], dict())
+        # each job is still running the first time it is checked on
+        processes = list()
+
+        def start_job(*args):
+            process = Mock(returncode=0)
+            process.poll.side_effect = [None, 0]
+            processes.append(process)
+            return process
+        m_start_job.side_effect = start_job
+
+        dispatcher = worker.Dispatcher(m_connection, 2, '/worker/log',
+                                       '/archive/dir')
+        dispatcher.loop()
+        assert len(processes) == 3
+        # the third job is only reserved once one of the first two is done
+        assert m_sleep.called
+        assert dispatcher.running == []
+        for job in jobs:
+            job.bury.assert_called_once_with()
+            job.delete.assert_called_once_with()
+
+
+class TestDispatcher(object):
+    def setup(self):
+        self.connection = Mock()
+        self.processes = dict()
+        self.started = list()
+        self.patchers = dict(
+            t_config=patch("teuthology.worker.teuth_config"),
+            sentinel=patch("teuthology.worker.sentinel", return_value=False),
+            load_config=patch("teuthology.worker.load_config"),
+            symlink_log=patch("teuthology.worker.symlink_worker_log"),
+            sleep=patch("time.sleep",
+                        side_effect=lambda seconds: gevent.sleep(0)),
+            tempfile=patch("tempfile.NamedTemporaryFile"),
+            start_job=patch("teuthology.worker.start_job",
+                            side_effect=self.start_job),
+            prep_job_args=patch("teuthology.worker.prep_job_args",
+                                return_value=(['teuthology'], dict())),
+            prep_job=patch("teuthology.worker.prep_job",
+                           side_effect=lambda config, *args:
+                           (config, '/bin/path')),
+            report=patch("teuthology.worker.report"),
+            kill_job=patch("teuthology.worker.kill_job"),
+        )
+        self.mocks = dict((name, patcher.start())
+                          for (name, patcher) in self.patchers.items())
+        self.mocks['t_config'].results_server = None
+
+    def teardown(self):
+        for patcher in self.patchers.values():
+            patcher.stop()
+
+    def start_job(self, job_config, *args):
+        # each job runs for as many checks as the polls given for it
+        name = job_config['name']
+        process = Mock(returncode=0)
+        process.poll.side_effect = self.processes.get(name, [None, 0])
+        self.started.append(name)
+        return process
+
+    def jobs(self, *bodies):
+        jobs = [Mock(jid=job_id, body=body)
+                for (job_id, body) in enumerate(bodies, 1)]
+        self.connection.reserve.side_effect = jobs + [None] * 100
+        return jobs
+
+    def dispatcher(self, slots=2):
+        return worker.Dispatcher(self.connection, slots, '/worker/log',
+                                 '/archive/dir')
+
+    def test_restart_drains(self):
+        jobs = self.jobs('name: one', 'name: two', 'name: three')
+        self.processes['one'] = [None] * 5 + [0]
+        # a restart is requested once both slots are busy
+        self.mocks['sentinel'].side_effect = \
+            lambda path: path == worker.restart_file_path and \
+            len(self.started) == 2
+        dispatcher = self.dispatcher()
+        with patch("teuthology.worker.restart") as m_restart:
+            m_restart.side_effect = lambda: self.started.append('restart')
+            dispatcher.loop()
+        # no more jobs were started, and the restart waited for both
+        assert self.started == ['one', 'two', 'restart']
+        assert self.connection.reserve.call_count == 2
+        for job in jobs[:2]:
+            job.delete.assert_called_once_with()
+        assert not jobs[2].bury.called
+
+    def test_stop_worker_drains(self):
+        self.jobs('name: one\nstop_worker: true', 'name: two')
+        self.processes['one'] = [None] * 5 + [0]
+        with patch("teuthology.worker.stop") as m_stop:
+            self.dispatcher().loop()
+        # the worker just exits once the first job is done
+        assert not m_stop.called
+        assert self.started == ['one']
+        assert self.connection.reserve.call_count == 1
+
+    def test_max_job_time(self):
+        self.mocks['t_config'].results_server = 'http://results/'
+        self.mocks['t_config'].watchdog_interval = 0
+        self.mocks['t_config'].max_job_time = -1
+        self.mocks['t_config'].archive_base = '/archive/dir'
+        self.jobs('name: one\nowner: owner\nstop_worker: true')
+        self.dispatcher().loop()
+        self.mocks['kill_job'].assert_called_once_with(
+            'one', '1', '/archive/dir', 'owner')
+        assert self.mocks['report'].try_push_heartbeats.called
+        assert self.mocks['report'].try_end_heartbeat.called
+
+    def test_prep_fails(self):
+        def prep_job(config, *args):
+            if config['name'] == 'one':
+                raise RuntimeError('boom')
+            return config, '/bin/path'
+        self.mocks['prep_job'].side_effect = prep_job
+        jobs = self.jobs('name: one', 'name: two\nstop_worker: true')
+        dispatcher = self.dispatcher()
+        dispatcher.loop()
+        # the other job still ran, and the failed one was left buried
+        assert self.started == ['two']
+        assert dispatcher.starting == []
+        jobs[0].bury.assert_called_once_with()
+        assert not jobs[0].delete.called
+        jobs[1].delete.assert_called_once_with()
+        self.mocks['report'].try_push_job_info.assert_called_once_with(
+            dict(name='one', job_id='1'),
+            dict(status='dead', failure_reason='boom'))
+
+    def test_prep_doesnt_block(self):
+        # the second job is prepared until the loop has seen the first one
+        # finish
+        jobs = self.jobs('name: one', 'name: two\nstop_worker: true')
+        first_done = gevent.event.Event()
+        jobs[0].delete.side_effect = first_done.set
+
+        def prep_job(config, *args):
+            if config['name'] == 'two':
+                assert first_done.wait(timeout=5)
+            return config, '/bin/path'
+        self.mocks['prep_job'].side_effect = prep_job
+        self.dispatcher().loop()
+        assert self.started == ['one', 'two']
+        jobs[1].delete.assert_called_once_with()
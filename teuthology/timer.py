@@ -33,6 +33,7 @@ class Timer(object):
         self.path = path
         self.sync = sync
         self.marks = list()
+        self.extra = dict()
         self.start_time = None
         self.start_string = None
 
@@ -55,6 +56,17 @@ class Timer(object):
         if self.sync:
             self.write()
 
+    def add_data(self, name, value):
+        """
+        Store additional data to be written out along with the time marks
+
+        :param name:  The top-level key to store value under
+        :param value: Any object yaml.safe_dump() can handle
+        """
+        self.extra[name] = value
+        if self.sync:
+            self.write()
+
     def _mark_start(self, message):
         """
         Create the initial time mark
@@ -89,10 +101,11 @@ class Timer(object):
              ],
              }
 
-        'start' and 'end' times are in UTC.
+        'start' and 'end' times are in UTC. Anything stored with add_data() is
+        included as well.
         """
         if not self.start_string:
-            return dict()
+            return dict(self.extra)
         if len(self.marks) <= 1:
             end_interval = 0
         else:
@@ -104,6 +117,7 @@ class Timer(object):
             end=self.get_datetime_string(end_time),
             elapsed=end_interval,
         )
+        result.update(self.extra)
         return result
 
     def write(self):
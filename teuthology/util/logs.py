@@ -0,0 +1,147 @@
+"""
+Read job logs like teuthology.log whether or not teuthology-prune-logs has
+compressed them.
+
+Functions here take the log's original path, e.g. .../teuthology.log, and
+find whichever of it and its compressed versions exists.
+"""
+import collections
+import contextlib
+import errno
+import gzip
+import os
+import re
+import shutil
+import subprocess
+
+from six import ensure_str
+
+# The suffixes a log may have been given by compressing it
+COMPRESSED_SUFFIXES = ('.gz', '.zst')
+# When a log is compressed, the end of it is kept uncompressed in a file with
+# this suffix, so that tailing it doesn't mean decompressing all of it
+TAIL_SUFFIX = '.tail'
+TAIL_LINES = 100
+
+
+def find_log(path):
+    """
+    :param path: The log's uncompressed path
+    :returns:    path or one of its compressed versions, whichever exists, or
+                 None if none do
+    """
+    for suffix in ('',) + COMPRESSED_SUFFIXES:
+        if os.path.exists(path + suffix):
+            return path + suffix
+    return None
+
+
+def _find_log(path):
+    found = find_log(path)
+    if found is None:
+        raise IOError(errno.ENOENT, os.strerror(errno.ENOENT), path)
+    return found
+
+
+@contextlib.contextmanager
+def open_log(path):
+    """
+    Open a log for reading in binary mode, decompressing it as it is read if
+    necessary
+
+    :param path: The log's uncompressed path
+    """
+    found = _find_log(path)
+    if found.endswith('.gz'):
+        with gzip.open(found, 'rb') as f:
+            yield f
+    elif found.endswith('.zst'):
+        proc = subprocess.Popen(['zstd', '-dcq', found],
+                                stdout=subprocess.PIPE)
+        try:
+            yield proc.stdout
+        finally:
+            proc.stdout.close()
+            if proc.poll() is None:
+                proc.kill()
+            proc.wait()
+    else:
+        with open(found, 'rb') as f:
+            yield f
+
+
+def tail_log(path, lines=10):
+    """
+    Return the last lines of a log
+
+    For a compressed log with a tail file, that is read instead, as long as
+    it has enough lines.
+
+    :param path:  The log's uncompressed path
+    :param lines: How many lines to return
+    :returns:     A list of lines, without line endings
+    """
+    found = _find_log(path)
+    if found == path:
+        return _tail_file(path, lines)
+    tail_path = path + TAIL_SUFFIX
+    if lines <= TAIL_LINES and os.path.exists(tail_path):
+        return _tail_file(tail_path, lines)
+    with open_log(path) as f:
+        tail = collections.deque(f, maxlen=lines)
+    return [ensure_str(line.rstrip(b'\r\n'), errors='replace')
+            for line in tail]
+
+
+def _tail_file(path, lines, block_size=8192):
+    """
+    Return the last lines of an uncompressed file, reading it backwards from
+    the end
+    """
+    if lines <= 0:
+        return []
+    with open(path, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        pos = f.tell()
+        data = b''
+        # the last line may or may not end in a newline, so one more than
+        # lines newlines are needed to be sure the first line is complete
+        while pos > 0 and data.count(b'\n') <= lines:
+            size = min(block_size, pos)
+            pos -= size
+            f.seek(pos)
+            data = f.read(size) + data
+    return [ensure_str(line, errors='replace')
+            for line in data.splitlines()[-lines:]]
+
+
+def grep_log(path, pattern):
+    """
+    Search a log for lines matching a regular expression, decompressing it
+    as it is read if necessary
+
+    :param path:    The log's uncompressed path
+    :param pattern: A regular expression, as a string or compiled
+    :returns:       A generator of matching lines, without line endings
+    """
+    regex = re.compile(pattern)
+    with open_log(path) as f:
+        for line in f:
+            line = ensure_str(line.rstrip(b'\r\n'), errors='replace')
+            if regex.search(line):
+                yield line
+
+
+def write_tail(path, lines=TAIL_LINES):
+    """
+    Save the end of an uncompressed log in its tail file, for tail_log() to
+    read once the log is compressed
+
+    :param path:  The log's path
+    :param lines: How many lines to save
+    """
+    tail_path = path + TAIL_SUFFIX
+    with open(tail_path, 'w') as f:
+        for line in _tail_file(path, lines):
+            f.write(line + '\n')
+    shutil.copystat(path, tail_path)
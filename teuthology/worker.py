@@ -1,3 +1,5 @@
+import gevent
+import gevent.lock
 import logging
 import os
 import subprocess
@@ -82,6 +84,12 @@ def main(ctx):
         fetch_teuthology('master')
     fetch_qa_suite('master')
 
+    if ctx.slots > 1:
+        dispatcher = Dispatcher(connection, ctx.slots, log_file_path,
+                                ctx.archive_dir, ctx.verbose)
+        dispatcher.loop()
+        return
+
     keep_running = True
     while keep_running:
         # Check to see if we have a teuthology-results process hanging around
@@ -189,37 +197,79 @@ def prep_job(job_config, log_file_path, archive_dir):
 
 
 def run_job(job_config, teuth_bin_path, archive_dir, verbose):
-    safe_archive = safepath.munge(job_config['name'])
     if job_config.get('first_in_suite') or job_config.get('last_in_suite'):
+        run_results(job_config, teuth_bin_path, archive_dir)
+        return
+
+    arg, env = prep_job_args(job_config, teuth_bin_path, verbose)
+    with tempfile.NamedTemporaryFile(prefix='teuthology-worker.',
+                                     suffix='.tmp', mode='w+t') as tmp:
+        p = start_job(job_config, arg, env, tmp)
+
         if teuth_config.results_server:
-            report.try_delete_jobs(job_config['name'], job_config['job_id'])
-        suite_archive_dir = os.path.join(archive_dir, safe_archive)
-        safepath.makedirs('/', suite_archive_dir)
-        args = [
-            os.path.join(teuth_bin_path, 'teuthology-results'),
-            '--archive-dir', suite_archive_dir,
-            '--name', job_config['name'],
-        ]
-        if job_config.get('first_in_suite'):
-            log.info('Generating memo for %s', job_config['name'])
-            if job_config.get('seed'):
-                args.extend(['--seed', job_config['seed']])
-            if job_config.get('subset'):
-                args.extend(['--subset', job_config['subset']])
+            log.info("Running with watchdog")
+            try:
+                run_with_watchdog(p, job_config)
+            except Exception:
+                log.exception("run_with_watchdog had an unhandled exception")
+                raise
         else:
-            log.info('Generating results for %s', job_config['name'])
-            timeout = job_config.get('results_timeout',
-                                     teuth_config.results_timeout)
-            args.extend(['--timeout', str(timeout)])
-            if job_config.get('email'):
-                args.extend(['--email', job_config['email']])
-        # Execute teuthology-results, passing 'preexec_fn=os.setpgrp' to
-        # make sure that it will continue to run if this worker process
-        # dies (e.g. because of a restart)
-        result_proc = subprocess.Popen(args=args, preexec_fn=os.setpgrp)
-        log.info("teuthology-results PID: %s", result_proc.pid)
-        return
+            log.info("Running without watchdog")
+            # This sleep() is to give the child time to start up and create the
+            # archive dir.
+            time.sleep(5)
+            symlink_worker_log(job_config['worker_log'],
+                               job_config['archive_path'])
+            p.wait()
 
+        if p.returncode != 0:
+            log.error('Child exited with code %d', p.returncode)
+        else:
+            log.info('Success!')
+
+
+def run_results(job_config, teuth_bin_path, archive_dir):
+    """
+    Start teuthology-results for a first_in_suite or last_in_suite job,
+    without waiting for it
+    """
+    safe_archive = safepath.munge(job_config['name'])
+    if teuth_config.results_server:
+        report.try_delete_jobs(job_config['name'], job_config['job_id'])
+    suite_archive_dir = os.path.join(archive_dir, safe_archive)
+    safepath.makedirs('/', suite_archive_dir)
+    args = [
+        os.path.join(teuth_bin_path, 'teuthology-results'),
+        '--archive-dir', suite_archive_dir,
+        '--name', job_config['name'],
+    ]
+    if job_config.get('first_in_suite'):
+        log.info('Generating memo for %s', job_config['name'])
+        if job_config.get('seed'):
+            args.extend(['--seed', job_config['seed']])
+        if job_config.get('subset'):
+            args.extend(['--subset', job_config['subset']])
+    else:
+        log.info('Generating results for %s', job_config['name'])
+        timeout = job_config.get('results_timeout',
+                                 teuth_config.results_timeout)
+        args.extend(['--timeout', str(timeout)])
+        if job_config.get('email'):
+            args.extend(['--email', job_config['email']])
+    # Execute teuthology-results, passing 'preexec_fn=os.setpgrp' to
+    # make sure that it will continue to run if this worker process
+    # dies (e.g. because of a restart)
+    result_proc = subprocess.Popen(args=args, preexec_fn=os.setpgrp)
+    log.info("teuthology-results PID: %s", result_proc.pid)
+
+
+def prep_job_args(job_config, teuth_bin_path, verbose):
+    """
+    Create the job's archive dir, and work out how to run it
+
+    :returns: The arguments to run teuthology with, less the path to the job
+              config, and its environment
+    """
     log.info('Creating archive dir %s', job_config['archive_path'])
     safepath.makedirs('/', job_config['archive_path'])
     log.info('Running job %s', job_config['job_id'])
@@ -253,40 +303,31 @@ def run_job(job_config, teuth_bin_path, archive_dir, verbose):
         arg.extend(['--description', job_config['description']])
     arg.append('--')
 
-    with tempfile.NamedTemporaryFile(prefix='teuthology-worker.',
-                                     suffix='.tmp', mode='w+t') as tmp:
-        yaml.safe_dump(data=job_config, stream=tmp)
-        tmp.flush()
-        arg.append(tmp.name)
-        env = os.environ.copy()
-        python_path = env.get('PYTHONPATH', '')
-        python_path = ':'.join([suite_path, python_path]).strip(':')
-        env['PYTHONPATH'] = python_path
-        log.debug("Running: %s" % ' '.join(arg))
-        p = subprocess.Popen(args=arg, env=env)
-        log.info("Job archive: %s", job_config['archive_path'])
-        log.info("Job PID: %s", str(p.pid))
-
-        if teuth_config.results_server:
-            log.info("Running with watchdog")
-            try:
-                run_with_watchdog(p, job_config)
-            except Exception:
-                log.exception("run_with_watchdog had an unhandled exception")
-                raise
-        else:
-            log.info("Running without watchdog")
-            # This sleep() is to give the child time to start up and create the
-            # archive dir.
-            time.sleep(5)
-            symlink_worker_log(job_config['worker_log'],
-                               job_config['archive_path'])
-            p.wait()
-
-        if p.returncode != 0:
-            log.error('Child exited with code %d', p.returncode)
-        else:
-            log.info('Success!')
+    env = os.environ.copy()
+    python_path = env.get('PYTHONPATH', '')
+    python_path = ':'.join([suite_path, python_path]).strip(':')
+    env['PYTHONPATH'] = python_path
+    return arg, env
+
+
+def start_job(job_config, arg, env, tmp):
+    """
+    Write the job config to tmp and start teuthology on it
+
+    :param arg: The arguments from prep_job_args()
+    :param env: The environment from prep_job_args()
+    :param tmp: An open temporary file, which must stay around until the job
+                is done
+    :returns:   The subprocess.Popen object
+    """
+    yaml.safe_dump(data=job_config, stream=tmp)
+    tmp.flush()
+    arg = arg + [tmp.name]
+    log.debug("Running: %s" % ' '.join(arg))
+    p = subprocess.Popen(args=arg, env=env)
+    log.info("Job archive: %s", job_config['archive_path'])
+    log.info("Job PID: %s", str(p.pid))
+    return p
 
 
 def run_with_watchdog(process, job_config):
@@ -312,9 +353,11 @@ def run_with_watchdog(process, job_config):
             kill_job(job_info['name'], job_info['job_id'],
                      teuth_config.archive_base, job_config['owner'])
 
-        # calling this without a status just updates the jobs updated time
-        report.try_push_job_info(job_info)
+        # this just updates the job's updated time, along with those of the
+        # other jobs on this host
+        report.try_push_heartbeats([job_info])
         time.sleep(teuth_config.watchdog_interval)
+    report.try_end_heartbeat(job_info)
 
     # we no longer support testing theses old branches
     assert(job_config.get('teuthology_branch') not in ('argonaut', 'bobtail',
@@ -327,6 +370,217 @@ def run_with_watchdog(process, job_config):
     report.try_push_job_info(job_info, dict(status='dead'))
 
 
+class Dispatcher(object):
+    """
+    Runs up to `slots` jobs at once from a single worker process, reserving
+    another job whenever one finishes.
+
+    One loop reserves the jobs, notices when they exit, and does the work
+    run_with_watchdog() does for each job in the single-slot worker: killing
+    jobs that run too long and sending heartbeats for all of them together.
+    Each job is prepared and started in a greenlet of its own, so that
+    fetching its branches doesn't hold up the loop, and a job that can't be
+    started is left buried without stopping the others.
+
+    When a restart or stop is requested, or a job has stop_worker set, no
+    more jobs are reserved; the running ones are waited for first.
+    """
+    # How often to check on running jobs, in seconds
+    poll_interval = 5
+
+    def __init__(self, connection, slots, log_file_path, archive_dir,
+                 verbose=False):
+        self.connection = connection
+        self.slots = slots
+        self.log_file_path = log_file_path
+        self.archive_dir = archive_dir
+        self.verbose = verbose
+        self.running = list()
+        # the greenlets preparing and starting jobs
+        self.starting = list()
+        # jobs are prepared one at a time, as the single-slot worker does
+        self.prep_lock = gevent.lock.Semaphore()
+        # the greenlets share the connection with the loop
+        self.connection_lock = gevent.lock.Semaphore()
+        self.accepting = True
+        self.then = None
+        self.last_heartbeat = time.time()
+        self.reporter = None
+
+    def loop(self):
+        while self.accepting or self.running or self.starting:
+            if self.accepting:
+                if sentinel(restart_file_path):
+                    self.drain(restart)
+                elif sentinel(stop_file_path):
+                    self.drain(stop)
+            self.check_jobs()
+            if self.accepting and \
+                    len(self.running) + len(self.starting) < self.slots:
+                load_config()
+                with self.connection_lock:
+                    job = self.connection.reserve(timeout=self.poll_interval)
+                if job is not None:
+                    self.start(job)
+            else:
+                time.sleep(self.poll_interval)
+        if self.then is not None:
+            self.then()
+
+    def drain(self, then=None):
+        """
+        Stop reserving jobs, and once the running ones finish, call then()
+        """
+        log.info("Waiting for %d running jobs to finish",
+                 len(self.running) + len(self.starting))
+        self.accepting = False
+        self.then = then
+
+    def start(self, job):
+        """
+        Bury a reserved job, and prepare and start it in a new greenlet
+        """
+        # bury the job so it won't be re-run if it fails
+        with self.connection_lock:
+            job.bury()
+        job_id = job.jid
+        log.info('Reserved job %d', job_id)
+        log.info('Config is: %s', job.body)
+        try:
+            job_config = yaml.safe_load(job.body)
+            job_config['job_id'] = str(job_id)
+        except Exception:
+            log.exception("Could not read job %s; leaving it buried", job_id)
+            return
+
+        if job_config.get('stop_worker'):
+            self.drain()
+
+        self.starting.append(gevent.spawn(self._start, job, job_config))
+
+    def _start(self, job, job_config):
+        try:
+            self.start_job(job, job_config)
+        except SkipJob:
+            pass
+        except Exception as exc:
+            log.exception("Failed to start job %s; leaving it buried",
+                          job.jid)
+            report.try_push_job_info(
+                job_config,
+                dict(status='dead', failure_reason=str(exc))
+            )
+        finally:
+            self.starting.remove(gevent.getcurrent())
+
+    def start_job(self, job, job_config):
+        with self.prep_lock:
+            job_config, teuth_bin_path = prep_job(
+                job_config,
+                self.log_file_path,
+                self.archive_dir,
+            )
+
+        if job_config.get('first_in_suite') or job_config.get('last_in_suite'):
+            run_results(job_config, teuth_bin_path, self.archive_dir)
+            self.delete(job)
+            return
+
+        arg, env = prep_job_args(job_config, teuth_bin_path, self.verbose)
+        tmp = tempfile.NamedTemporaryFile(prefix='teuthology-worker.',
+                                          suffix='.tmp', mode='w+t')
+        try:
+            process = start_job(job_config, arg, env, tmp)
+        except Exception:
+            tmp.close()
+            raise
+        self.running.append(dict(
+            job=job,
+            job_config=job_config,
+            process=process,
+            tmp=tmp,
+            start_time=datetime.utcnow(),
+            symlinked=False,
+        ))
+
+    def check_jobs(self):
+        now = datetime.utcnow()
+        heartbeat = (
+            teuth_config.results_server and
+            time.time() - self.last_heartbeat >=
+            teuth_config.watchdog_interval
+        )
+        for running in list(self.running):
+            if running['process'].poll() is not None:
+                self.finish(running)
+                continue
+            job_config = running['job_config']
+            run_time = now - running['start_time']
+            total_seconds = run_time.days * 60 * 60 * 24 + run_time.seconds
+            # This is to give the child time to start up and create the
+            # archive dir.
+            if not running['symlinked'] and total_seconds >= 5:
+                symlink_worker_log(job_config['worker_log'],
+                                   job_config['archive_path'])
+                running['symlinked'] = True
+            # Kill jobs that have been running longer than the global max
+            if heartbeat and total_seconds > teuth_config.max_job_time:
+                log.warning(
+                    "Job {id} ran longer than {max}s. Killing...".format(
+                        id=job_config['job_id'],
+                        max=teuth_config.max_job_time))
+                kill_job(job_config['name'], job_config['job_id'],
+                         teuth_config.archive_base, job_config['owner'])
+        if heartbeat:
+            self.last_heartbeat = time.time()
+            if self.running:
+                # this just updates the jobs' updated times
+                report.try_push_heartbeats(
+                    [self.job_info(running) for running in self.running])
+
+    def finish(self, running):
+        self.running.remove(running)
+        running['tmp'].close()
+        process = running['process']
+        job_id = running['job_config']['job_id']
+        if process.returncode != 0:
+            log.error('Job %s exited with code %d', job_id,
+                      process.returncode)
+        else:
+            log.info('Job %s succeeded', job_id)
+        if teuth_config.results_server:
+            # See run_with_watchdog()
+            report.try_end_heartbeat(self.job_info(running))
+            report.try_push_jobs_info(
+                [self.job_info(running)], dict(status='dead'),
+                reporter=self.get_reporter(),
+            )
+        self.delete(running['job'])
+
+    def get_reporter(self):
+        if self.reporter is None:
+            self.reporter = report.ResultsReporter()
+        return self.reporter
+
+    @staticmethod
+    def job_info(running):
+        # Only push the information that's relevant to the watchdog, to save
+        # db load
+        return dict(
+            name=running['job_config']['name'],
+            job_id=running['job_config']['job_id'],
+        )
+
+    def delete(self, job):
+        # This try/except block is to keep the worker from dying when
+        # beanstalkc throws a SocketError
+        try:
+            with self.connection_lock:
+                job.delete()
+        except Exception:
+            log.exception("Saw exception while trying to delete job")
+
+
 def symlink_worker_log(worker_log_path, archive_dir):
     try:
         log.debug("Worker log: %s", worker_log_path)